@@ -0,0 +1,114 @@
+"""
+
+Streaming upload of the SIGIR .csv dataset files as .parquet, shared by the local_dataset_upload.py script
+of each flow.
+
+"""
+import os
+from typing import Optional, List
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow.fs import FileSystem, LocalFileSystem
+
+
+# explicit column types of the SIGIR eCom CSVs, so that every chunk gets the same schema
+SIGIR_COLUMN_TYPES = {
+    'browsing_train': {
+        'session_id_hash': pa.string(),
+        'event_type': pa.string(),
+        'product_action': pa.string(),
+        'product_sku_hash': pa.string(),
+        'server_timestamp_epoch_ms': pa.int64(),
+        'hashed_url': pa.string()
+    },
+    'search_train': {
+        'session_id_hash': pa.string(),
+        'query_vector': pa.string(),
+        'clicked_skus_hash': pa.string(),
+        'product_skus_hash': pa.string(),
+        'server_timestamp_epoch_ms': pa.int64()
+    },
+    'sku_to_content': {
+        'product_sku_hash': pa.string(),
+        'description_vector': pa.string(),
+        'category_hash': pa.string(),
+        'image_vector': pa.string(),
+        'price_bucket': pa.float64()
+    }
+}
+# low-cardinality columns, dictionary-encoded in the Parquet files (hashes repeat across rows); session ids
+# are near-unique, and would only make the dictionaries overflow to plain encoding
+DICTIONARY_COLUMNS = ['product_sku_hash', 'category_hash', 'hashed_url', 'event_type', 'product_action']
+
+
+def _filesystem_and_path(uri: str):
+    """
+    Resolve a S3 uri or a plain local path into a pyarrow filesystem and a path on it
+    """
+    try:
+        filesystem, path = FileSystem.from_uri(uri)
+    except (pa.ArrowInvalid, ValueError):
+        # plain relative path
+        filesystem, path = LocalFileSystem(), os.path.abspath(uri)
+    if isinstance(filesystem, LocalFileSystem):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    return filesystem, path
+
+
+def upload_file_as_parquet(file_path: str,
+                           target_s3_folder: str,
+                           chunksize: int = 500000,
+                           partition_cols: Optional[List[str]] = None,
+                           max_rows: Optional[int] = None) -> None:
+    """
+    Stream a SIGIR .csv file into Parquet: the file is read in chunks with explicit types and each chunk
+    is written as a row group of a single Parquet file (or as files of a partitioned dataset), so memory
+    is bounded by the chunk size and not by the file size
+
+    :param file_path: local .csv file
+    :param target_s3_folder: S3 (or local) folder
+    :param chunksize: number of rows per chunk / row group
+    :param partition_cols: if set, write a dataset partitioned by these columns
+    :param max_rows: if set, only upload the first max_rows rows
+    :return:
+    """
+    print('Begin reading file {}'.format(file_path))
+
+    file_name = os.path.splitext(os.path.basename(file_path))[0]
+    s3_file_name = os.path.join(target_s3_folder, file_name + '.parquet')
+    column_types = SIGIR_COLUMN_TYPES.get(file_name)
+    schema = None if column_types is None else pa.schema(list(column_types.items()))
+    # strings are read as object columns, numbers with their own type
+    dtypes = None if column_types is None else {
+        name: str if pa.types.is_string(data_type) else data_type.to_pandas_dtype()
+        for name, data_type in column_types.items()
+    }
+    chunks = pd.read_csv(file_path, chunksize=chunksize, dtype=dtypes, nrows=max_rows)
+
+    print('Begin upload to S3')
+    filesystem, path = _filesystem_and_path(s3_file_name)
+    sink = None
+    writer = None
+    n_rows = 0
+    for chunk in chunks:
+        table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+        # unknown files: all chunks get the schema of the first one
+        schema = table.schema
+        if partition_cols:
+            pq.write_to_dataset(table, root_path=path, partition_cols=partition_cols, filesystem=filesystem)
+        else:
+            if writer is None:
+                sink = filesystem.open_output_stream(path)
+                writer = pq.ParquetWriter(sink,
+                                          schema=schema,
+                                          use_dictionary=[name for name in schema.names if name in DICTIONARY_COLUMNS])
+            writer.write_table(table, row_group_size=chunksize)
+        n_rows += len(table)
+        print('Uploaded {} rows'.format(n_rows))
+    if writer is not None:
+        writer.close()
+        sink.close()
+
+    print('Parquet files for {} stored at : {}'.format(file_path, s3_file_name))
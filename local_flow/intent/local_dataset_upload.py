@@ -7,32 +7,13 @@ from dotenv import load_dotenv
 load_dotenv('.env')
 
 import os
-from typing import Optional, List
+import sys
 
-import pandas as pd
 from metaflow.metaflow_config import DATATOOLS_S3ROOT
 
-from src.utils import get_filename
-
-
-def upload_file_as_parquet(file_path: str,
-                           target_s3_folder: str,
-                           chunksize: Optional[int] = None,
-                           partition_cols: Optional[List[str]] = None) -> None:
-    print('Begin reading file {}'.format(file_path))
-
-    s3_file_name = os.path.join(
-        target_s3_folder, get_filename(file_path) + '.parquet')
-    if not chunksize is None:
-        df_content = next(pd.read_csv(file_path, chunksize=chunksize))
-    else:
-        df_content = pd.read_csv(file_path)
-
-    print('Begin upload to S3')
-    df_content.to_parquet(path=s3_file_name, engine='pyarrow',
-                          partition_cols=partition_cols)
-
-    print('Parquet files for {} stored at : {}'.format(file_path, s3_file_name))
+# shared upload module, in local_flow
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from dataset_upload import upload_file_as_parquet
 
 
 if __name__ == '__main__':
@@ -43,7 +24,6 @@ if __name__ == '__main__':
     TARGET_S3_PATH = os.path.join(DATATOOLS_S3ROOT, PARQUET_S3_PATH)
 
     # upload to S3 at some know path under the CartFlow directory
-    # for now, upload some rows
     # there is no versioning whatsoever at this stage
     upload_file_as_parquet(SKU_TO_CONTENT_PATH, TARGET_S3_PATH)
     upload_file_as_parquet(BROWSING_TRAIN_PATH, TARGET_S3_PATH)
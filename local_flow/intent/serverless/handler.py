@@ -7,10 +7,28 @@ from typing import Dict, Any, Union, IO
 
 # grab environment variables
 SAGEMAKER_ENDPOINT_NAME = os.getenv('SAGEMAKER_ENDPOINT_NAME')
+TRUNCATION_POLICY_BASENAME = os.getenv('TRUNCATION_POLICY_BASENAME', 'truncation-policy')
+# saved next to the handler by the deploy step of CartFlow
+TRUNCATION_POLICY_FNAME = "{}-{}.json".format(TRUNCATION_POLICY_BASENAME, SAGEMAKER_ENDPOINT_NAME)
+# 'sagemaker' calls the endpoint, 'local' runs the model in this process (see local_server.py)
+SERVING_MODE = os.getenv('SERVING_MODE', 'sagemaker')
 # print to AWS for debug!
 print(SAGEMAKER_ENDPOINT_NAME)
 # instantiate AWS client for invoking sagemaker endpoint
-runtime = boto3.client('sagemaker-runtime')
+runtime = boto3.client('sagemaker-runtime') if SERVING_MODE == 'sagemaker' else None
+# in-process endpoint, set by local_server.py in local serving mode
+local_endpoint = None
+# truncation policy the model was trained with, e.g. {"max_actions": 200, "compress_views": false}; loaded on
+# first request
+truncation_policy = None
+
+
+def get_truncation_policy():
+    global truncation_policy
+    if truncation_policy is None:
+        with open(TRUNCATION_POLICY_FNAME) as f:
+            truncation_policy = json.load(f)
+    return truncation_policy
 
 
 def wrap_response(status_code: int,
@@ -32,6 +50,23 @@ def wrap_response(status_code: int,
     }
 
 
+def truncate_session(actions: list, max_actions: int = None, compress_views: bool = False):
+    """
+    Same truncation as at training time (see truncate_session in src/prepare_dataset.py): optionally collapse
+    each run of consecutive views into a single view, then keep the last max_actions actions
+
+    :param actions: list of actions in a session, without start/end tokens
+    :param max_actions: maximum number of actions to keep, None for no limit
+    :param compress_views: collapse runs of consecutive views
+    :return: truncated list of actions
+    """
+    if compress_views:
+        actions = [a for i, a in enumerate(actions) if a != 'view' or i == 0 or actions[i - 1] != 'view']
+    if max_actions is not None and len(actions) > max_actions:
+        actions = actions[len(actions) - max_actions:]
+    return actions
+
+
 def get_response_from_sagemaker(model_input: str,
                                 endpoint_name: str,
                                 content_type: str = 'application/json'):
@@ -43,6 +78,9 @@ def get_response_from_sagemaker(model_input: str,
     :param content_type: content format, default to application/json
     :return:
     """
+    # local serving: same request, no HTTP hop
+    if local_endpoint is not None:
+        return local_endpoint.invoke(model_input, content_type)
     # get raw response from sagemaker
     response = runtime.invoke_endpoint(EndpointName=endpoint_name,
                                        ContentType=content_type,
@@ -81,7 +119,7 @@ def predict(event: Dict[str, Any],
 
     print(session)
 
-    session = ['start'] + session + ['end']
+    session = ['start'] + truncate_session(session, **get_truncation_policy()) + ['end']
 
     session_onehot = [
         action_map[_] if _ in action_map else action_map['empty']
@@ -0,0 +1,179 @@
+"""
+
+Local serving: load the model trained by CartFlow in-process, behind the same Lambda handler, with the
+shared HTTP front end and load tester of local_flow/local_serving.py.
+
+Usage (from the serverless folder):
+    python local_server.py serve [--run-id RUN_ID] [--port 8080]
+    python local_server.py load_test [--requests 2000] [--concurrency 16]
+
+"""
+import os
+import sys
+import json
+import random
+import asyncio
+import argparse
+import numpy as np
+
+SERVERLESS_PATH = os.path.dirname(os.path.abspath(__file__))
+SRC_PATH = os.path.join(SERVERLESS_PATH, '..', 'src')
+sys.path.append(SRC_PATH)
+# shared local serving module, in local_flow
+sys.path.append(os.path.join(SERVERLESS_PATH, '..', '..'))
+
+from local_serving import MicroBatcher, latest_trained_run, serve, load_test
+
+
+class LocalEndpoint:
+    """
+    In-process replacement for the SageMaker endpoint: requests get the same answer as from the default
+    TF Serving container (no custom input/output handlers for the intent model), without the HTTP hop.
+
+    Example:
+        >>> endpoint = LocalEndpoint.from_flow(run_id='1625000000000000')
+        >>> endpoint.invoke(json.dumps({'instances': [[[1, 0, 0, 0, 0, 0, 0], [0, 0, 0, 0, 1, 0, 0]]]}))
+    """
+    def __init__(self, tf_model, name: str, truncation_policy: dict = None):
+        self.tf_model = tf_model
+        self.name = name
+        self.truncation_policy = truncation_policy
+        # set by enable_batching
+        self.batcher = None
+
+    @classmethod
+    def from_flow(cls, run_id: str = None):
+        """
+        Build the endpoint from the artifacts of a CartFlow run
+
+        :param run_id: Metaflow run id, defaults to the latest run with a trained model
+        :return: LocalEndpoint
+        """
+        from metaflow import Run
+        from tensorflow.keras.models import model_from_json
+
+        run = Run('CartFlow/{}'.format(run_id)) if run_id else latest_trained_run('CartFlow')
+        print('Loading model from {}'.format(run.pathspec))
+        data = run['train_model'].task.data
+
+        tf_model = model_from_json(data.model)
+        tf_model.set_weights(data.model_weights)
+        # runs trained before the truncation policy have none
+        truncation_policy = data.truncation_policy if 'truncation_policy' in data else None
+        return cls(tf_model=tf_model, name='local-{}'.format(run.id), truncation_policy=truncation_policy)
+
+    def enable_batching(self, max_batch_size: int = 32, max_wait_ms: float = 2.0):
+        """
+        Route model calls through a MicroBatcher, so that concurrent requests share a forward pass
+
+        :param max_batch_size: maximum number of sessions per forward pass
+        :param max_wait_ms: maximum time a request waits for the batch to fill up
+        :return: the MicroBatcher
+        """
+        self.batcher = MicroBatcher(batch_fn=self.predict,
+                                    max_batch_size=max_batch_size,
+                                    max_wait_ms=max_wait_ms,
+                                    collate_fn=pad_sessions)
+        return self.batcher
+
+    def invoke(self, model_input: str, content_type: str = 'application/json'):
+        """
+        Same contract as invoking the SageMaker endpoint: JSON request in, decoded JSON response out
+
+        :param model_input: JSON dump of model input params
+        :param content_type: content format, only application/json is supported
+        :return: response dict, with 'predictions'
+        """
+        assert content_type == 'application/json'
+        instances = [np.array(session, dtype=np.float32) for session in json.loads(model_input)['instances']]
+        predictions = self.batcher.predict(instances) if self.batcher else self.predict(pad_sessions(instances))
+        return {'predictions': predictions}
+
+    def predict(self, instances: np.ndarray):
+        """
+        Run the model and format the outputs as TF Serving does (row format)
+
+        :param instances: (n, max_len, 7) one-hot sessions
+        :return: list of predictions, one per instance
+        """
+        return np.asarray(self.tf_model(instances, training=False)).tolist()
+
+
+def pad_sessions(sessions: list):
+    """
+    Stack one-hot sessions of different lengths into a batch, padding with all-zero steps (post); padded
+    steps are skipped by the Masking layer of the model
+
+    :param sessions: list of (length, 7) one-hot sessions
+    :return: (n, max_len, 7) array
+    """
+    max_len = max(len(session) for session in sessions)
+    batch = np.zeros((len(sessions), max_len, 7), dtype=np.float32)
+    for idx, session in enumerate(sessions):
+        batch[idx, :len(session)] = session
+    return batch
+
+
+def build_handler(endpoint: LocalEndpoint):
+    """
+    Import the Lambda handler in local serving mode, wired to an in-process endpoint
+
+    :param endpoint: LocalEndpoint
+    :return: the handler module
+    """
+    # the handler reads its truncation policy from disk, as in the Lambda package
+    from deploy_model import save_truncation_policy
+
+    truncation_policy_fname = os.path.join(SERVERLESS_PATH, 'truncation-policy-{}.json'.format(endpoint.name))
+    # runs trained before the truncation policy did not truncate
+    save_truncation_policy(truncation_policy_fname, endpoint.truncation_policy or {})
+    print('Truncation policy saved at: {}'.format(truncation_policy_fname))
+
+    os.environ['SAGEMAKER_ENDPOINT_NAME'] = endpoint.name
+    os.environ['SERVING_MODE'] = 'local'
+    os.chdir(SERVERLESS_PATH)
+    import handler
+    handler.local_endpoint = endpoint
+    return handler
+
+
+def random_sessions(n_sessions: int = 1000, max_len: int = 20, seed: int = 42):
+    """
+    Random browsing sessions, in the format expected by the Lambda, to be used as load test requests
+
+    :param n_sessions: number of sessions
+    :param max_len: maximum session length
+    :param seed: random seed
+    :return: list of sessions (list of actions)
+    """
+    rng = random.Random(seed)
+    return [rng.choices(['detail', 'view', 'add', 'remove'], k=rng.randint(1, max_len)) for _ in range(n_sessions)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['serve', 'load_test'])
+    parser.add_argument('--run-id', default=None)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    # micro-batching window, a max batch size of 1 disables it
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=2.0)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        endpoint = LocalEndpoint.from_flow(run_id=args.run_id)
+        batcher = endpoint.enable_batching(args.max_batch_size, args.max_wait_ms) if args.max_batch_size > 1 else None
+        asyncio.run(serve(build_handler(endpoint).predict,
+                          host=args.host,
+                          port=args.port,
+                          n_workers=2 * args.max_batch_size if batcher else 1,
+                          metrics_fn=batcher.metrics if batcher else None))
+    else:
+        asyncio.run(load_test(random_sessions(),
+                              host=args.host,
+                              port=args.port,
+                              n_requests=args.requests,
+                              concurrency=args.concurrency))
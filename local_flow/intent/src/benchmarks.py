@@ -0,0 +1,117 @@
+"""
+
+Micro-benchmarks for the intent flow, run on synthetic sessions
+
+Usage: python src/benchmarks.py <benchmark_name> [--rows N]
+
+"""
+import time
+import argparse
+import numpy as np
+
+
+def make_sessions(n_sessions: int,
+                  mean_session_len: int = 10,
+                  long_session_share: float = 0.001,
+                  long_session_len: int = 1000,
+                  seed: int = 42):
+    """
+    Build synthetic indexed sessions (with start/end tokens) and labels: lengths are geometric, plus a few very
+    long sessions, as in the browsing data
+
+    :param n_sessions: number of sessions
+    :param mean_session_len: average number of actions per session
+    :param long_session_share: share of sessions of long_session_len actions
+    :param long_session_len: length of the long sessions
+    :param seed: random seed
+    :return: list of sessions (lists of action indices) and list of labels
+    """
+    rng = np.random.default_rng(seed)
+    lengths = rng.geometric(1.0 / mean_session_len, size=n_sessions)
+    lengths[rng.random(n_sessions) < long_session_share] = long_session_len
+    x = [[0] + rng.integers(2, 7, size=length).tolist() + [1] for length in lengths]
+    y = rng.integers(0, 2, size=n_sessions).tolist()
+    return x, y
+
+
+def timed(func, *args, **kwargs):
+    """
+    Run a function once and return its output along with the elapsed wall time in seconds
+    """
+    start = time.perf_counter()
+    out = func(*args, **kwargs)
+    return out, time.perf_counter() - start
+
+
+def benchmark_input_pipeline(n_rows: int, epochs: int = 2, batch_size: int = 128):
+    """
+    Compare training on one-hot sessions all padded to the longest one against the bucketed int8 tf.data
+    pipeline: input memory and epoch time (the last epoch, after tracing); n_rows is the number of sessions
+    """
+    import tensorflow.keras as keras
+    from tensorflow.keras.preprocessing.sequence import pad_sequences
+    from model import PAD_IDX, build_lstm_model, id_input_model, session_dataset, padded_one_hot
+
+    class EpochTimer(keras.callbacks.Callback):
+        def on_train_begin(self, logs=None):
+            self.times = []
+
+        def on_epoch_begin(self, epoch, logs=None):
+            self.start = time.perf_counter()
+
+        def on_epoch_end(self, epoch, logs=None):
+            self.times.append(time.perf_counter() - self.start)
+
+    x, y = make_sessions(n_rows)
+    max_len = max(len(_) for _ in x)
+    print('{} sessions, {} actions, longest session {} actions'.format(len(x), sum(len(_) for _ in x), max_len))
+
+    # golden checks: the pipeline yields the sessions and labels unchanged (one bucket, no shuffle), and the
+    # model over int8 ids predicts as the one-hot model, with the same weights
+    sample_x, sample_y = x[:512], y[:512]
+    batches = list(session_dataset(sample_x, sample_y, bucket_boundaries=[]).as_numpy_iterator())
+    rows = [row for sessions, _ in batches for row in sessions]
+    assert [row[:len(session)].tolist() for row, session in zip(rows, sample_x)] == sample_x
+    assert all((row[len(session):] == PAD_IDX).all() for row, session in zip(rows, sample_x))
+    assert np.concatenate([labels for _, labels in batches]).tolist() == sample_y
+    model = build_lstm_model()
+    sample_len = max(len(_) for _ in sample_x)
+    one_hot_preds = model.predict(padded_one_hot(sample_x, sample_len))
+    id_preds = id_input_model(model).predict(
+        pad_sequences(sample_x, padding="post", value=PAD_IDX, maxlen=sample_len).astype(np.int8))
+    assert np.allclose(one_hot_preds, id_preds, atol=1e-5)
+
+    padded, padded_build_time = timed(padded_one_hot, x, max_len)
+    dataset, dataset_build_time = timed(session_dataset, x, y, batch_size=batch_size, shuffle=True)
+    batch_shapes = [sessions.shape for sessions, _ in dataset.as_numpy_iterator()]
+    flat_bytes = sum(len(_) for _ in x)
+
+    results = {}
+    for name, fit_model, fit_inputs in (
+            ('padded one-hot', build_lstm_model(), dict(x=padded, y=np.array(y), batch_size=batch_size)),
+            ('bucketed int8', id_input_model(build_lstm_model()), dict(x=dataset))):
+        fit_model.compile(optimizer='adam', loss='binary_crossentropy')
+        timer = EpochTimer()
+        fit_model.fit(epochs=epochs, callbacks=[timer], verbose=0, **fit_inputs)
+        results[name] = timer.times[-1]
+
+    print('padded one-hot: {:.1f} MB of float32 inputs, built in {:.2f}s, {} padded timesteps, epoch {:.2f}s'.format(
+        padded.numpy().nbytes / 2 ** 20, padded_build_time, len(x) * max_len, results['padded one-hot']))
+    print('bucketed int8 : {:.1f} MB of int8 inputs, built in {:.2f}s, {} padded timesteps, epoch {:.2f}s '
+          '({} batches, x{:.1f})'.format(flat_bytes / 2 ** 20, dataset_build_time,
+                                         sum(rows * length for rows, length in batch_shapes),
+                                         results['bucketed int8'], len(batch_shapes),
+                                         results['padded one-hot'] / results['bucketed int8']))
+
+
+BENCHMARKS = {
+    'input_pipeline': benchmark_input_pipeline,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('--rows', type=int, default=10000)
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args.rows)
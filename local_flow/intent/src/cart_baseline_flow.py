@@ -139,6 +139,7 @@ class CartFlow(FlowSpec):
         """
         
         from model import train_lstm_model
+        from prepare_dataset import truncate_sessions
         from utils import ExperimentTracker
         
         # Get tracker name by detecting which tracker's environment variables are set
@@ -153,14 +154,20 @@ class CartFlow(FlowSpec):
             s3_path=os.getenv('PARQUET_S3_PATH')
         )
 
-        self.model, self.model_weights = train_lstm_model(x=self.dataset['X'],
+        # truncation policy: an artifact of the run, stored with the model so that inference truncates as training
+        self.truncation_policy = {'max_actions': self.config['MAX_ACTIONS'],
+                                  'compress_views': self.config['COMPRESS_VIEWS']}
+        x = truncate_sessions(self.dataset['X'], **self.truncation_policy)
+
+        self.model, self.model_weights = train_lstm_model(x=x,
                                                           y=self.dataset['y'],
                                                           epochs=self.config['EPOCHS'],
                                                           patience=self.config['PATIENCE'],
                                                           lstm_dim=self.config['LSTM_DIMS'],
                                                           batch_size=self.config['BATCH_SIZE'],
                                                           lr=self.config['LEARNING_RATE'],
-                                                          tracker_callback=tracker.get_tracker_callback())
+                                                          tracker_callback=tracker.get_tracker_callback(),
+                                                          bucketed=self.config['BUCKETED_INPUT'])
         self.next(self.deploy)
 
     @step
@@ -170,7 +177,7 @@ class CartFlow(FlowSpec):
         """
         import os
         from tensorflow.keras.models import model_from_json
-        from deploy_model import deploy_model, tf_model_to_tar
+        from deploy_model import deploy_model, tf_model_to_tar, save_truncation_policy
 
         # load model from artifacts
         tf_model = model_from_json(self.model)
@@ -192,6 +199,10 @@ class CartFlow(FlowSpec):
 
         # deploy model on SageMaker
         self.endpoint_name = deploy_model(self.model_s3_path)
+        # the Lambda must truncate sessions as the model was trained: save the policy to the serverless folder
+        self.truncation_policy_fname = 'serverless/truncation-policy-{}.json'.format(self.endpoint_name)
+        save_truncation_policy(self.truncation_policy_fname, self.truncation_policy)
+        print("Truncation policy saved at: {}".format(self.truncation_policy_fname))
 
         self.next(self.end)
 
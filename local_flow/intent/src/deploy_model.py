@@ -4,6 +4,7 @@ Deploy a tensorflow model onto SageMaker
 
 """
 import os
+import json
 import time
 import shutil
 import tarfile
@@ -12,7 +13,7 @@ import tensorflow as tf
 from sagemaker.tensorflow import TensorFlowModel
 
 
-def tf_model_to_tar(tf_model, run_id: int, ):
+def tf_model_to_tar(tf_model, run_id: int):
     """
     Saves tensorflow model as compressed file
 
@@ -35,6 +36,18 @@ def tf_model_to_tar(tf_model, run_id: int, ):
     return local_tar_name
 
 
+def save_truncation_policy(fname: str, truncation_policy: dict):
+    """
+    Save the truncation policy the model was trained with, to be packaged with the Lambda (see serverless.yml)
+
+    :param fname: output file name
+    :param truncation_policy: truncate_session arguments, e.g. {"max_actions": 200, "compress_views": false}
+    :return:
+    """
+    with open(fname, 'w') as f:
+        json.dump(truncation_policy, f)
+
+
 def deploy_model(model_s3_path: str):
     """
     Entry point for deploy step
@@ -5,6 +5,7 @@ Train and LSTM model for intent prediction with using Neptune.ai or Weights & Bi
 """
 
 import numpy as np
+from itertools import chain
 import tensorflow as tf
 import tensorflow.keras as keras
 from tensorflow.keras.models import model_from_json
@@ -12,17 +13,119 @@ from tensorflow.keras.preprocessing.sequence import pad_sequences
 from tensorflow.python.client import device_lib
 from sklearn.model_selection import train_test_split
 
-from prepare_dataset import session_indexed
+from prepare_dataset import session_indexed, truncate_session
 from utils import return_json_file_content
 
 
+# one-hot depth (the 7 action tokens) and the index used to pad sessions, one-hot encoded as a zero vector
+N_ACTIONS = 7
+PAD_IDX = 7
+
+
+def build_lstm_model(lstm_dim: int = 48):
+    """
+    LSTM over one-hot encoded sessions: this is the model that is deployed and served
+
+    :param lstm_dim: lstm units
+    :return: keras model, with (batch, timesteps, 7) float inputs
+    """
+    model = keras.Sequential()
+    model.add(keras.layers.InputLayer(input_shape=(None, N_ACTIONS)))
+    # Masking layer ignores padded time-steps
+    model.add(keras.layers.Masking())
+    model.add(keras.layers.LSTM(lstm_dim))
+    model.add(keras.layers.Dense(1, activation='sigmoid'))
+    return model
+
+
+def id_input_model(one_hot_model):
+    """
+    Wrap a one-hot model to take int8 action ids: a frozen identity Embedding does the one-hot encoding in the
+    graph, with the padding index as a zero vector (masked as before); the layers of the one-hot model are shared,
+    so training this model trains it
+
+    :param one_hot_model: model built by build_lstm_model
+    :return: keras model, with (batch, timesteps) int8 inputs
+    """
+    one_hot = np.vstack([np.eye(N_ACTIONS), np.zeros((1, N_ACTIONS))]).astype(np.float32)
+    model = keras.Sequential()
+    model.add(keras.layers.InputLayer(input_shape=(None,), dtype='int8'))
+    model.add(keras.layers.Embedding(N_ACTIONS + 1, N_ACTIONS,
+                                     embeddings_initializer=keras.initializers.Constant(one_hot),
+                                     trainable=False))
+    model.add(one_hot_model)
+    return model
+
+
+def length_buckets(lengths: np.ndarray, n_buckets: int = 8):
+    """
+    Bucket boundaries at the quantiles of the session lengths, so that buckets get about as many sessions, then
+    doubling up to the longest session, so that the few long sessions are not batched with shorter ones
+
+    :param lengths: session lengths
+    :param n_buckets: number of quantile buckets
+    :return: increasing list of boundaries (a session of length l goes to the first bucket with l < boundary)
+    """
+    boundaries = np.unique(np.quantile(lengths, np.linspace(0, 1, n_buckets + 1)[1:-1]).astype(np.int64) + 1)
+    boundaries = boundaries.tolist() or [1]
+    while boundaries[-1] * 2 <= np.max(lengths):
+        boundaries.append(boundaries[-1] * 2)
+    return boundaries
+
+
+def session_dataset(x, y,
+                    batch_size: int = 128,
+                    bucket_boundaries: list = None,
+                    shuffle: bool = False):
+    """
+    tf.data pipeline over variable-length sessions: sessions are kept as one flat int8 array of action ids, sliced
+    per element, and batches are drawn from length buckets and padded to their own longest session only
+
+    :param x: indexed sessions
+    :param y: target labels
+    :param batch_size: batch size
+    :param bucket_boundaries: session length boundaries of the buckets, defaults to length_buckets
+    :param shuffle: reshuffle sessions at each epoch
+    :return: dataset of (int8 sessions, int8 labels) batches
+    """
+    lengths = np.fromiter((len(_) for _ in x), dtype=np.int64, count=len(x))
+    starts = np.cumsum(lengths) - lengths
+    actions = tf.constant(np.fromiter(chain.from_iterable(x), dtype=np.int8, count=int(lengths.sum())))
+    if bucket_boundaries is None:
+        bucket_boundaries = length_buckets(lengths)
+
+    dataset = tf.data.Dataset.from_tensor_slices((starts, lengths, np.asarray(y, dtype=np.int8)))
+    if shuffle:
+        dataset = dataset.shuffle(len(lengths), reshuffle_each_iteration=True)
+    dataset = dataset.map(lambda start, length, label: (actions[start:start + length], label),
+                          num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.apply(tf.data.experimental.bucket_by_sequence_length(
+        element_length_func=lambda session, label: tf.shape(session)[0],
+        bucket_boundaries=bucket_boundaries,
+        bucket_batch_sizes=[batch_size] * (len(bucket_boundaries) + 1),
+        padding_values=(tf.constant(PAD_IDX, dtype=tf.int8), tf.constant(0, dtype=tf.int8))))
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def padded_one_hot(x, max_len: int):
+    """
+    Pad all sessions to max_len and one-hot encode them, as float32
+
+    :param x: indexed sessions
+    :param max_len: padded length
+    :return: (sessions, max_len, 7) tensor
+    """
+    return tf.one_hot(pad_sequences(x, padding="post", value=PAD_IDX, maxlen=max_len), depth=N_ACTIONS)
+
+
 def train_lstm_model(x, y,
                      epochs=200,
                      patience=10,
                      lstm_dim=48,
                      batch_size=128,
                      lr=1e-3,
-                     tracker_callback=None):
+                     tracker_callback=None,
+                     bucketed=True):
     """
     Train an LSTM to predict purchase (1) or abandon (0)
 
@@ -34,6 +137,8 @@ def train_lstm_model(x, y,
     :param batch_size: batch size
     :param lr: learning rate
     :param tracker_callback: experiment tracking callback
+    :param bucketed: train on int8 sessions batched by length (session_dataset), instead of one-hot sessions
+        all padded to the longest one (see benchmarks.py input_pipeline)
     :return: trained model as json-serialized model and model weights
     """
 
@@ -44,27 +149,25 @@ def train_lstm_model(x, y,
 
     # train & test splits
     X_train, X_test, y_train, y_test = train_test_split(x, y)
-    # pad sequences for training in batches
-    max_len = max(len(_) for _ in x)
-    X_train = pad_sequences(X_train, padding="post", value=7, maxlen=max_len)
-    X_test = pad_sequences(X_test, padding="post", value=7, maxlen=max_len)
-
-    # convert to one-hot
-    X_train = tf.one_hot(X_train, depth=7)
-    X_test = tf.one_hot(X_test, depth=7)
-
-    y_train = np.array(y_train)
-    y_test = np.array(y_test)
 
     # Define Model
-    model = keras.Sequential()
-    model.add(keras.layers.InputLayer(input_shape=(None, 7)))
-    # Masking layer ignores padded time-steps
-    model.add(keras.layers.Masking())
-    model.add(keras.layers.LSTM(lstm_dim))
-    model.add(keras.layers.Dense(1, activation='sigmoid'))
+    model = build_lstm_model(lstm_dim)
     model.summary()
 
+    if bucketed:
+        # the one-hot encoding happens in the graph, batch by batch
+        train_model = id_input_model(model)
+        fit_inputs = dict(x=session_dataset(X_train, y_train, batch_size=batch_size, shuffle=True),
+                          validation_data=session_dataset(X_test, y_test, batch_size=batch_size))
+    else:
+        # pad sequences for training in batches, and convert to one-hot
+        train_model = model
+        max_len = max(len(_) for _ in x)
+        fit_inputs = dict(x=padded_one_hot(X_train, max_len),
+                          y=np.array(y_train),
+                          validation_data=(padded_one_hot(X_test, max_len), np.array(y_test)),
+                          batch_size=batch_size)
+
     # Some Hyper Params
     opt = keras.optimizers.Adam(learning_rate=lr)
     loss = keras.losses.BinaryCrossentropy()
@@ -79,29 +182,28 @@ def train_lstm_model(x, y,
     else:
         callbacks = [es]
 
-    model.compile(optimizer=opt,
-                  loss=loss,
-                  metrics=['accuracy'])
+    train_model.compile(optimizer=opt,
+                        loss=loss,
+                        metrics=['accuracy'])
 
     # Train Model
-    model.fit(X_train, y_train,
-              validation_data=(X_test, y_test),
-              batch_size=batch_size,
-              epochs=epochs,
-              callbacks=callbacks)
+    train_model.fit(epochs=epochs,
+                    callbacks=callbacks,
+                    **fit_inputs)
 
-    # return trained model
+    # return trained model: the one-hot model, whose weights were trained through train_model
     # NB: to store model as Metaflow Artifact it needs to be pickle-able!
     return model.to_json(), model.get_weights()
 
 
-def make_predictions(model, model_weights, test_file: str):
+def make_predictions(model, model_weights, test_file: str, truncation_policy: dict = None):
     """
     Made predictions given a data challenge test file
 
     :param model: prediction model
     :param model_weights: model weights
     :param test_file: path to test file
+    :param truncation_policy: truncate_session arguments the model was trained with
     :return: predictions over test file
     """
     # re-init model and load weights
@@ -122,13 +224,12 @@ def make_predictions(model, model_weights, test_file: str):
                 actions.append('view')
             elif e['product_action'] != None:
                 actions.append(e['product_action'])
-        X_test.append(actions)
+        X_test.append(truncate_session(actions, **(truncation_policy or {})))
 
     # Convert to index, pad & one-hot
-    max_len = max([len(_) for _ in X_test])
     X_test = [session_indexed(_) for _ in X_test]
-    X_test = pad_sequences(X_test, padding="post", value=7, maxlen=max_len)
-    X_test = tf.one_hot(X_test, depth=7)
+    max_len = max([len(_) for _ in X_test])
+    X_test = padded_one_hot(X_test, max_len)
 
     # make predictions
     preds = model.predict(X_test, batch_size=128)
@@ -6,6 +6,8 @@ Data preparation for model training
 import csv
 import pandas as pd
 
+from session_labels import ACTION_TO_IDX, sessions_to_flat_array, prepare_training_arrays
+
 
 def prepare_dataset(training_file: str, K: int = None):
     """
@@ -68,10 +70,38 @@ def session_indexed(s: list):
     :param s: list of actions in a session (i.e 'add','detail', etc)
     :return: list of actions as indices
     """
-    # assign an integer to each possible action token
-    action_to_idx = {'start': 0, 'end': 1, 'add': 2,
-                     'remove': 3, 'purchase': 4, 'detail': 5, 'view': 6}
-    return [action_to_idx['start']] + [action_to_idx[e] for e in s] + [action_to_idx['end']]
+    return [ACTION_TO_IDX['start']] + [ACTION_TO_IDX[e] for e in s] + [ACTION_TO_IDX['end']]
+
+
+def truncate_session(actions: list, max_actions: int = None, compress_views: bool = False, view='view'):
+    """
+    Truncation policy for sessions of unbounded length: optionally collapse each run of consecutive views into
+    a single view, then keep the last max_actions actions (the ones closest to the prediction)
+
+    :param actions: list of actions in a session, without start/end tokens (names or indices)
+    :param max_actions: maximum number of actions to keep, None for no limit
+    :param compress_views: collapse runs of consecutive views
+    :param view: the view action, as it appears in actions
+    :return: truncated list of actions
+    """
+    if compress_views:
+        actions = [a for i, a in enumerate(actions) if a != view or i == 0 or actions[i - 1] != view]
+    if max_actions is not None and len(actions) > max_actions:
+        actions = actions[len(actions) - max_actions:]
+    return actions
+
+
+def truncate_sessions(x: list, max_actions: int = None, compress_views: bool = False):
+    """
+    Apply the truncation policy to indexed sessions, keeping their start/end tokens
+
+    :param x: indexed sessions (with start/end tokens)
+    :param max_actions: maximum number of actions to keep, None for no limit
+    :param compress_views: collapse runs of consecutive views
+    :return: truncated indexed sessions
+    """
+    return [[s[0]] + truncate_session(s[1:-1], max_actions, compress_views, view=ACTION_TO_IDX['view']) + [s[-1]]
+            for s in x]
 
 
 def prepare_training_data(sessions: list):
@@ -81,36 +111,5 @@ def prepare_training_data(sessions: list):
     :param sessions: list of sessions
     :return: training data
     """
-
-    purchase_sessions = []
-    abandon_sessions = []
-    for s in sessions:
-        # check that purchase action occurs after add action
-        if 'purchase' in s and 'add' in s and s.index('purchase') > s.index('add'):
-            first_purchase = s.index('purchase')
-            p_session = s
-            # truncate session if multiple purchase actions in a session
-            if s.count('purchase') > 1:
-                second_purchase = s.index('purchase', first_purchase + 1)
-                p_session = s[:second_purchase]
-            # remove actual purchase from list
-            p_session.pop(first_purchase)
-            purchase_sessions.append(p_session)
-            assert not any(e == 'purchase' for e in p_session)
-
-        # add action but no purchase
-        elif 'add' in s and 'purchase' not in s:
-            abandon_sessions.append(s)
-
-    # convert sessions to index
-    purchase_sessions = [session_indexed(s) for s in purchase_sessions]
-    abandon_sessions = [session_indexed(s) for s in abandon_sessions]
-
-    # combine session with purchase and abandon
-    x = purchase_sessions + abandon_sessions
-
-    # give label=1 for purchase, label=0 for abandon
-    y = [1] * len(purchase_sessions) + [0] * len(abandon_sessions)
-    assert len(x) == len(y)
-
-    return x, y
+    actions, offsets = sessions_to_flat_array(sessions)
+    return prepare_training_arrays(actions, offsets)
@@ -0,0 +1,139 @@
+"""
+
+Batched purchase/abandon labelling of sessions over a flat array of action indices, shared by the intent flow
+(src/prepare_dataset.py) and the remote flow (remote_flow/metaflow/prepare_dataset.py, which adds this folder
+to its path).
+
+"""
+import numpy as np
+
+
+# assign an integer to each possible action token
+ACTION_TO_IDX = {'start': 0, 'end': 1, 'add': 2,
+                 'remove': 3, 'purchase': 4, 'detail': 5, 'view': 6}
+# index of the actions outside ACTION_TO_IDX (e.g. 'click'): they are dropped when labelling
+UNKNOWN_ACTION = -1
+
+
+def sessions_to_flat_array(sessions: list, action_to_idx: dict = ACTION_TO_IDX):
+    """
+    Encode a list of sessions (of actions) as one flat int8 array of action indices plus offsets
+
+    :param sessions: list of sessions
+    :param action_to_idx: index of each action, actions missing from it are encoded as UNKNOWN_ACTION
+    :return: flat int8 action array and int64 offsets, session i being actions[offsets[i]:offsets[i+1]]
+    """
+    lengths = np.fromiter((len(s) for s in sessions), dtype=np.int64, count=len(sessions))
+    offsets = np.zeros(len(sessions) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    actions = np.fromiter((action_to_idx.get(e, UNKNOWN_ACTION) for s in sessions for e in s),
+                          dtype=np.int8, count=offsets[-1])
+    return actions, offsets
+
+
+def _first_per_session(mask: np.ndarray, seg: np.ndarray, pos: np.ndarray, n_sessions: int, rank: int = 0):
+    """
+    Position of the (rank+1)-th flagged action in each session, or -1 if there is none
+
+    :param mask: boolean flag per action
+    :param seg: session index per action
+    :param pos: position within its session per action
+    :param n_sessions: number of sessions
+    :param rank: 0 for the first occurrence, 1 for the second and so on
+    :return: int64 array of positions, one per session
+    """
+    out = np.full(n_sessions, -1, dtype=np.int64)
+    idx = np.flatnonzero(mask)
+    if len(idx) == 0:
+        return out
+    idx_seg = seg[idx]
+    # flagged actions are ordered by session, so each group starts where the session index changes
+    group_start = np.flatnonzero(np.r_[True, idx_seg[1:] != idx_seg[:-1]])
+    group_rank = np.arange(len(idx)) - np.repeat(group_start, np.diff(np.r_[group_start, len(idx)]))
+    hit = group_rank == rank
+    out[idx_seg[hit]] = pos[idx[hit]]
+    return out
+
+
+def label_sessions(actions: np.ndarray, offsets: np.ndarray, pad_value: int = 7):
+    """
+    Batched purchase/abandon labeller over a flat action array
+
+    A session is a purchase session if its first purchase follows its first add: it is truncated
+    before its second purchase (if any) and the first purchase is removed. A session with adds but
+    no purchase is an abandon session. Other sessions are dropped. Unknown actions (UNKNOWN_ACTION)
+    are removed from the sessions that are kept.
+
+    :param actions: flat int8 array of action indices
+    :param offsets: session i is actions[offsets[i]:offsets[i+1]]
+    :param pad_value: value used to right-pad sessions
+    :return: padded int8 matrix of indexed sessions (with start/end tokens; purchase sessions first),
+             int64 lengths of each row and int8 labels
+    """
+    n_sessions = len(offsets) - 1
+    lengths = np.diff(offsets)
+    seg = np.repeat(np.arange(n_sessions), lengths)
+    pos = np.arange(len(actions)) - offsets[seg]
+
+    is_purchase = actions == ACTION_TO_IDX['purchase']
+    first_add = _first_per_session(actions == ACTION_TO_IDX['add'], seg, pos, n_sessions)
+    first_purchase = _first_per_session(is_purchase, seg, pos, n_sessions)
+    second_purchase = _first_per_session(is_purchase, seg, pos, n_sessions, rank=1)
+
+    # check that purchase action occurs after add action
+    purchase_session = (first_add >= 0) & (first_purchase > first_add)
+    # add action but no purchase
+    abandon_session = (first_add >= 0) & (first_purchase < 0)
+    # truncate session if multiple purchase actions in a session
+    cut = np.where(second_purchase >= 0, second_purchase, lengths)
+
+    # keep actions before the cut, minus the actual purchase, for purchase sessions; all for abandon ones
+    keep = (purchase_session[seg] & (pos < cut[seg]) & (pos != first_purchase[seg])) | abandon_session[seg]
+    # drop unknown actions
+    unknown = actions == UNKNOWN_ACTION
+    if unknown.any():
+        print("# unknown actions dropped: {}".format(int((keep & unknown).sum())))
+        keep &= ~unknown
+
+    # output rows: purchase sessions first, then abandon sessions, each in input order
+    n_purchase = int(purchase_session.sum())
+    row = np.full(n_sessions, -1, dtype=np.int64)
+    row[purchase_session] = np.arange(n_purchase)
+    row[abandon_session] = n_purchase + np.arange(int(abandon_session.sum()))
+    n_rows = n_purchase + int(abandon_session.sum())
+
+    # column of each kept action, shifted by one for the start token
+    kept_before = np.cumsum(keep) - keep
+    col = kept_before - kept_before[offsets[seg]] + 1
+
+    # kept actions per session, plus start/end tokens
+    row_lengths = np.bincount(row[seg[keep]], minlength=n_rows) + 2
+
+    x = np.full((n_rows, int(row_lengths.max()) if n_rows else 2), pad_value, dtype=np.int8)
+    x[:, 0] = ACTION_TO_IDX['start']
+    x[row[seg[keep]], col[keep]] = actions[keep]
+    x[np.arange(n_rows), row_lengths - 1] = ACTION_TO_IDX['end']
+
+    # give label=1 for purchase, label=0 for abandon
+    y = np.zeros(n_rows, dtype=np.int8)
+    y[:n_purchase] = 1
+
+    return x, row_lengths, y
+
+
+def prepare_training_arrays(actions: np.ndarray, offsets: np.ndarray):
+    """
+    Convert sessions, as a flat action array, into training data
+
+    :param actions: flat int8 array of action indices
+    :param offsets: session i is actions[offsets[i]:offsets[i+1]]
+    :return: x (variable-length sessions of action indices, with start/end tokens) and y (labels)
+    """
+    x_padded, lengths, y = label_sessions(actions, offsets)
+
+    # strip padding to return variable-length sessions
+    x = [_x[:_l].tolist() for _x, _l in zip(x_padded, lengths.tolist())]
+    y = y.tolist()
+    assert len(x) == len(y)
+
+    return x, y
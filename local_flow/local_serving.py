@@ -0,0 +1,241 @@
+"""
+
+Local serving shared by the flows: micro-batching in front of a model, a small asyncio HTTP front end exposing
+the Lambda handler as the API Gateway does, and a load tester to measure latency and throughput without AWS.
+The model-specific endpoints are in each flow's serverless/local_server.py.
+
+"""
+import json
+import time
+import queue
+import random
+import asyncio
+import threading
+import numpy as np
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, Future
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+HTTP_REASONS = {200: 'OK', 404: 'Not Found', 500: 'Internal Server Error'}
+
+
+class MicroBatcher:
+    """
+    Micro-batching in front of a model: concurrent single-row requests are collected for up to
+    `max_wait_ms` (counted from the first row) or `max_batch_size` rows, scored with one batched call
+    of `batch_fn`, and each caller gets back its own row.
+
+    Attributes:
+        batch_sizes (`Counter`): number of batches run for each batch size, for fill rate metrics.
+
+    Example:
+        >>> batcher = MicroBatcher(batch_fn=endpoint.predict, max_batch_size=32, max_wait_ms=2.0)
+        >>> predictions = batcher.predict(list(instances))
+    """
+    def __init__(self, batch_fn, max_batch_size: int = 32, max_wait_ms: float = 2.0, collate_fn=np.stack):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.collate_fn = collate_fn
+        self.batch_sizes = Counter()
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def predict(self, rows: list):
+        """
+        Score rows, waiting for them to be batched with concurrent requests
+
+        :param rows: model inputs, one per row
+        :return: list of predictions, one per row
+        """
+        futures = []
+        for row in rows:
+            future = Future()
+            self._queue.put((row, future))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def metrics(self):
+        """
+        Batching metrics: number of batches and rows, mean batch size and fill rate (mean size / max size)
+        """
+        n_batches = sum(self.batch_sizes.values())
+        n_rows = sum(size * count for size, count in self.batch_sizes.items())
+        mean_batch_size = n_rows / n_batches if n_batches else 0.0
+        return {
+            'batches': n_batches,
+            'rows': n_rows,
+            'mean_batch_size': mean_batch_size,
+            'fill_rate': mean_batch_size / self.max_batch_size,
+            'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())}
+        }
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            rows, futures = zip(*batch)
+            try:
+                for future, prediction in zip(futures, self.batch_fn(self.collate_fn(rows))):
+                    future.set_result(prediction)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+            self.batch_sizes[len(batch)] += 1
+
+
+def latest_trained_run(flow_name: str):
+    """
+    Most recent run of a flow whose train_model step succeeded
+
+    :param flow_name: name of the Metaflow flow
+    :return: Metaflow Run
+    """
+    from metaflow import Flow
+
+    for run in Flow(flow_name):
+        try:
+            if run['train_model'].task.successful:
+                return run
+        except KeyError:
+            continue
+    raise ValueError('No run of {} with a trained model'.format(flow_name))
+
+
+async def _read_http_message(reader: asyncio.StreamReader):
+    """
+    Read a HTTP/1.1 request or response: first line, headers and body (Content-Length only)
+
+    :return: (first line, headers dict, body), or None if the connection was closed
+    """
+    first_line = await reader.readline()
+    if not first_line:
+        return None
+    headers = dict()
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return first_line.decode('latin-1').strip(), headers, body
+
+
+async def serve(predict_fn,
+                host: str = '127.0.0.1',
+                port: int = 8080,
+                n_workers: int = 1,
+                metrics_fn=None):
+    """
+    Minimal HTTP/1.1 (keep-alive) front end exposing GET /predict?session=... as the API Gateway does,
+    and GET /metrics if a metrics function is given
+
+    :param predict_fn: Lambda handler function, called with an API Gateway-like event
+    :param host: host to bind
+    :param port: port to bind
+    :param n_workers: number of handler calls in flight; with a single worker model calls are serialized,
+        with micro-batching it should exceed the batch size so that batches can fill up
+    :param metrics_fn: function returning a dict of serving metrics
+    :return:
+    """
+    loop = asyncio.get_running_loop()
+    # the event loop only does I/O, handler calls run in the executor
+    executor = ThreadPoolExecutor(max_workers=n_workers)
+
+    async def handle_connection(reader, writer):
+        while True:
+            message = await _read_http_message(reader)
+            if message is None:
+                break
+            request_line, headers, _ = message
+            url = urlsplit(request_line.split(' ')[1])
+            if url.path == '/predict':
+                event = {'queryStringParameters': {k: v[0] for k, v in parse_qs(url.query).items()}}
+                response = await loop.run_in_executor(executor, predict_fn, event, None)
+            elif url.path == '/metrics' and metrics_fn is not None:
+                response = {'statusCode': 200, 'headers': {}, 'body': json.dumps(metrics_fn())}
+            else:
+                response = {'statusCode': 404, 'headers': {}, 'body': json.dumps({'error': 'not found'})}
+            body = response['body'].encode('utf-8')
+            response_headers = dict(response['headers'],
+                                    **{'Content-Type': 'application/json', 'Content-Length': str(len(body))})
+            writer.write('HTTP/1.1 {} {}\r\n'.format(response['statusCode'],
+                                                    HTTP_REASONS.get(response['statusCode'], '')).encode('latin-1'))
+            writer.write(''.join('{}: {}\r\n'.format(k, v) for k, v in response_headers.items()).encode('latin-1'))
+            writer.write(b'\r\n' + body)
+            await writer.drain()
+            if headers.get('connection', '').lower() == 'close':
+                break
+        writer.close()
+
+    server = await asyncio.start_server(handle_connection, host, port)
+    print('Serving on http://{}:{}/predict'.format(host, port))
+    async with server:
+        await server.serve_forever()
+
+
+async def load_test(sessions: list,
+                    host: str = '127.0.0.1',
+                    port: int = 8080,
+                    n_requests: int = 2000,
+                    concurrency: int = 16):
+    """
+    Closed-loop load test: `concurrency` keep-alive clients send GET /predict requests back to back
+
+    :param sessions: list of sessions (list of tokens) to sample requests from
+    :param host: server host
+    :param port: server port
+    :param n_requests: total number of requests
+    :param concurrency: number of concurrent clients
+    :return: dict with p50 / p99 latency (ms) and throughput (requests/s)
+    """
+    latencies = []
+    n_sent = 0
+
+    async def client():
+        nonlocal n_sent
+        reader, writer = await asyncio.open_connection(host, port)
+        while n_sent < n_requests:
+            n_sent += 1
+            query = urlencode({'session': ','.join(random.choice(sessions))})
+            start = time.perf_counter()
+            writer.write('GET /predict?{} HTTP/1.1\r\nHost: {}\r\n\r\n'.format(query, host).encode('latin-1'))
+            await writer.drain()
+            status_line, _, _ = await _read_http_message(reader)
+            latencies.append(time.perf_counter() - start)
+            assert ' 200 ' in status_line, status_line
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    stats = {
+        'p50_ms': 1000 * float(np.percentile(latencies, 50)),
+        'p99_ms': 1000 * float(np.percentile(latencies, 99)),
+        'throughput': len(latencies) / elapsed
+    }
+    print('{} requests, concurrency {}: p50 {:.2f}ms, p99 {:.2f}ms, {:.1f} req/s'.format(
+        len(latencies), concurrency, stats['p50_ms'], stats['p99_ms'], stats['throughput']))
+
+    # server-side batching metrics, if exposed
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write('GET /metrics HTTP/1.1\r\nHost: {}\r\nConnection: close\r\n\r\n'.format(host).encode('latin-1'))
+    await writer.drain()
+    status_line, _, body = await _read_http_message(reader)
+    writer.close()
+    if ' 200 ' in status_line:
+        stats['server'] = json.loads(body)
+        print('Server metrics: {}'.format(stats['server']))
+
+    return stats
@@ -2,29 +2,42 @@ import os
 import json
 import time
 import boto3
-from typing import Dict, Any, Union, IO
+import heapq
+from typing import Dict, Any, Union, IO, List
 import random
+from vocabulary import load_vocabulary
 
 # grab environment variables
 SAGEMAKER_ENDPOINT_NAME = os.getenv('SAGEMAKER_ENDPOINT_NAME')
 TOKEN_MAPPING_BASENAME = os.getenv('TOKEN_MAPPING_BASENAME','token-mapping')
-TOKEN_MAPPING_FNAME = "{}-{}.json".format(TOKEN_MAPPING_BASENAME, SAGEMAKER_ENDPOINT_NAME)
+# compact binary mapping if packaged, legacy JSON otherwise
+TOKEN_MAPPING_FNAME = "{}-{}.vocab".format(TOKEN_MAPPING_BASENAME, SAGEMAKER_ENDPOINT_NAME)
+if not os.path.exists(TOKEN_MAPPING_FNAME):
+    TOKEN_MAPPING_FNAME = "{}-{}.json".format(TOKEN_MAPPING_BASENAME, SAGEMAKER_ENDPOINT_NAME)
+# 'sagemaker' calls the endpoint, 'local' runs the model in this process (see local_server.py)
+SERVING_MODE = os.getenv('SERVING_MODE', 'sagemaker')
 # print to AWS for debug!
 print(SAGEMAKER_ENDPOINT_NAME)
 print(TOKEN_MAPPING_FNAME)
 
 # instantiate AWS client for invoking sagemaker endpoint
-runtime = boto3.client('sagemaker-runtime')
+runtime = boto3.client('sagemaker-runtime') if SERVING_MODE == 'sagemaker' else None
+# in-process endpoint, set by local_server.py in local serving mode
+local_endpoint = None
 
-# load token mapping
-with open(TOKEN_MAPPING_FNAME) as f:
-    token_mapping = json.load(f)
+# token mapping, loaded on first request
+vocabulary = None
+# number of recommended skus
+N_PREDICTIONS = 10
 
-token2id = token_mapping['token2id']
-id2token = token_mapping['id2token']
-VOCAB_SIZE = len(token2id)
 
-assert VOCAB_SIZE > 0
+def get_vocabulary():
+    global vocabulary
+    if vocabulary is None:
+        vocabulary = load_vocabulary(TOKEN_MAPPING_FNAME)
+        assert len(vocabulary) > 0
+    return vocabulary
+
 
 def wrap_response(status_code: int,
                   body: Dict[Any, Any]) -> Dict[str, Any]:
@@ -57,18 +70,30 @@ def get_response_from_sagemaker(model_input: str,
     :param content_type: content format, default to application/json
     :return:
     """
-    # get raw response from sagemaker
     print(model_input)
+    # local serving: same request, no HTTP hop
+    if local_endpoint is not None:
+        return local_endpoint.invoke(model_input, content_type)
+    # get raw response from sagemaker
     response = runtime.invoke_endpoint(EndpointName=endpoint_name,
                                        ContentType=content_type,
                                        Body=model_input)
     # return the response body, properly decoded
     return json.loads(response['Body'].read().decode())
 
-def argsort(seq):
-    #http://stackoverflow.com/questions/3382352/equivalent-of-numpy-argsort-in-basic-python/3382369#3382369
-    #by unutbu
-    return sorted(range(len(seq)), key=seq.__getitem__)
+def top_ids(prediction: Union[Dict[str, List], List[float]], k: int) -> List[int]:
+    """
+    Ids of the k best items from the endpoint prediction, best first.
+
+    :param prediction: either the compact top-k payload ({'ids': [...], 'scores': [...]}, already sorted)
+        or a score for every item id
+    :param k: number of ids to return
+    :return: list of item ids
+    """
+    if isinstance(prediction, dict):
+        return prediction['ids'][:k]
+    # full-vocabulary scores: partial selection, no need to sort the whole catalog
+    return heapq.nlargest(k, range(len(prediction)), key=prediction.__getitem__)
 
 
 def predict(event: Dict[str, Any],
@@ -90,12 +115,13 @@ def predict(event: Dict[str, Any],
 
     print(session)
 
+    vocabulary = get_vocabulary()
     # get UNK index if exist else random select from vocab
-    UNK = token2id.get('[UNK]', random.randint(0,VOCAB_SIZE))
+    UNK = vocabulary.token_to_id('[UNK]', random.randint(0,len(vocabulary)))
     # get mask index if exist else None, used by ProdB
-    MASK = token2id.get('mask', None)
+    MASK = vocabulary.token_to_id('mask', None)
     # convert session sku to ids
-    session_indices = [token2id.get(_, UNK) for _ in session]
+    session_indices = [vocabulary.token_to_id(_, UNK) for _ in session]
     input_payload = {'instances': [session_indices], 'mask': MASK}
 
     print(input_payload)
@@ -105,12 +131,12 @@ def predict(event: Dict[str, Any],
     print(result)
     if result:
         response = result['predictions'][0]
-        sorted_indices = argsort(response)
-        sku_predictions = [token_mapping['id2token'].get(str(_),'UNK') for _ in sorted_indices]
-        print(sku_predictions[:10])
+        best_indices = top_ids(response, N_PREDICTIONS)
+        sku_predictions = [vocabulary.id_to_token(_,'UNK') for _ in best_indices]
+        print(sku_predictions)
 
         return wrap_response(200, {
-            "prediction":sku_predictions[:10],
+            "prediction":sku_predictions,
             "time": time.time() - start,
             "endpoint": SAGEMAKER_ENDPOINT_NAME
         })
@@ -0,0 +1,284 @@
+"""
+
+Local serving: load the model trained by RecFlow in-process, behind the same Lambda handler and the same
+SageMaker input/output handlers, with the shared HTTP front end and load tester of local_flow/local_serving.py.
+
+Usage (from the serverless folder):
+    python local_server.py serve [--run-id RUN_ID] [--port 8080]
+    python local_server.py load_test --token-mapping token-mapping-local-<RUN_ID>.vocab [--requests 2000]
+
+"""
+import os
+import io
+import sys
+import json
+import random
+import asyncio
+import argparse
+import importlib.util
+import numpy as np
+
+SERVERLESS_PATH = os.path.dirname(os.path.abspath(__file__))
+SRC_PATH = os.path.join(SERVERLESS_PATH, '..', 'src')
+sys.path.append(SRC_PATH)
+# shared local serving module, in local_flow
+sys.path.append(os.path.join(SERVERLESS_PATH, '..', '..'))
+
+from local_serving import MicroBatcher, latest_trained_run, serve, load_test
+
+
+class _Context:
+    """
+    Minimal stand-in for the SageMaker TF Serving context passed to the handlers
+    """
+    accept_header = 'application/json'
+
+
+class _Response:
+    """
+    Minimal stand-in for the TF Serving response passed to output_handler
+    """
+    def __init__(self, payload: dict):
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+def load_inference_module(model_choice: str):
+    """
+    Load the SageMaker entry point (input_handler / output_handler) used for a model
+
+    :param model_choice: KNN or PRODB
+    :return: inference module
+    """
+    path = os.path.join(SRC_PATH, '{}_sm_inference'.format(model_choice.lower()), 'inference.py')
+    spec = importlib.util.spec_from_file_location('{}_inference'.format(model_choice.lower()), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class LocalEndpoint:
+    """
+    In-process replacement for the SageMaker endpoint: requests go through the same input_handler,
+    model and output_handler as in the TF Serving container, without the HTTP hop.
+
+    Example:
+        >>> endpoint = LocalEndpoint.from_flow(run_id='1625000000000000')
+        >>> endpoint.invoke(json.dumps({'instances': [[10, 124, 12]], 'mask': None}))
+    """
+    def __init__(self, model, inference_module, token_mapping: dict, name: str):
+        # Keras model, or NumPy scoring function for kNN models
+        self.model = model
+        self.inference = inference_module
+        # hash-keyed token mapping, as used by the Lambda
+        self.token_mapping = token_mapping
+        self.name = name
+        # set by enable_batching
+        self.batcher = None
+        self.input_dtype = model.inputs[0].dtype.as_numpy_dtype if hasattr(model, 'inputs') else np.int64
+
+    @classmethod
+    def from_flow(cls, run_id: str = None, top_k: int = None):
+        """
+        Build the endpoint from the artifacts of a RecFlow run
+
+        :param run_id: Metaflow run id, defaults to the latest run with a trained model
+        :param top_k: if set, serve only the best k items, as deploy_tf_model does; kNN models trained
+            with an IVF index then take their top-k from the index
+        :return: LocalEndpoint
+        """
+        import pandas as pd
+        from metaflow import Run
+        from tensorflow.keras.models import model_from_json
+        from deploy_model import lambda_token_mapping, top_k_model
+        from ann_index import IVFIndex
+        from embedding_store import fetch_embedding_store, load_embedding_store, load_neighbour_table, knn_scorer
+
+        run = Run('RecFlow/{}'.format(run_id)) if run_id else latest_trained_run('RecFlow')
+        print('Loading model from {}'.format(run.pathspec))
+        data = run['train_model'].task.data
+
+        neighbours = None
+        if data.model['weights'] is None:
+            # kNN: score on the memory-mapped embeddings, no Keras model to rebuild
+            store_path = fetch_embedding_store(data.embedding_paths, os.path.join(SERVERLESS_PATH, 'embedding_store'))
+            embeddings, _ = load_embedding_store(store_path)
+            # IVF index (ANN_LISTS > 0), memory-mapped from the store as well
+            ann_index = IVFIndex.load(store_path, embeddings)
+            neighbours = load_neighbour_table(store_path)
+            if top_k and ann_index is not None:
+                model = ann_scorer(ann_index, top_k)
+            else:
+                model = knn_scorer(embeddings)
+                if top_k:
+                    model = top_k_scorer(model, top_k)
+        else:
+            model = model_from_json(data.model['model'], custom_objects=data.model['custom_objects'])
+            model.set_weights(data.model['weights'])
+            if top_k:
+                model = top_k_model(model, top_k)
+
+        inference_module = load_inference_module(data.model_choice)
+        # kNN neighbour table, memory-mapped from the store instead of the model directory
+        if neighbours is not None:
+            inference_module.neighbours = neighbours
+
+        sku_vocabulary = pd.read_parquet(data.vocabulary_paths['product_sku_hash'])['product_sku_hash'].to_numpy()
+        return cls(model=model,
+                   inference_module=inference_module,
+                   token_mapping=lambda_token_mapping(data.token_mapping, sku_vocabulary),
+                   name='local-{}'.format(run.id))
+
+    def enable_batching(self, max_batch_size: int = 32, max_wait_ms: float = 2.0):
+        """
+        Route model calls through a MicroBatcher, so that concurrent requests share a forward pass
+
+        :param max_batch_size: maximum number of sessions per forward pass
+        :param max_wait_ms: maximum time a request waits for the batch to fill up
+        :return: the MicroBatcher
+        """
+        self.batcher = MicroBatcher(batch_fn=self.predict, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+        return self.batcher
+
+    def invoke(self, model_input: str, content_type: str = 'application/json'):
+        """
+        Same contract as invoking the SageMaker endpoint: JSON request in, decoded JSON response out
+
+        :param model_input: JSON dump of model input params
+        :param content_type: content format, only application/json is supported
+        :return: response dict, with 'predictions'
+        """
+        assert content_type == 'application/json'
+        context = _Context()
+        # short sessions may be answered without the model (kNN neighbour table)
+        if hasattr(self.inference, 'short_session_response'):
+            response = self.inference.short_session_response(model_input, context)
+            if response is not None:
+                return json.loads(response[0])
+        payload = self.inference.input_handler(io.BytesIO(model_input.encode('utf-8')), context)
+        instances = np.array(json.loads(payload)['instances'], dtype=self.input_dtype)
+        predictions = self.batcher.predict(list(instances)) if self.batcher else self.predict(instances)
+        body, _ = self.inference.output_handler(_Response({'predictions': predictions}), context)
+        return json.loads(body)
+
+    def predict(self, instances: np.ndarray):
+        """
+        Run the model and format the outputs as TF Serving does (row format)
+
+        :param instances: model inputs
+        :return: list of predictions, one per instance
+        """
+        outputs = self.model(instances)
+        if isinstance(outputs, list):
+            # already one prediction per instance
+            return outputs
+        if isinstance(outputs, dict):
+            outputs = {name: np.asarray(value).tolist() for name, value in outputs.items()}
+            return [dict(zip(outputs.keys(), row)) for row in zip(*outputs.values())]
+        return np.asarray(outputs).tolist()
+
+
+def top_k_scorer(scorer, k: int):
+    """
+    NumPy counterpart of deploy_model.top_k_model: ids and scores of the k best items, best first
+
+    :param scorer: function mapping a batch of inputs to (batch, vocab_size) scores
+    :param k: number of items to return
+    :return: function mapping a batch of inputs to a dict with 'ids' and 'scores'
+    """
+    def score(instances):
+        scores = scorer(instances)
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top = np.take_along_axis(top, np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1), axis=1)
+        return {'ids': top, 'scores': np.take_along_axis(scores, top, axis=1)}
+
+    return score
+
+
+def ann_scorer(ann_index, k: int):
+    """
+    Same output as top_k_scorer over the kNN scores, from an IVF index: only the probed lists are scored. If the
+    probed lists hold fewer than k items, the padding (-1 ids, -inf scores, which are not valid JSON) is dropped
+
+    :param ann_index: IVFIndex over the model embeddings, as trained by train_prod2vec_model
+    :param k: number of items to return
+    :return: function mapping a batch of padded sessions to a list of dicts with 'ids' and 'scores', one per session
+    """
+    def score(instances):
+        ids, scores = ann_index.search_sessions(instances, k=k)
+        found = ids >= 0
+        return [{'ids': row_ids[row_found].tolist(), 'scores': row_scores[row_found].tolist()}
+                for row_ids, row_scores, row_found in zip(ids, scores, found)]
+
+    return score
+
+
+def build_handler(endpoint: LocalEndpoint):
+    """
+    Import the Lambda handler in local serving mode, wired to an in-process endpoint
+
+    :param endpoint: LocalEndpoint
+    :return: the handler module
+    """
+    # the handler reads its token mapping from disk at import time, as in the Lambda package
+    from deploy_model import save_compact_vocabulary
+
+    token_mapping_fname = os.path.join(SERVERLESS_PATH, 'token-mapping-{}.vocab'.format(endpoint.name))
+    save_compact_vocabulary(token_mapping_fname, endpoint.token_mapping['id2token'])
+    print('Token mapping saved at: {}'.format(token_mapping_fname))
+
+    os.environ['SAGEMAKER_ENDPOINT_NAME'] = endpoint.name
+    os.environ['SERVING_MODE'] = 'local'
+    os.chdir(SERVERLESS_PATH)
+    import handler
+    handler.local_endpoint = endpoint
+    return handler
+
+
+def random_sessions(token_mapping_fname: str, n_sessions: int = 1000, max_len: int = 10, seed: int = 42):
+    """
+    Random browsing sessions over the skus known to the model, to be used as load test requests
+
+    :param token_mapping_fname: token mapping file, as saved by the deploy step or by `serve`
+    :param n_sessions: number of sessions
+    :param max_len: maximum session length
+    :param seed: random seed
+    :return: list of sessions (list of sku hashes)
+    """
+    from vocabulary import load_vocabulary
+
+    skus = [token for token in load_vocabulary(token_mapping_fname).tokens() if token not in ('[UNK]', 'mask')]
+    rng = random.Random(seed)
+    return [rng.choices(skus, k=rng.randint(1, max_len)) for _ in range(n_sessions)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['serve', 'load_test'])
+    parser.add_argument('--run-id', default=None)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--token-mapping', default=None)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    # micro-batching window, a max batch size of 1 disables it
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=2.0)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        endpoint = LocalEndpoint.from_flow(run_id=args.run_id, top_k=int(os.getenv('SAGEMAKER_TOP_K') or 0))
+        batcher = endpoint.enable_batching(args.max_batch_size, args.max_wait_ms) if args.max_batch_size > 1 else None
+        asyncio.run(serve(build_handler(endpoint).predict,
+                          host=args.host,
+                          port=args.port,
+                          n_workers=2 * args.max_batch_size if batcher else 1,
+                          metrics_fn=batcher.metrics if batcher else None))
+    else:
+        asyncio.run(load_test(random_sessions(args.token_mapping),
+                              host=args.host,
+                              port=args.port,
+                              n_requests=args.requests,
+                              concurrency=args.concurrency))
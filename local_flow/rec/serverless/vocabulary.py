@@ -0,0 +1,103 @@
+"""
+
+Token mappings for the recommendation Lambda, with the same lookups for two formats:
+
+- compact binary (.vocab): a fixed-width array of sorted tokens, the id of each sorted token and, for the reverse
+  lookup, the position of each id in the sorted tokens. The file is memory-mapped, so opening it is constant time
+  and a lookup only touches the pages of a binary search. Written by deploy_model.save_compact_vocabulary.
+- JSON (.json): the legacy {'token2id': {...}, 'id2token': {...}} file, parsed in full.
+
+Only the standard library is used, as the Lambda package has no dependencies.
+
+"""
+import json
+import mmap
+import struct
+
+MAGIC = b'RECVOCAB'
+# magic, token width (bytes), number of tokens, size of the id -> position table
+HEADER = struct.Struct('<8sIII')
+
+
+class CompactVocabulary:
+    """
+    Memory-mapped compact vocabulary.
+
+    Example:
+        >>> vocabulary = CompactVocabulary('token-mapping-my-endpoint.vocab')
+        >>> vocabulary.token_to_id('a1b2...', default=0)
+        >>> vocabulary.id_to_token(12, default='UNK')
+    """
+    def __init__(self, fname: str):
+        with open(fname, 'rb') as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.width, self.n_tokens, n_ids = HEADER.unpack_from(self._buffer, 0)
+        assert magic == MAGIC, 'Not a compact vocabulary: {}'.format(fname)
+        self._tokens_start = HEADER.size
+        ids_start = self._tokens_start + self.width * self.n_tokens
+        positions_start = ids_start + 4 * self.n_tokens
+        view = memoryview(self._buffer)
+        self._ids = view[ids_start:positions_start].cast('i')
+        self._positions = view[positions_start:positions_start + 4 * n_ids].cast('i')
+
+    def __len__(self):
+        return self.n_tokens
+
+    def _token_at(self, position: int):
+        start = self._tokens_start + position * self.width
+        return self._buffer[start:start + self.width]
+
+    def token_to_id(self, token: str, default=None):
+        key = token.encode('utf-8')
+        if len(key) > self.width:
+            return default
+        # tokens are NUL-padded to the same width, which keeps their byte order
+        key = key.ljust(self.width, b'\0')
+        low, high = 0, self.n_tokens
+        while low < high:
+            middle = (low + high) // 2
+            if self._token_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.n_tokens and self._token_at(low) == key:
+            return self._ids[low]
+        return default
+
+    def id_to_token(self, idx: int, default=None):
+        if not 0 <= idx < len(self._positions) or self._positions[idx] < 0:
+            return default
+        return self._token_at(self._positions[idx]).rstrip(b'\0').decode('utf-8')
+
+    def tokens(self):
+        return [self._token_at(position).rstrip(b'\0').decode('utf-8') for position in range(self.n_tokens)]
+
+
+class JsonVocabulary:
+    """
+    Legacy JSON token mapping, with the same interface as CompactVocabulary.
+    """
+    def __init__(self, fname: str):
+        with open(fname) as f:
+            token_mapping = json.load(f)
+        self._token2id = token_mapping['token2id']
+        self._id2token = token_mapping['id2token']
+
+    def __len__(self):
+        return len(self._token2id)
+
+    def token_to_id(self, token: str, default=None):
+        return self._token2id.get(token, default)
+
+    def id_to_token(self, idx: int, default=None):
+        return self._id2token.get(str(idx), default)
+
+    def tokens(self):
+        return list(self._token2id.keys())
+
+
+def load_vocabulary(fname: str):
+    """
+    Open a token mapping file, compact (.vocab) or JSON (.json)
+    """
+    return CompactVocabulary(fname) if fname.endswith('.vocab') else JsonVocabulary(fname)
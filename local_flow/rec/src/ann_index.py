@@ -0,0 +1,189 @@
+"""
+
+Approximate nearest neighbour (IVF) index over product embeddings, in pure NumPy
+
+"""
+import numpy as np
+from embedding_store import save_arrays, load_arrays
+
+# arrays of a fitted index, saved as ann_<name>.npy in the embedding store
+INDEX_ARRAYS = ('centroids', 'list_offsets', 'ids', 'id_positions', 'n_probe')
+
+
+class IVFIndex:
+    """
+    Inverted file index for maximum inner product search over (normalized) product vectors.
+
+    Vectors are clustered with spherical k-means into `n_lists` lists; a query only scores the vectors
+    in the `n_probe` lists whose centroids are closest to it. The index does not copy the vectors: it keeps
+    the ids of each list, in list order, and reads their rows from the (memory-mapped) embeddings. Its arrays
+    are saved next to the embedding store with `save`, and memory-mapped by `load`.
+
+    Attributes:
+        n_lists (`int`): number of inverted lists (k-means clusters).
+        n_probe (`int`): default number of lists scanned per query.
+        centroids (`np.ndarray`): (n_lists, dim) normalized centroids.
+        list_offsets (`np.ndarray`): list i holds rows list_offsets[i]:list_offsets[i+1].
+        ids (`np.ndarray`): id of each indexed vector, in list order.
+        id_positions (`np.ndarray`): position of each id in `ids`, -1 if not indexed.
+        embeddings (`np.ndarray`): vectors indexed by id, not saved with the index.
+
+    Example:
+        >>> index = IVFIndex(n_lists=256, n_probe=8).fit(embeddings, ids=np.arange(1, len(embeddings)))
+        >>> top_ids, top_scores = index.search(query_vectors, k=10)
+        >>> top_ids, top_scores = index.search_sessions(padded_sessions, k=10)
+        >>> index.save('embedding_store')
+        >>> index = IVFIndex.load('embedding_store', embeddings)
+    """
+    def __init__(self, n_lists: int = 256, n_probe: int = 8, n_iter: int = 10, seed: int = 42):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.seed = seed
+        self.centroids = None
+        self.list_offsets = None
+        self.ids = None
+        self.id_positions = None
+        self.embeddings = None
+
+    def fit(self, embeddings: np.ndarray, ids: np.ndarray = None, max_train_points: int = 256):
+        """
+        Train centroids with spherical k-means and fill the inverted lists
+
+        :param embeddings: (n, dim) vectors indexed by id, e.g. the embedding store (row 0 being padding)
+        :param ids: ids of the vectors to index, defaults to all rows
+        :param max_train_points: k-means is trained on at most max_train_points * n_lists vectors
+        :return: the fitted index
+        """
+        self.embeddings = embeddings
+        ids = np.arange(len(embeddings)) if ids is None else np.asarray(ids)
+        vectors = np.asarray(embeddings[ids], dtype=np.float32)
+        rng = np.random.default_rng(self.seed)
+        self.n_lists = min(self.n_lists, len(vectors))
+
+        # train on a sample, as centroids converge long before seeing the full catalog
+        n_train = min(len(vectors), max_train_points * self.n_lists)
+        train = vectors[rng.choice(len(vectors), size=n_train, replace=False)]
+        centroids = _normalize(train[rng.choice(n_train, size=self.n_lists, replace=False)])
+        for _ in range(self.n_iter):
+            assignment = self._assign(train, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, train)
+            counts = np.bincount(assignment, minlength=self.n_lists)
+            # re-seed empty lists with random training points
+            empty = counts == 0
+            sums[empty] = train[rng.choice(n_train, size=int(empty.sum()))]
+            centroids = _normalize(sums)
+        self.centroids = centroids
+
+        # store vectors grouped by list
+        assignment = self._assign(vectors, centroids)
+        order = np.argsort(assignment, kind='stable')
+        self.list_offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=self.n_lists))))
+        self.ids = ids[order]
+        self.id_positions = np.full(int(ids.max()) + 1, -1, dtype=np.int64)
+        self.id_positions[self.ids] = np.arange(len(self.ids))
+
+        return self
+
+    def save(self, folder: str):
+        """
+        Write the index arrays as .npy files in the embedding store folder; the vectors are not copied
+
+        :param folder: embedding store folder
+        :return: dict of file name to local path
+        """
+        arrays = {name: getattr(self, name) for name in INDEX_ARRAYS if name != 'n_probe'}
+        arrays['n_probe'] = np.array(self.n_probe)
+        return save_arrays(folder, {'ann_{}'.format(name): array for name, array in arrays.items()})
+
+    @classmethod
+    def load(cls, folder: str, embeddings: np.ndarray, mmap_mode: str = 'r'):
+        """
+        Memory-map an index saved in the embedding store
+
+        :param folder: embedding store folder
+        :param embeddings: the vectors the index was fitted on, indexed by id
+        :param mmap_mode: numpy memory-map mode, None to load in memory
+        :return: IVFIndex, or None if the store has no index
+        """
+        arrays = load_arrays(folder, ['ann_{}'.format(name) for name in INDEX_ARRAYS], mmap_mode=mmap_mode)
+        if arrays is None:
+            return None
+        index = cls(n_lists=len(arrays['ann_centroids']), n_probe=int(arrays['ann_n_probe']))
+        for name in INDEX_ARRAYS:
+            if name != 'n_probe':
+                setattr(index, name, arrays['ann_{}'.format(name)])
+        index.embeddings = embeddings
+        return index
+
+    def search(self, queries: np.ndarray, k: int = 10, n_probe: int = None):
+        """
+        Approximate top-k by inner product
+
+        :param queries: (n, dim) query vectors
+        :param k: number of results per query
+        :param n_probe: number of lists scanned per query, defaults to the index setting
+        :return: (n, k) ids and (n, k) scores, best first; padded with -1 / -inf if fewer candidates
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        top_ids = np.full((len(queries), k), -1, dtype=self.ids.dtype)
+        top_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+
+        # closest lists for every query at once
+        coarse = queries @ self.centroids.T
+        probes = np.argpartition(-coarse, n_probe - 1, axis=1)[:, :n_probe]
+        starts = self.list_offsets[probes]
+        ends = self.list_offsets[probes + 1]
+
+        for q_idx, query in enumerate(queries):
+            rows = np.concatenate([np.arange(s, e) for s, e in zip(starts[q_idx], ends[q_idx])])
+            scores = np.asarray(self.embeddings[self.ids[rows]], dtype=np.float32) @ query
+            n_results = min(k, len(rows))
+            if n_results == 0:
+                continue
+            best = np.argpartition(-scores, n_results - 1)[:n_results]
+            best = best[np.argsort(-scores[best])]
+            top_ids[q_idx, :n_results] = self.ids[rows[best]]
+            top_scores[q_idx, :n_results] = scores[best]
+
+        return top_ids, top_scores
+
+    def search_sessions(self, sessions: np.ndarray, k: int = 10, n_probe: int = None):
+        """
+        Top-k for padded sessions of ids, the query being the average of the session vectors (as in
+        the kNN keras model); padding (0) and ids not in the index are ignored
+
+        :param sessions: (n, max_len) padded sessions of ids
+        :param k: number of results per query
+        :param n_probe: number of lists scanned per query, defaults to the index setting
+        :return: (n, k) ids and (n, k) scores, best first
+        """
+        return self.search(self.session_vectors(sessions), k=k, n_probe=n_probe)
+
+    def session_vectors(self, sessions: np.ndarray):
+        """
+        Average vector of each padded session of ids
+
+        :param sessions: (n, max_len) padded sessions of ids
+        :return: (n, dim) query vectors
+        """
+        sessions = np.asarray(sessions)
+        in_range = (sessions >= 0) & (sessions < len(self.id_positions))
+        positions = np.where(in_range, self.id_positions[np.where(in_range, sessions, 0)], -1)
+        valid = (sessions > 0) & (positions >= 0)
+        vectors = np.asarray(self.embeddings[np.where(valid, sessions, 0)], dtype=np.float32) * valid[..., None]
+        return vectors.sum(axis=1) / np.maximum(valid.sum(axis=1, keepdims=True), 1)
+
+    def _assign(self, vectors, centroids, chunk_size=65536):
+        """
+        Closest centroid of each vector, computed in chunks to bound memory
+        """
+        return np.concatenate([np.argmax(vectors[start:start + chunk_size] @ centroids.T, axis=1)
+                               for start in range(0, len(vectors), chunk_size)])
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
@@ -0,0 +1,225 @@
+"""
+
+Micro-benchmarks for the recommendation flow, run on synthetic browsing data
+
+Usage: python src/benchmarks.py <benchmark_name> [--rows N]
+
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+
+
+def make_browsing_frame(n_rows: int,
+                        n_skus: int = 50000,
+                        mean_session_len: int = 8,
+                        seed: int = 42):
+    """
+    Build a synthetic, processed and encoded browsing_train dataframe (sorted by session and timestamp)
+
+    :param n_rows: number of rows
+    :param n_skus: number of distinct skus
+    :param mean_session_len: average number of events per session
+    :param seed: random seed
+    :return: dataframe with session_code, sku_code, server_timestamp_epoch_ms
+    """
+    rng = np.random.default_rng(seed)
+    # session lengths are geometric, so that some sessions fall outside the 3..20 range
+    lengths = rng.geometric(1.0 / mean_session_len, size=n_rows // 2 + 1)
+    session_idx = np.repeat(np.arange(len(lengths)), lengths)[:n_rows]
+    session_start = rng.integers(1_550_000_000_000, 1_560_000_000_000, size=len(lengths))
+    timestamps = session_start[session_idx] + np.arange(n_rows) - np.searchsorted(session_idx, session_idx)
+    skus = rng.integers(0, n_skus, size=n_rows)
+
+    return pd.DataFrame({'session_code': session_idx.astype(np.int32),
+                         'sku_code': skus.astype(np.int32),
+                         'server_timestamp_epoch_ms': timestamps})
+
+
+def timed(func, *args, **kwargs):
+    """
+    Run a function once and return its output along with the elapsed wall time in seconds
+    """
+    start = time.perf_counter()
+    out = func(*args, **kwargs)
+    return out, time.perf_counter() - start
+
+
+def benchmark_sessionizer(n_rows: int):
+    """
+    Compare the columnar sessionizer against the iterrows loop on the same data
+    """
+    from prepare_dataset import sessionize, sessionize_iterrows, session_list
+
+    df = make_browsing_frame(n_rows)
+    loop_sessions, loop_time = timed(sessionize_iterrows, df)
+    columnar_sessions, columnar_time = timed(sessionize,
+                                             session_codes=df['session_code'].to_numpy(),
+                                             sku_codes=df['sku_code'].to_numpy(),
+                                             timestamps=df['server_timestamp_epoch_ms'].to_numpy())
+    columnar_sessions = session_list(columnar_sessions)
+    assert columnar_sessions == loop_sessions
+
+    print('Sessionizer on {} rows ({} sessions)'.format(n_rows, len(columnar_sessions)))
+    print('iterrows : {:.3f}s'.format(loop_time))
+    print('columnar : {:.3f}s ({:.1f}x)'.format(columnar_time, loop_time / columnar_time))
+
+
+def make_embeddings(n_items: int,
+                    dims: int = 48,
+                    n_clusters: int = 200,
+                    seed: int = 42):
+    """
+    Build synthetic, clustered and normalized product embeddings, a rough stand-in for prod2vec vectors
+
+    :param n_items: number of products
+    :param dims: embedding size
+    :param n_clusters: number of latent product categories
+    :param seed: random seed
+    :return: (n_items, dims) float32 array of unit vectors
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dims))
+    vectors = centers[rng.integers(0, n_clusters, size=n_items)] + 0.5 * rng.normal(size=(n_items, dims))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.astype(np.float32)
+
+
+def benchmark_ann(n_rows: int, k: int = 10, n_queries: int = 1000):
+    """
+    Recall@k and per-query latency of the IVF index against exact (full catalog) scoring;
+    n_rows is the catalog size
+    """
+    from ann_index import IVFIndex
+
+    vectors = make_embeddings(n_rows)
+    rng = np.random.default_rng(0)
+    # queries are averages of short sessions, as in the kNN model
+    sessions = rng.integers(0, n_rows, size=(n_queries, 3))
+    queries = vectors[sessions].mean(axis=1)
+
+    def exact_search(q):
+        scores = q @ vectors.T
+        top_k = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        return np.take_along_axis(top_k, np.argsort(-np.take_along_axis(scores, top_k, axis=1), axis=1), axis=1)
+
+    exact, exact_time = timed(exact_search, queries)
+    n_lists = int(max(1, np.sqrt(n_rows)))
+    index, build_time = timed(IVFIndex(n_lists=n_lists).fit, vectors)
+
+    print('IVF on {} items, {} lists (built in {:.2f}s), {} queries'.format(n_rows, n_lists, build_time, n_queries))
+    print('exact      : {:.3f} ms/query, recall@{} 1.000'.format(1000 * exact_time / n_queries, k))
+    for n_probe in (1, 2, 4, 8, 16, 32):
+        if n_probe > n_lists:
+            break
+        (approx, _), approx_time = timed(index.search, queries, k=k, n_probe=n_probe)
+        recall = np.mean([len(np.intersect1d(a, e)) / k for a, e in zip(approx, exact)])
+        print('n_probe={:<3}: {:.3f} ms/query, recall@{} {:.3f}'.format(n_probe,
+                                                                       1000 * approx_time / n_queries,
+                                                                       k,
+                                                                       recall))
+
+
+def benchmark_prodb_batching(n_rows: int, batch_sizes: tuple = (1, 32, 256)):
+    """
+    Throughput (sessions/s) of the batched ProdB inference graph against the previous single-session graph,
+    on an untrained ProdB model built from synthetic sessions; n_rows is the size of the browsing data
+    """
+    from prodb.prodb import ProdB
+    from prepare_dataset import sessionize, session_list
+    from prodb_sm_inference.inference import pad_sessions
+    from model import ProdBConfig, prodb_inference_model, prodb_single_session_model, prodb_token_mapping, codes_to_ids
+
+    df = make_browsing_frame(n_rows, n_skus=5000)
+    sessions = session_list(sessionize(session_codes=df['session_code'].to_numpy(),
+                                       sku_codes=df['sku_code'].to_numpy(),
+                                       timestamps=df['server_timestamp_epoch_ms'].to_numpy()))
+    config = ProdBConfig(VOCAB_SIZE=len(np.unique(df['sku_code'])))
+    prodb_model = ProdB([' '.join(map(str, _)) for _ in sessions], config)
+    batched_model = prodb_inference_model(prodb_model)
+    single_model = prodb_single_session_model(prodb_model)
+
+    # queries as in evaluation: session prefixes as model ids, plus mask, padded
+    token_mapping = prodb_token_mapping(prodb_model.id2token)
+    rng = np.random.default_rng(0)
+    queries = [codes_to_ids(np.array(s[:rng.integers(1, len(s))]), token_mapping['id2code']).tolist()
+               for s in sessions[:max(batch_sizes) * 4]]
+    queries = np.array(pad_sessions(queries, token_mapping['special_tokens']['mask']), dtype=np.int64)
+
+    single_scores, single_time = timed(lambda: np.vstack([np.asarray(single_model(q[None])) for q in queries]))
+    print('ProdB inference on {} sessions'.format(len(queries)))
+    print('single-session graph : {:.1f} sessions/s'.format(len(queries) / single_time))
+    for batch_size in batch_sizes:
+        batched_scores, batched_time = timed(lambda: np.vstack([np.asarray(batched_model(queries[i:i + batch_size]))
+                                                                for i in range(0, len(queries), batch_size)]))
+        assert np.allclose(batched_scores, single_scores, atol=1e-4)
+        print('batched graph, batch size {:<3}: {:.1f} sessions/s ({:.1f}x)'.format(batch_size,
+                                                                                     len(queries) / batched_time,
+                                                                                     single_time / batched_time))
+
+
+def benchmark_vocabulary(n_rows: int, n_lookups: int = 20):
+    """
+    Lambda cold start with the JSON token mapping against the compact binary vocabulary; each load runs in a
+    fresh interpreter and is timed up to the first lookups of a request; n_rows is the number of skus
+    """
+    from deploy_model import save_compact_vocabulary
+
+    serverless_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'serverless')
+    rng = np.random.default_rng(42)
+    tokens = [rng.bytes(32).hex() for _ in range(n_rows)]
+    id2token = dict(enumerate(tokens, start=1))
+    queries = [tokens[idx] for idx in rng.integers(0, n_rows, size=n_lookups)]
+
+    cold_start = '''
+import sys, json, time
+start = time.perf_counter()
+sys.path.append({serverless_path!r})
+from vocabulary import load_vocabulary
+vocabulary = load_vocabulary({fname!r})
+ids = [vocabulary.token_to_id(token, 0) for token in {queries!r}]
+assert [vocabulary.id_to_token(idx) for idx in ids] == {queries!r}
+seconds = time.perf_counter() - start
+# peak resident memory of this interpreter (Linux)
+with open('/proc/self/status') as f:
+    max_rss_kb = [int(line.split()[1]) for line in f if line.startswith('VmHWM')][0]
+print(json.dumps({{'seconds': seconds, 'max_rss_mb': max_rss_kb / 1024}}))
+'''
+    with tempfile.TemporaryDirectory() as folder:
+        json_fname = os.path.join(folder, 'token-mapping.json')
+        with open(json_fname, 'w') as f:
+            json.dump({'token2id': {token: idx for idx, token in id2token.items()}, 'id2token': id2token}, f)
+        compact_fname = os.path.join(folder, 'token-mapping.vocab')
+        save_compact_vocabulary(compact_fname, id2token)
+
+        print('Token mapping cold start with {} skus, {} lookups'.format(n_rows, n_lookups))
+        for name, fname in (('json', json_fname), ('compact', compact_fname)):
+            code = cold_start.format(serverless_path=serverless_path, fname=fname, queries=queries)
+            stats = json.loads(subprocess.run([sys.executable, '-c', code],
+                                              capture_output=True, check=True, text=True).stdout)
+            print('{:<8}: {:.2f} MB on disk, {:.1f} ms, max RSS {:.0f} MB'.format(name,
+                                                                            os.path.getsize(fname) / 2 ** 20,
+                                                                            1000 * stats['seconds'],
+                                                                            stats['max_rss_mb']))
+
+
+BENCHMARKS = {
+    'sessionizer': benchmark_sessionizer,
+    'ann': benchmark_ann,
+    'prodb_batching': benchmark_prodb_batching,
+    'vocabulary': benchmark_vocabulary,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('--rows', type=int, default=200000)
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args.rows)
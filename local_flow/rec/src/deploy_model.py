@@ -5,10 +5,12 @@ Deploy a tensorflow model onto SageMaker
 """
 import os
 import time
+import struct
 import shutil
 import tarfile
 import numpy as np
 
+import tensorflow as tf
 from tensorflow.keras import Model
 from tensorflow.keras.models import model_from_json
 
@@ -16,12 +18,13 @@ from sagemaker.tensorflow import TensorFlowModel
 
 from metaflow import S3
 
-def tf_model_to_tar(tf_model: Model, run_id: int, ):
+def tf_model_to_tar(tf_model: Model, run_id: int, neighbours: dict = None):
     """
     Saves tensorflow model as compressed file
 
     :param run_id: current Metaflow run id
     :param tf_model: tensorflow model
+    :param neighbours: optional kNN neighbour table, saved as neighbours.npz next to the model
     :return:
     """
 
@@ -33,26 +36,54 @@ def tf_model_to_tar(tf_model: Model, run_id: int, ):
     # save model as .tar.gz
     with tarfile.open(local_tar_name, mode="w:gz") as _tar:
         _tar.add(model_name, recursive=True)
+        if neighbours is not None:
+            # extracted to /opt/ml/model/neighbours.npz, where the kNN handler looks for it
+            neighbours_name = 'neighbours-{}.npz'.format(run_id)
+            np.savez(neighbours_name, **neighbours)
+            _tar.add(neighbours_name, arcname='neighbours.npz')
+            os.remove(neighbours_name)
     # remove local model
     shutil.rmtree(model_name.split('/')[0])
 
     return local_tar_name
 
 
+def top_k_model(tf_model: Model, k: int):
+    """
+    Wrap a scoring model so that it returns the ids and scores of the k best items only, instead of
+    a score for every item in the vocabulary
+
+    :param tf_model: tensorflow model returning (batch, vocab_size) scores
+    :param k: number of items to return
+    :return: tensorflow model with 'ids' and 'scores' outputs, best first
+    """
+    top_k = tf.math.top_k(tf_model.outputs[0], k=k)
+    model = Model(inputs=tf_model.inputs,
+                  outputs={'ids': top_k.indices, 'scores': top_k.values},
+                  name='{}-top-{}'.format(tf_model.name, k))
+    model.compile()
+    return model
+
+
 def deploy_tf_model(model_json: str,
                     model_weights: list,
                     custom_objects: dict,
                     sagemaker_entry_point_path: str,
                     token_mapping: dict,
                     s3_obj: S3,
-                    run_id: int):
+                    run_id: int,
+                    top_k: int = None,
+                    neighbours: dict = None):
 
     # load model from json and weights
     tf_model = model_from_json(model_json, custom_objects=custom_objects)
     tf_model.set_weights(model_weights)
+    # serve only the best k items, if required
+    if top_k:
+        tf_model = top_k_model(tf_model, top_k)
 
     # save model as .tar.gz onto S3 for SageMaker
-    local_tar_name = tf_model_to_tar(tf_model, run_id)
+    local_tar_name = tf_model_to_tar(tf_model, run_id, neighbours=neighbours)
 
     # save model to S3
     with open(local_tar_name, "rb") as in_file:
@@ -87,10 +118,50 @@ def deploy_tf_model(model_json: str,
 
     # prepare a test input and check response
     test_inp = {'instances': [[10,124,12,45,43]+[0]*15],
-                'mask' : token_mapping['token2id'].get('mask', None)}
+                'mask' : token_mapping['special_tokens'].get('mask', None)}
     result = predictor.predict(test_inp)
     assert result['predictions']
     print(result['predictions'])
 
     return model_s3_path, endpoint_name
 
+
+def lambda_token_mapping(token_mapping: dict, sku_vocabulary: np.ndarray):
+    """
+    Build the hash-keyed token mapping used by the Lambda from the array-based one
+
+    :param token_mapping: model token mapping, with 'id2code' and 'special_tokens'
+    :param sku_vocabulary: array of product_sku_hash, indexed by sku code
+    :return: dict with token2id and id2token
+    """
+    id2code = token_mapping['id2code']
+    sku_ids = np.flatnonzero(id2code >= 0)
+    id2token = dict(zip(sku_ids.tolist(), sku_vocabulary[id2code[sku_ids]].tolist()))
+    id2token.update({idx: token for token, idx in token_mapping['special_tokens'].items()})
+
+    return {
+        'token2id': {token: idx for idx, token in id2token.items()},
+        'id2token': id2token
+    }
+
+
+def save_compact_vocabulary(fname: str, id2token: dict):
+    """
+    Save the Lambda token mapping in the compact binary format read by serverless/vocabulary.py: header,
+    NUL-padded tokens in byte order, id of each sorted token, then position of each id in the sorted tokens
+
+    :param fname: output file name
+    :param id2token: model id to token mapping, as built by lambda_token_mapping
+    :return:
+    """
+    ids = np.fromiter(id2token.keys(), dtype=np.int32, count=len(id2token))
+    tokens = np.array([token.encode('utf-8') for token in id2token.values()])
+    order = np.argsort(tokens, kind='stable')
+    positions = np.full(int(ids.max()) + 1, -1, dtype=np.int32)
+    positions[ids[order]] = np.arange(len(order), dtype=np.int32)
+
+    with open(fname, 'wb') as f:
+        f.write(struct.pack('<8sIII', b'RECVOCAB', tokens.dtype.itemsize, len(tokens), len(positions)))
+        f.write(tokens[order].tobytes())
+        f.write(ids[order].astype('<i4').tobytes())
+        f.write(positions.astype('<i4').tobytes())
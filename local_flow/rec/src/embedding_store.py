@@ -0,0 +1,153 @@
+"""
+
+Embedding store for the kNN model: product vectors are written once as a .npy file (row = model id, row 0 being
+padding) next to the vocabulary (model id -> sku code), and memory-mapped when loaded, instead of travelling
+as pickled Keras weights. The other catalog-sized arrays of the model (IVF index, neighbour table) are saved in
+the same folder with save_arrays, so that Metaflow artifacts only hold file paths
+
+"""
+import os
+import shutil
+import numpy as np
+
+
+EMBEDDINGS_FILE = 'embeddings.npy'
+VOCABULARY_FILE = 'vocabulary.npy'
+# arrays of the kNN neighbour table (see build_neighbour_table), saved as neighbours_<name>.npy
+NEIGHBOUR_ARRAYS = ('ids', 'scores', 'max_session_len')
+
+
+def save_embedding_store(folder: str,
+                         embeddings: np.ndarray,
+                         id2code: np.ndarray,
+                         dtype: str = 'float32'):
+    """
+    Write embeddings and vocabulary as .npy files
+
+    :param folder: local folder, created if needed
+    :param embeddings: (vocab_size + 1, dims) embeddings, indexed by model id
+    :param id2code: model id to sku code array, -1 for non-sku ids
+    :param dtype: float32 or float16
+    :return: dict of file name to local path
+    """
+    os.makedirs(folder, exist_ok=True)
+    paths = {
+        EMBEDDINGS_FILE: os.path.join(folder, EMBEDDINGS_FILE),
+        VOCABULARY_FILE: os.path.join(folder, VOCABULARY_FILE)
+    }
+    np.save(paths[EMBEDDINGS_FILE], np.asarray(embeddings, dtype=dtype))
+    np.save(paths[VOCABULARY_FILE], np.asarray(id2code, dtype=np.int32))
+    print('Embedding store saved at: {}'.format(folder))
+    return paths
+
+
+def load_embedding_store(folder: str, mmap_mode: str = 'r'):
+    """
+    Memory-map embeddings and vocabulary: pages are only read from disk when rows are accessed
+
+    :param folder: local folder with the store files
+    :param mmap_mode: numpy memory-map mode, None to load in memory
+    :return: embeddings and id2code arrays
+    """
+    embeddings = np.load(os.path.join(folder, EMBEDDINGS_FILE), mmap_mode=mmap_mode)
+    id2code = np.load(os.path.join(folder, VOCABULARY_FILE), mmap_mode=mmap_mode)
+    return embeddings, id2code
+
+
+def save_arrays(folder: str, arrays: dict):
+    """
+    Write arrays as .npy files in the store folder, next to the embeddings
+
+    :param folder: local folder, created if needed
+    :param arrays: dict of name to array, saved as <name>.npy
+    :return: dict of file name to local path
+    """
+    os.makedirs(folder, exist_ok=True)
+    paths = dict()
+    for name, array in arrays.items():
+        paths['{}.npy'.format(name)] = os.path.join(folder, '{}.npy'.format(name))
+        np.save(paths['{}.npy'.format(name)], np.asarray(array))
+    return paths
+
+
+def load_arrays(folder: str, names: list, mmap_mode: str = 'r'):
+    """
+    Memory-map arrays saved with save_arrays
+
+    :param folder: local folder with the store files
+    :param names: names of the arrays
+    :param mmap_mode: numpy memory-map mode, None to load in memory
+    :return: dict of name to array, or None if the store does not have them
+    """
+    paths = {name: os.path.join(folder, '{}.npy'.format(name)) for name in names}
+    if not all(os.path.exists(path) for path in paths.values()):
+        return None
+    return {name: np.load(path, mmap_mode=mmap_mode) for name, path in paths.items()}
+
+
+def save_neighbour_table(folder: str, table: dict):
+    """
+    Write the kNN neighbour table in the store folder
+
+    :param folder: local folder, created if needed
+    :param table: neighbour table, as built by build_neighbour_table
+    :return: dict of file name to local path
+    """
+    return save_arrays(folder, {'neighbours_{}'.format(name): table[name] for name in NEIGHBOUR_ARRAYS})
+
+
+def load_neighbour_table(folder: str, mmap_mode: str = 'r'):
+    """
+    Memory-map the kNN neighbour table
+
+    :param folder: local folder with the store files
+    :param mmap_mode: numpy memory-map mode, None to load in memory
+    :return: neighbour table, with the keys of build_neighbour_table, or None if the store does not have one
+    """
+    arrays = load_arrays(folder, ['neighbours_{}'.format(name) for name in NEIGHBOUR_ARRAYS], mmap_mode=mmap_mode)
+    if arrays is None:
+        return None
+    return {name: arrays['neighbours_{}'.format(name)] for name in NEIGHBOUR_ARRAYS}
+
+
+def fetch_embedding_store(paths: dict, folder: str):
+    """
+    Make the store available locally: S3 files are downloaded once into the folder, local files are used as is
+
+    :param paths: dict of file name to S3 url or local path, as saved by the flow
+    :param folder: local folder for downloaded files
+    :return: local folder with the store files
+    """
+    if not any(path.startswith('s3://') for path in paths.values()):
+        return os.path.dirname(paths[EMBEDDINGS_FILE])
+
+    from metaflow import S3
+
+    os.makedirs(folder, exist_ok=True)
+    with S3() as s3:
+        for name, s3_object in zip(paths.keys(), s3.get_many(list(paths.values()))):
+            # the S3 client removes its temp files on exit
+            shutil.move(s3_object.path, os.path.join(folder, name))
+    return folder
+
+
+def knn_scorer(embeddings: np.ndarray, batch_size: int = 4096):
+    """
+    NumPy equivalent of the kNN inference model over (memory-mapped) embeddings: the query is the average
+    of the session vectors, scored by dot product against the same columns as knn_inference_model
+
+    :param embeddings: (vocab_size + 1, dims) embeddings indexed by model id, row 0 being padding
+    :param batch_size: number of catalog rows scored per matrix product
+    :return: function mapping (n, MAX_LEN) padded ids to (n, vocab_size) scores
+    """
+    def score(sessions):
+        sessions = np.asarray(sessions, dtype=np.int64)
+        valid = (sessions > 0) & (sessions < len(embeddings))
+        sessions = np.where(valid, sessions, 0)
+        query = (embeddings[sessions].astype(np.float32) * valid[..., None]).sum(axis=1)
+        query /= np.maximum(valid.sum(axis=1, keepdims=True), 1)
+        # output column i is model id i, for ids 0 to vocab_size - 1
+        return np.hstack([query @ embeddings[start:min(start + batch_size, len(embeddings) - 1)].astype(np.float32).T
+                          for start in range(0, len(embeddings) - 1, batch_size)])
+
+    return score
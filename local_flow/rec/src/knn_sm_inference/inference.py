@@ -1,4 +1,72 @@
+import io
+import os
 import json
+import numpy as np
+
+# number of past interactions the model takes as input
+MAX_LEN = 20
+# precomputed item-to-item neighbours, shipped next to the model by deploy_tf_model
+NEIGHBOURS_PATH = os.getenv('NEIGHBOURS_PATH', '/opt/ml/model/neighbours.npz')
+# loaded on first request, if the model comes with a neighbour table
+neighbours = None
+
+
+def get_neighbours():
+    global neighbours
+    if neighbours is None and os.path.exists(NEIGHBOURS_PATH):
+        with np.load(NEIGHBOURS_PATH) as f:
+            neighbours = {name: f[name] for name in f.files}
+    return neighbours
+
+
+def neighbour_predictions(session, table):
+    """
+    Merge the precomputed neighbour lists of the session items: the kNN model scores items by their
+    average similarity with the session items, so scores are averaged over the session; a candidate
+    missing from a list gets that list's lowest score, an upper bound of its similarity
+
+    :param session: list of model ids
+    :param table: neighbour table, with 'ids' (int32, -1 for no neighbour) and 'scores' (float16)
+    :return: dict with ids and scores of the merged neighbours, best first
+    """
+    session = np.array([_ for _ in session if 0 < _ < len(table['ids'])], dtype=np.int64)
+    ids = table['ids'][session]
+    valid = ids >= 0
+    lists = table['scores'][session].astype(np.float32)
+    floors = np.where(valid, lists, np.inf).min(axis=1, keepdims=True)
+    candidates, inverse = np.unique(ids[valid], return_inverse=True)
+    gains = np.bincount(inverse, weights=(lists - floors)[valid], minlength=len(candidates))
+    scores = (gains + floors[np.isfinite(floors)].sum()) / max(len(session), 1)
+    best = np.argsort(-scores, kind='stable')[:table['ids'].shape[1]]
+    return {'ids': candidates[best].tolist(), 'scores': scores[best].tolist()}
+
+
+def short_session_response(data_str, context):
+    """
+    Answer short sessions from the neighbour table, without running the model
+
+    :return: (response, content type), or None if the request needs full scoring
+    """
+    table = get_neighbours()
+    if table is None:
+        return None
+    session = json.loads(data_str.split("\n")[0])["instances"][-1][-MAX_LEN:]
+    if not 0 < len(session) <= int(table['max_session_len']):
+        return None
+    return json.dumps({'predictions': [neighbour_predictions(session, table)]}), context.accept_header
+
+
+def handler(data, context):
+    # short sessions: merge precomputed neighbours
+    data_str = data.read().decode("utf-8")
+    response = short_session_response(data_str, context)
+    if response is not None:
+        return response
+    # longer sessions: full scoring by the model
+    import requests
+    processed_input = input_handler(io.BytesIO(data_str.encode("utf-8")), context)
+    response = requests.post(context.rest_uri, data=processed_input)
+    return output_handler(response, context)
 
 
 def input_handler(data, context):
@@ -7,9 +75,11 @@ def input_handler(data, context):
     jsonlines = data_str.split("\n")
     session = json.loads(jsonlines[0])["instances"]
     # select most-recent for kNN model for prediction
-    return json.dumps({'instances':[session[-1]]})
+    session = session[-1][-MAX_LEN:]
+    # padding, as the model takes a fixed-length input
+    return json.dumps({'instances':[session + [0]*(MAX_LEN-len(session))]})
 
 def output_handler(response, context):
-    # pass through
+    # pass through: full-vocabulary scores or, for top-k models, {'ids': [...], 'scores': [...]}
     response_content_type = context.accept_header
     return json.dumps(response.json()), response_content_type
@@ -10,6 +10,10 @@ from random import sample
 
 from dataclasses import dataclass
 from prodb.prodb import ProdB
+from prepare_dataset import session_list
+from prodb_sm_inference.inference import pad_sessions, MAX_LEN
+from ann_index import IVFIndex
+from embedding_store import save_embedding_store, load_embedding_store, knn_scorer
 
 import tensorflow as tf
 from tensorflow.keras import layers, Model
@@ -33,11 +37,19 @@ class ProdBConfig:
 
 
 def prodb_inference_model(prodb_model):
+    """
+    Wrap the ProdB masked language model for inference: each input row is a session padded after
+    its mask token, and the output is the row of logits at that row's mask position
 
+    :param prodb_model: trained ProdB model
+    :return: keras model mapping (batch, MAX_LEN) ids to (batch, vocab) scores
+    """
     inputs = layers.Input((prodb_model.config.MAX_LEN,), dtype=tf.int64)
     prediction = prodb_model.bert_masked_model(inputs)
-    mask_idx = tf.where(tf.not_equal(inputs[0], 0))[-1, 0]
-    output = prediction[:1, mask_idx]
+    # mask position of each row: last non-padding position
+    positions = tf.range(tf.shape(inputs)[1])
+    mask_idx = tf.reduce_max(tf.where(tf.not_equal(inputs, 0), positions, -1), axis=1)
+    output = tf.gather(prediction, tf.maximum(mask_idx, 0), axis=1, batch_dims=1)
     inference_model = Model(inputs=inputs, outputs=output)
     inference_model.compile()
     # debug
@@ -45,12 +57,27 @@ def prodb_inference_model(prodb_model):
     return inference_model
 
 
+def prodb_single_session_model(prodb_model):
+    """
+    Previous ProdB inference graph, scoring the first session of a batch only; reference for benchmarks
+
+    :param prodb_model: trained ProdB model
+    :return: keras model mapping (1, MAX_LEN) ids to (1, vocab) scores
+    """
+    inputs = layers.Input((prodb_model.config.MAX_LEN,), dtype=tf.int64)
+    prediction = prodb_model.bert_masked_model(inputs)
+    mask_idx = tf.where(tf.not_equal(inputs[0], 0))[-1, 0]
+    output = prediction[:1, mask_idx]
+    inference_model = Model(inputs=inputs, outputs=output)
+    inference_model.compile()
+    return inference_model
+
+
 def knn_inference_model(vector_dims: int,
                         vocab_size: int,
-                        wv_model,
-                        id2token: dict):
-    # get normalized vectors from trained gensim model
-    embedding_matrix = np.array([wv_model.get_vector(id2token[idx+1], norm=True) for idx in range(vocab_size)])
+                        wv_model):
+    # get normalized vectors from trained gensim model, in index order (model id = index + 1)
+    embedding_matrix = wv_model.get_normed_vectors()
     # reserve idx=0 for masking
     embedding_weights = np.vstack((np.zeros((1, vector_dims)),
                                    embedding_matrix))
@@ -87,6 +114,41 @@ def knn_inference_model(vector_dims: int,
     # model.summary()
     return model
 
+def build_neighbour_table(vectors: np.ndarray,
+                          n_neighbours: int = 50,
+                          max_session_len: int = 3,
+                          batch_size: int = 1024):
+    """
+    Precompute the top-N most similar products of every product, to answer short sessions without
+    scoring the full catalog; lists are exact and include the product itself, as the kNN model does
+
+    :param vectors: (n_items, dims) normalized product vectors, model id = row + 1
+    :param n_neighbours: number of neighbours kept per product
+    :param max_session_len: sessions up to this length are answered from the table when serving
+    :param batch_size: number of products scored per matrix product
+    :return: dict with 'ids' (int32, indexed by model id, -1 for none), 'scores' (float16) and 'max_session_len'
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    n_neighbours = min(n_neighbours, len(vectors))
+    # row 0 is padding
+    ids = np.full((len(vectors) + 1, n_neighbours), -1, dtype=np.int32)
+    scores = np.zeros((len(vectors) + 1, n_neighbours), dtype=np.float16)
+    for start in range(0, len(vectors), batch_size):
+        similarities = vectors[start:start + batch_size] @ vectors.T
+        top_n = np.argpartition(-similarities, n_neighbours - 1, axis=1)[:, :n_neighbours]
+        top_n_scores = np.take_along_axis(similarities, top_n, axis=1)
+        order = np.argsort(-top_n_scores, axis=1)
+        ids[start + 1:start + 1 + len(top_n)] = np.take_along_axis(top_n, order, axis=1) + 1
+        scores[start + 1:start + 1 + len(top_n)] = np.take_along_axis(top_n_scores, order, axis=1)
+    print('Neighbour table: {} products x {} neighbours'.format(len(vectors), n_neighbours))
+
+    return {
+                'ids': ids,
+                'scores': scores,
+                'max_session_len': np.array(max_session_len)
+           }
+
+
 def train_prodb_model(sessions: dict,
                       max_len: int = 20,
                       batch_size: int = 32,
@@ -110,10 +172,10 @@ def train_prodb_model(sessions: dict,
                          NUM_LAYERS=num_layers,
                          EPOCHS=epochs)
 
-    # convert into prodb input format
-    train_sessions = [' '.join(_) for _ in sessions['train']]
+    # convert into prodb input format, sku codes being the tokens
+    train_sessions = [' '.join(map(str, _)) for _ in session_list(sessions['train'])]
     # set vocab size based on training sessions
-    config.VOCAB_SIZE = len({_ for s in sessions['train'] for _ in s})
+    config.VOCAB_SIZE = len(np.unique(sessions['train']['skus']))
     print('Init ProdB model')
     # init prodb model and duplicate data
     prodb_model = ProdB(train_sessions*data_duplication, config)
@@ -127,15 +189,11 @@ def train_prodb_model(sessions: dict,
     model = prodb_inference_model(prodb_model)
     # debug
     # print(model(np.array([ [10,124,12,45,43]+[0]*15 ])))
-    validation_hr = hit_rate_at_k(rec_model=model,
-                                  token2id=prodb_model.token2id,
-                                  id2token=prodb_model.id2token,
-                                  sessions=sessions['valid'])
-    if tracker_callback is not None:
-        if isinstance(tracker_callback, wandb.keras.WandbCallback):
-            wandb.log({'HR@10': validation_hr})
-        else:
-            tracker_callback._metric_logger["HR@10"] = validation_hr
+    token_mapping = prodb_token_mapping(prodb_model.id2token)
+    validation_metrics = evaluate_rec_model(rec_model=model,
+                                            token_mapping=token_mapping,
+                                            sessions=sessions['valid'])
+    log_validation_metrics(validation_metrics, tracker_callback)
 
     # return MLM weights and token mappings
     return {
@@ -143,33 +201,92 @@ def train_prodb_model(sessions: dict,
                'weights': model.get_weights(),
                'custom_objects': {prodb_model.MaskedLanguageModel.__name__: prodb_model.MaskedLanguageModel}
             },\
-           {
-                'token2id': prodb_model.token2id,
-                'id2token': prodb_model.id2token
+           token_mapping
+
+
+def log_validation_metrics(metrics: dict, tracker=None):
+    """
+    Log validation metrics to the experiment tracker, if any
+
+    :param metrics: dict of metric name to value
+    :param tracker: wandb or neptune keras callback
+    :return:
+    """
+    if tracker is None:
+        return
+    if isinstance(tracker, wandb.keras.WandbCallback):
+        wandb.log(metrics)
+    else:
+        for name, value in metrics.items():
+            tracker._metric_logger[name] = value
+
+
+def prodb_token_mapping(id2token: dict):
+    """
+    Convert ProdB string tokens into an array-based token mapping
+
+    :param id2token: ProdB id to token mapping; sku tokens are sku codes
+    :return: token mapping with 'id2code' (int32 array, -1 for non-sku tokens) and 'special_tokens'
+    """
+    id2code = np.full(max(id2token.keys()) + 1, -1, dtype=np.int32)
+    special_tokens = dict()
+    for idx, token in id2token.items():
+        if str(token).isdigit():
+            id2code[idx] = int(token)
+        else:
+            special_tokens[token] = idx
+
+    return {
+                'id2code': id2code,
+                'special_tokens': special_tokens
            }
 
 
+def codes_to_ids(codes: np.ndarray, id2code: np.ndarray):
+    """
+    Map sku codes to model ids through a dense lookup table
+
+    :param codes: array of sku codes
+    :param id2code: model id to sku code array, -1 for non-sku ids
+    :return: array of model ids, 0 for codes unknown to the model
+    """
+    size = max(int(codes.max()) if len(codes) else 0, int(id2code.max())) + 1
+    code2id = np.zeros(size, dtype=np.int32)
+    sku_ids = np.flatnonzero(id2code >= 0)
+    code2id[id2code[sku_ids]] = sku_ids
+    return code2id[codes]
+
+
 def train_prod2vec_model(sessions: dict,
                          min_c: int = 3,
                          size: int = 48,
                          window: int = 5,
                          iterations: int = 15,
                          ns_exponent: float = 0.75,
+                         ann_lists: int = 0,
+                         ann_probes: int = 8,
+                         embedding_store_path: str = 'embedding_store',
+                         embedding_dtype: str = 'float32',
                          tracker=None):
     """
     Train CBOW to get product embeddings. We start with sensible defaults from the literature - please
     check https://arxiv.org/abs/2007.14906 for practical tips on how to optimize prod2vec.
 
-    :param sessions: list of lists, as user sessions are list of interactions
+    :param sessions: train and valid flat sessions of sku codes
     :param min_c: minimum frequency of an event for it to be calculated for product embeddings
     :param size: output dimension
     :param window: window parameter for gensim word2vec
     :param iterations: number of training iterations
     :param ns_exponent: ns_exponent parameter for gensim word2vec
-    :return: trained product embedding model
+    :param ann_lists: if > 0, also build an IVF index with this many lists over the product embeddings, saved in
+        the embedding store
+    :param ann_probes: default number of lists scanned per query by the IVF index
+    :param embedding_store_path: local folder where embeddings and vocabulary are saved as .npy
+    :param embedding_dtype: float32 or float16, dtype of the saved embeddings
+    :return: trained product embedding model; weights are in the embedding store
     """
     print('Training P2V Model!')
-    model = gensim.models.Word2Vec(sentences=sessions['train'],
+    model = gensim.models.Word2Vec(sentences=session_list(sessions['train']),
                                    min_count=min_c,
                                    vector_size=size,
                                    window=window,
@@ -178,96 +295,157 @@ def train_prod2vec_model(sessions: dict,
 
     print("# products in the space: {}".format(len(model.wv.index_to_key)))
     # reserve idx 0 for masking
-    token2id = {token: idx+1 for token, idx in model.wv.key_to_index.items()}
-    id2token = {idx: token for token, idx in token2id.items()}
+    token_mapping = {
+        'id2code': np.concatenate(([-1], model.wv.index_to_key)).astype(np.int32),
+        'special_tokens': {}
+    }
 
     knn_model = knn_inference_model(vector_dims=size,
-                                    vocab_size=len(token2id),
-                                    wv_model=model.wv,
-                                    id2token=id2token)
+                                    vocab_size=len(model.wv.index_to_key),
+                                    wv_model=model.wv)
     # debug
     # response = knn_model(np.array([[0]]))[0]
     # response = np.argsort(response)[::-1][:10]
     # print(response)
     # print([ token2id[_[0]] for _ in model.wv.similar_by_word(id2token[0])])
 
-    validation_hr = hit_rate_at_k(rec_model=knn_model,
-                                  token2id=token2id,
-                                  id2token=id2token,
-                                  sessions=sessions['valid'])
-    if tracker is not None:                             
-        if isinstance(tracker, wandb.keras.WandbCallback):
-            wandb.log({'HR@10': validation_hr})
-        else:
-            tracker._metric_logger["HR@10"] = validation_hr
-    
+    # write embeddings once, and evaluate on the memory-mapped copy
+    store_paths = save_embedding_store(embedding_store_path,
+                                       embeddings=knn_model.get_weights()[0],
+                                       id2code=token_mapping['id2code'],
+                                       dtype=embedding_dtype)
+    embeddings, _ = load_embedding_store(embedding_store_path)
+
+    validation_metrics = evaluate_rec_model(rec_model=knn_scorer(embeddings),
+                                            token_mapping=token_mapping,
+                                            sessions=sessions['valid'])
+
+    if ann_lists > 0:
+        print('Building IVF index with {} lists'.format(ann_lists))
+        # index ids are model ids, idx 0 being reserved for masking
+        ann_index = IVFIndex(n_lists=ann_lists, n_probe=ann_probes).fit(embeddings,
+                                                                        ids=np.arange(1, len(embeddings)))
+        # saved next to the embeddings, which it reads its vectors from
+        store_paths.update(ann_index.save(embedding_store_path))
+        ann_metrics = evaluate_rec_model(rec_model=None,
+                                         token_mapping=token_mapping,
+                                         sessions=sessions['valid'],
+                                         ann_index=ann_index)
+        validation_metrics.update({'ANN {}'.format(name): value for name, value in ann_metrics.items()})
+    log_validation_metrics(validation_metrics, tracker)
 
     return {
                 'model': knn_model.to_json(),
-                'weights': knn_model.get_weights(),
-                'custom_objects': {}
+                # weights are the embeddings, see the embedding store
+                'weights': None,
+                'custom_objects': {},
+                'embedding_store': store_paths
            }, \
-           {
-                'token2id': token2id,
-                'id2token': id2token
-           }
+           token_mapping
 
 
 def hit_rate_at_k(rec_model,
-                  token2id: dict,
-                  id2token: dict,
-                  sessions: list,
-                  k: int = 10):
-    print('Evaluating HR@{}'.format(k))
-    all_skus_idx = list(id2token.keys())
-    test_queries = sessions
-    cnt_preds = 0
-    hits = 0
-    # loop over the records and predict the next event
-    for idx, t in enumerate(test_queries):
-        # debug
-        if idx % 10000 == 0:
-            print('\nProcessed {}/{} test queries'.format(idx, len(test_queries)))
-            print('Running HR@{} is {}'.format(k, hits/(idx+1)))
-
-        # if unknown product, will never hit
-        if t[-1] not in token2id:
-            continue
-
-        # convert session to indices
-        if '[UNK]' in token2id:
-            # use ['UNK'] token if it exists
-            t_idx = [int(token2id.get(_, token2id['[UNK]'])) for _ in t]
+                  token_mapping: dict,
+                  sessions: dict,
+                  k: int = 10,
+                  batch_size: int = 256):
+    """
+    HR@k of a recommendation model over validation sessions; see `evaluate_rec_model`
+
+    :return: HR@k
+    """
+    return evaluate_rec_model(rec_model=rec_model,
+                              token_mapping=token_mapping,
+                              sessions=sessions,
+                              ks=(k,),
+                              batch_size=batch_size)['HR@{}'.format(k)]
+
+
+def evaluate_rec_model(rec_model,
+                       token_mapping: dict,
+                       sessions: dict,
+                       ks: tuple = (1, 5, 10, 20),
+                       batch_size: int = 256,
+                       ann_index: IVFIndex = None):
+    """
+    Batched next-item evaluation: the last product of each session is the target, the previous ones
+    are the query. All queries are padded at once with the same logic as the SageMaker handler, scored
+    in batches of `batch_size` and ranked with argpartition. Sessions whose target is unknown to the model
+    count as misses, sessions without a query fall back to random SKUs.
+
+    :param rec_model: keras model mapping padded sessions to scores over model ids
+    :param token_mapping: model token mapping, with 'id2code' and 'special_tokens'
+    :param sessions: flat sessions of sku codes
+    :param ks: cut-offs to compute metrics at
+    :param batch_size: number of sessions scored per model call
+    :param ann_index: if given, top-k come from the approximate index instead of the model scores
+    :return: dict of HR@k, MRR@k and NDCG@k for each k
+    """
+    print('Evaluating at k={}'.format(list(ks)))
+    max_k = max(ks)
+    id2code = token_mapping['id2code']
+    unk_id = token_mapping['special_tokens'].get('[UNK]')
+    mask_id = token_mapping['special_tokens'].get('mask')
+    all_skus_idx = np.flatnonzero(id2code >= 0).tolist()
+
+    # convert sessions to model indices once; 0 for unknown products
+    ids = codes_to_ids(sessions['skus'], id2code)
+    offsets = sessions['offsets']
+    n_queries = len(offsets) - 1
+    lengths = np.diff(offsets)
+    seg = np.repeat(np.arange(n_queries), lengths)
+    # if unknown product, will never hit
+    target_known = ids[offsets[1:] - 1] > 0
+    if unk_id is not None:
+        # use ['UNK'] token if it exists
+        ids = np.where(ids > 0, ids, unk_id)
+    else:
+        # drop unknown products
+        seg = seg[ids > 0]
+        ids = ids[ids > 0]
+        lengths = np.bincount(seg, minlength=n_queries)
+    session_offsets = np.concatenate(([0], np.cumsum(lengths)))
+
+    evaluated = np.flatnonzero(target_known)
+    targets = ids[session_offsets[evaluated + 1] - 1]
+    has_query = lengths[evaluated] > 1
+    # ranked predictions for each evaluated session, best first
+    ranked = np.zeros((len(evaluated), max_k), dtype=np.int64)
+
+    # this is our default predictions, which defaults to a random SKU
+    for row in np.flatnonzero(~has_query):
+        ranked[row] = sample(all_skus_idx, k=max_k)
+
+    # if there exists products in session, pad all queries at once and score them in batches
+    query_rows = np.flatnonzero(has_query)
+    queries = [ids[session_offsets[q]:session_offsets[q + 1] - 1].tolist() for q in evaluated[query_rows]]
+    queries = np.array(pad_sessions(queries, mask_id), dtype=np.int64).reshape(-1, MAX_LEN)
+    for start in range(0, len(queries), batch_size):
+        if ann_index is not None:
+            top_k, _ = ann_index.search_sessions(queries[start:start + batch_size], k=max_k)
         else:
-            t_idx = [int(token2id[_]) for _ in t if _ in token2id]
-
-        # this is our default predictions, which defaults to a random SKU
-        next_skus = sample(all_skus_idx, k=k)
-        target = t_idx[-1]
-        _products_in_session = t_idx[:-1]
-
-        # if there exists products in session
-        if _products_in_session:
-            # if mask token exists, add to end of seq
-            if 'mask' in token2id:
-                _products_in_session_padded = _products_in_session[-19:] + [token2id['mask']] + \
-                                              [0] * (20 - len(_products_in_session[-19:]) - 1)
-            else:
-                _products_in_session_padded = _products_in_session[-19:] + [0]*(20-len(_products_in_session[-19:]))
-            predictions = rec_model(np.array([_products_in_session_padded]))[0]
-            top_k = np.argsort(predictions)[-k:]
-            next_skus = top_k.tolist()
-            cnt_preds += 1
+            predictions = np.asarray(rec_model(queries[start:start + batch_size]))
+            top_k = np.argpartition(-predictions, max_k - 1, axis=1)[:, :max_k]
+            top_k_scores = np.take_along_axis(predictions, top_k, axis=1)
+            top_k = np.take_along_axis(top_k, np.argsort(-top_k_scores, axis=1), axis=1)
+        ranked[query_rows[start:start + batch_size]] = top_k
         # debug
-        # print('target is : {}'.format(target))
-        # print(next_skus)
-        # print('\n')
-        if target in next_skus:
-            hits += 1
+        print('Scored {}/{} test queries'.format(min(start + batch_size, len(queries)), len(queries)))
+
+    # position of the target in the ranked list, max_k if not there
+    hit_matrix = ranked == targets[:, None]
+    rank = np.where(hit_matrix.any(axis=1), hit_matrix.argmax(axis=1), max_k)
+
+    metrics = dict()
+    for k in ks:
+        hit = rank < k
+        metrics['HR@{}'.format(k)] = hit.sum() / n_queries
+        metrics['MRR@{}'.format(k)] = (1.0 / (rank[hit] + 1)).sum() / n_queries
+        metrics['NDCG@{}'.format(k)] = (1.0 / np.log2(rank[hit] + 2)).sum() / n_queries
 
     # print out some "coverage"
-    print("Predictions made in {} out of {} total test cases".format(cnt_preds, len(test_queries)))
-    # check hit rate as metric
-    print("HR@{} : {}".format(k, hits/len(test_queries)))
+    print("Predictions made in {} out of {} total test cases".format(len(query_rows), n_queries))
+    for name, value in metrics.items():
+        print("{} : {}".format(name, value))
 
-    return hits/len(test_queries)
+    return metrics
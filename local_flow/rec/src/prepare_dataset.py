@@ -4,6 +4,7 @@ Data preparation for model training
 
 """
 import csv
+import numpy as np
 import pandas as pd
 import random
 
@@ -26,54 +27,139 @@ def read_sessions_from_training_file(training_file: str, K: int = None):
 
     :param training_file: path to training file
     :param K: row limit
-    :return: list of sessions
+    :return: train and valid sessions, as flat arrays of sku codes with offsets
+    """
+    reader = pd.read_parquet(training_file,
+                             columns=['session_code', 'sku_code', 'server_timestamp_epoch_ms'])
+    # if a max number of items is specified, just keep the first K rows
+    if K:
+        reader = reader.head(K)
+
+    user_sessions = sessionize(session_codes=reader['session_code'].to_numpy(),
+                               sku_codes=reader['sku_code'].to_numpy(),
+                               timestamps=reader['server_timestamp_epoch_ms'].to_numpy())
+
+    # print how many sessions we have...
+    print("# total sessions: {}".format(len(user_sessions['offsets']) - 1))
+    # print first one to check
+    print("First session is: {}".format(session_list(user_sessions)[0]))
+
+    return train_valid_split(user_sessions)
+
+
+def sessionize(session_codes: np.ndarray,
+               sku_codes: np.ndarray,
+               timestamps: np.ndarray,
+               min_len: int = 3,
+               max_len: int = 20):
+    """
+    Columnar sessionization over rows already sorted by session and timestamp.
+
+    Session boundaries are found with a single diff over the session codes, and sessions
+    are filtered by size and sorted by start time using array operations only. As in the row-wise
+    reader, the last (possibly truncated) session is never flushed and thus not returned.
+
+    :param session_codes: session_code column
+    :param sku_codes: sku_code column
+    :param timestamps: server_timestamp_epoch_ms column
+    :param min_len: minimum session length to retain
+    :param max_len: maximum session length to retain
+    :return: sessions sorted by start time, as a flat int32 array of sku codes ('skus') and
+             int64 'offsets', session i being skus[offsets[i]:offsets[i+1]]
+    """
+    boundaries = np.flatnonzero(np.diff(session_codes)) + 1
+    # every boundary closes the session before it; the trailing session is left open
+    starts = np.concatenate(([0], boundaries[:-1])) if len(boundaries) else np.array([], dtype=np.int64)
+    ends = boundaries
+    sizes = ends - starts
+    # retain session if within reasonable range
+    keep = (sizes >= min_len) & (sizes <= max_len)
+    starts = starts[keep]
+    sizes = sizes[keep]
+    # sort by start time; ascending (stable, as python's sorted)
+    order = np.argsort(timestamps[starts], kind='stable')
+    starts = starts[order]
+    sizes = sizes[order]
+
+    # gather the rows of the retained sessions, in their new order
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    rows = np.repeat(starts - offsets[:-1], sizes) + np.arange(offsets[-1])
+
+    return {
+            'skus': sku_codes[rows].astype(np.int32),
+            'offsets': offsets
+            }
+
+
+def sessionize_iterrows(df: pd.DataFrame,
+                        min_len: int = 3,
+                        max_len: int = 20):
+    """
+    Row-wise reference sessionizer, kept for parity checks and benchmarking against `sessionize`
+
+    :param df: dataframe sorted by session and timestamp
+    :param min_len: minimum session length to retain
+    :param max_len: maximum session length to retain
+    :return: list of sessions (list of sku codes), sorted by session start time
     """
     user_sessions = []
     current_session = []
     current_session_id = None
     current_session_time = None
 
-    reader = pd.read_parquet(training_file)
-    for idx, row in reader.iterrows():
-        # if a max number of items is specified, just return at the K with what you have
-        if K and idx >= K:
-            break
-        # row will contain: session_id_hash, product_action, product_sku_hash, server_timestamp_epoch_ms
-        _session_id_hash = row['session_id_hash']
+    for idx, row in df.iterrows():
+        # row will contain: session_code, sku_code, server_timestamp_epoch_ms
+        _session_code = row['session_code']
 
         if current_session_time is None:
             current_session_time = row['server_timestamp_epoch_ms']
 
         # when a new session begins, store the old one and start again
-        if current_session_id and current_session and _session_id_hash != current_session_id:
-            if 3 <= len(current_session) <= 20:
+        if current_session_id is not None and current_session and _session_code != current_session_id:
+            if min_len <= len(current_session) <= max_len:
                 # retain session if within reasonable range
                 user_sessions.append({'session_start_time':current_session_time, 'session': current_session})
             # reset session
             current_session = []
             current_session_time = row['server_timestamp_epoch_ms']
 
-        current_session.append(row['product_sku_hash'])
+        current_session.append(row['sku_code'])
         # update the current session id
-        current_session_id = _session_id_hash
-
-    # print how many sessions we have...
-    print("# total sessions: {}".format(len(user_sessions)))
-    # print first one to check
-    print("First session is: {}".format(user_sessions[0]))
-    print(user_sessions[0]['session_start_time'])
-    print(user_sessions[10]['session_start_time'])
+        current_session_id = _session_code
 
     # sort by start time; ascending
     user_sessions = sorted(user_sessions,
                            key=lambda _ : _['session_start_time'],
                            reverse=False)
     # extract sessions only
+    return [ _['session'] for _ in user_sessions]
+
+
+def session_list(sessions: dict):
+    """
+    Expand flat sessions into a list of sessions (list of sku codes)
+
+    :param sessions: flat sessions, as returned by `sessionize`
+    :return: list of lists of int
+    """
+    return [s.tolist() for s in np.split(sessions['skus'], sessions['offsets'][1:-1])] \
+        if len(sessions['offsets']) > 1 else []
+
 
-    user_sessions = [ _['session'] for _ in user_sessions]
+def train_valid_split(user_sessions: dict, train_ratio: float = 0.95):
+    """
+    Time-ordered train/validation split
+
+    :param user_sessions: flat sessions, sorted by start time
+    :param train_ratio: fraction of sessions used for training
+    :return: dictionary of train and valid flat sessions
+    """
+    skus, offsets = user_sessions['skus'], user_sessions['offsets']
     # sample 0.95 for training, 0.05 for validation
-    train_sessions = user_sessions[:int(len(user_sessions)*0.95)]
-    valid_sessions = user_sessions[int(len(user_sessions)*0.95):]
+    cut = int((len(offsets) - 1) * train_ratio)
+    train_sessions = {'skus': skus[:offsets[cut]], 'offsets': offsets[:cut + 1]}
+    valid_sessions = {'skus': skus[offsets[cut]:], 'offsets': offsets[cut:] - offsets[cut]}
 
     return {
             'train': train_sessions,
@@ -6,7 +6,20 @@ except Exception as e:
     print(e)
     CUDF_AVAIL = False
 
+import os
+import shutil
+import tempfile
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from pyarrow.fs import FileSystem
+
+BROWSING_SORT_KEYS = ['session_id_hash', 'server_timestamp_epoch_ms']
+BROWSING_OUTPUT_COLUMNS = ['session_id_hash', 'product_sku_hash', 'server_timestamp_epoch_ms']
+# hash columns are dictionary-encoded as dense int32 codes, code i being row i of the vocabulary
+ENCODED_COLUMNS = {'session_id_hash': 'session_code', 'product_sku_hash': 'sku_code'}
 
 
 def read_from_parquet(path, limit=None):
@@ -25,22 +38,31 @@ def return_df(df):
     return df
 
 
-def process_raw_data(search_train_path, browsing_train_path, sku_to_content_path):
+def process_raw_data(search_train_path, browsing_train_path, sku_to_content_path, streaming=False, output_dir=None):
     """
     Entry point for data transformation with rapids/pandas
 
     :param search_train_path:
     :param browsing_train_path:
     :param sku_to_content_path:
-    :return:
+    :param streaming: if True, process browsing_train row group by row group in bounded memory
+    :param output_dir: local folder for the parquet files written when streaming, owned by the caller
+    :return: dict of processed data and dict of vocabularies, by name
     """
+    if streaming and output_dir is None:
+        raise ValueError('output_dir is required when streaming')
     # process raw_data
     df_search_train = process_search_train(search_train_path)
-    df_browsing_train = process_browsing_train(browsing_train_path)
+    if streaming:
+        # browsing_train and vocabularies are returned as paths to local parquet files in output_dir
+        df_browsing_train, vocabularies = stream_browsing_train(
+            browsing_train_path, os.path.join(output_dir, 'browsing_train.parquet'))
+    else:
+        df_browsing_train, vocabularies = process_browsing_train(browsing_train_path)
     df_sku_to_content = process_sku_to_content(sku_to_content_path)
 
     # reutrn dict of processed data with name, only browsing_train for now
-    return {'browsing_train': df_browsing_train}
+    return {'browsing_train': df_browsing_train}, vocabularies
 
 
 def process_search_train(search_train_path):
@@ -80,7 +102,278 @@ def process_browsing_train(browsing_train_path):
     print(df[['session_id_hash', 'server_timestamp_epoch_ms']].head(10))
     print('\n')
 
-    return return_df(df)
+    return encode_browsing_train(return_df(df))
+
+
+def encode_browsing_train(df):
+    """
+    Replace session and sku hashes with dense int32 codes
+
+    Codes follow the sorted order of the hashes, so that sorting by session_code is the same as
+    sorting by session_id_hash.
+
+    :param df: processed browsing_train dataframe
+    :return: encoded dataframe and dict of vocabularies (one dataframe per hash column)
+    """
+    vocabularies = dict()
+    for column, code_column in ENCODED_COLUMNS.items():
+        codes, uniques = pd.factorize(df[column], sort=True)
+        df[column] = codes.astype('int32')
+        df = df.rename(columns={column: code_column})
+        vocabularies[column] = pd.DataFrame({column: uniques})
+        print('{} distinct values for {}'.format(len(uniques), column))
+
+    return df, vocabularies
+
+
+def stream_browsing_train(browsing_train_path,
+                          output_path,
+                          limit=None,
+                          run_size=2000000,
+                          merge_batch_size=100000):
+    """
+    CPU-only, bounded-memory version of `process_browsing_train`
+
+    The file is read row group by row group, projecting the needed columns only and skipping row groups
+    whose statistics exclude `product_action == 'detail'`. Filtered rows are buffered into sorted runs of
+    at most `run_size` rows which are spilled to disk, and the runs are then k-way merged by
+    (session_id_hash, server_timestamp_epoch_ms) into a single parquet file. Skus are encoded while
+    reading and sessions while merging, so that the output has the same columns as `encode_browsing_train`.
+
+    :param browsing_train_path: path to browsing_train parquet file (local or S3)
+    :param output_path: local path of the output parquet file; the vocabularies are written next to it
+    :param limit: max number of raw rows to read
+    :param run_size: max number of rows held in memory per sorted run
+    :param merge_batch_size: number of rows read at a time from each run during the merge
+    :return: path to the sorted parquet file and dict of paths to the vocabulary parquet files
+    """
+    print('Streaming {}'.format(browsing_train_path))
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    vocabulary_paths = {column: os.path.join(output_dir, column + '_vocabulary.parquet')
+                        for column in ENCODED_COLUMNS}
+    spill_dir = tempfile.mkdtemp()
+    try:
+        run_paths, sku_vocabulary = _spill_sorted_runs(browsing_train_path, spill_dir, limit, run_size)
+        n_rows = _merge_sorted_runs(run_paths, output_path, vocabulary_paths['session_id_hash'], merge_batch_size)
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+    print('Wrote {} rows from {} sorted runs to {}'.format(n_rows, len(run_paths), output_path))
+
+    # skus are encoded in order of appearance while streaming
+    pq.write_table(pa.Table.from_pandas(pd.DataFrame({'product_sku_hash': sku_vocabulary}),
+                                        preserve_index=False), vocabulary_paths['product_sku_hash'])
+    print('{} distinct values for product_sku_hash'.format(len(sku_vocabulary)))
+
+    # check sorting
+    print(pq.ParquetFile(output_path).read_row_group(0).to_pandas().head(10))
+    print('\n')
+
+    return output_path, vocabulary_paths
+
+
+def _open_parquet_file(path):
+    """
+    Open a local or remote (e.g. s3://) parquet file with pyarrow
+
+    :param path: path or uri of the parquet file
+    :return: pyarrow ParquetFile
+    """
+    try:
+        fs, fs_path = FileSystem.from_uri(path)
+    except (pa.ArrowInvalid, ValueError):
+        # plain local path
+        return pq.ParquetFile(path)
+    return pq.ParquetFile(fs.open_input_file(fs_path))
+
+
+def _row_group_may_match(row_group, column_idx, value):
+    """
+    Use row group min/max statistics to check whether a column may contain a value
+
+    :param row_group: pyarrow row group metadata
+    :param column_idx: index of the column in the file schema
+    :param value: value to look for
+    :return: False if the row group can be safely skipped
+    """
+    stats = row_group.column(column_idx).statistics
+    if stats is None or not stats.has_min_max:
+        return True
+    _min, _max = stats.min, stats.max
+    if isinstance(_min, bytes):
+        _min, _max = _min.decode('utf-8'), _max.decode('utf-8')
+    return _min <= value <= _max
+
+
+def _spill_sorted_runs(browsing_train_path, spill_dir, limit, run_size):
+    """
+    Read, filter, encode skus and sort browsing_train into sorted runs spilled as parquet files
+
+    :return: list of run paths, in file order, and sku vocabulary
+    """
+    parquet_file = _open_parquet_file(browsing_train_path)
+    metadata = parquet_file.metadata
+    action_idx = parquet_file.schema_arrow.get_field_index('product_action')
+    columns = BROWSING_OUTPUT_COLUMNS + ['product_action']
+
+    run_paths = []
+    buffer = []
+    buffered_rows = 0
+    rows_read = 0
+    sku_vocabulary = pd.Index([], dtype=object)
+
+    def spill():
+        run = pd.concat(buffer, ignore_index=True)
+        # stable sort, so that ties keep file order
+        run = run.sort_values(by=BROWSING_SORT_KEYS, kind='mergesort')
+        run_path = os.path.join(spill_dir, 'run-{}.parquet'.format(len(run_paths)))
+        pq.write_table(pa.Table.from_pandas(run, preserve_index=False), run_path)
+        run_paths.append(run_path)
+
+    for rg_idx in range(metadata.num_row_groups):
+        if limit and rows_read >= limit:
+            break
+        row_group = metadata.row_group(rg_idx)
+        rg_rows = row_group.num_rows
+        if limit:
+            rg_rows = min(rg_rows, limit - rows_read)
+        rows_read += rg_rows
+        # predicate pushdown: skip row groups without any detail action
+        if not _row_group_may_match(row_group, action_idx, 'detail'):
+            continue
+        table = parquet_file.read_row_group(rg_idx, columns=columns).slice(0, rg_rows)
+        # select only rows with detail action
+        table = table.filter(pc.equal(table['product_action'], pa.scalar('detail')))
+        table = table.drop(['product_action'])
+        if table.num_rows == 0:
+            continue
+        df = table.to_pandas()
+        # encode skus against the vocabulary seen so far, extending it with new skus
+        codes = sku_vocabulary.get_indexer(df['product_sku_hash'])
+        if (codes < 0).any():
+            sku_vocabulary = sku_vocabulary.append(pd.Index(df['product_sku_hash'][codes < 0].unique()))
+            codes = sku_vocabulary.get_indexer(df['product_sku_hash'])
+        df['product_sku_hash'] = codes.astype('int32')
+        buffer.append(df.rename(columns={'product_sku_hash': 'sku_code'}))
+        buffered_rows += len(df)
+        if buffered_rows >= run_size:
+            spill()
+            buffer, buffered_rows = [], 0
+
+    if buffer:
+        spill()
+
+    print('Read {} rows into {} sorted runs'.format(rows_read, len(run_paths)))
+    return run_paths, sku_vocabulary.to_numpy()
+
+
+def _merge_sorted_runs(run_paths, output_path, session_vocabulary_path, merge_batch_size):
+    """
+    K-way merge of sorted runs into a single parquet file, holding at most a few batches per run in memory
+
+    At each round, the frontier is the smallest last key among the buffers of the runs that still have
+    data on disk: every row with a smaller key is already in memory, so those rows are merged and written
+    out, while the runs whose buffer ends at the frontier read their next batch. Sessions come out sorted,
+    so they are encoded with a running counter and their hashes streamed to the session vocabulary.
+
+    :return: number of rows written
+    """
+    schema = pa.schema([('session_code', pa.int32()),
+                        ('sku_code', pa.int32()),
+                        ('server_timestamp_epoch_ms', pa.int64())])
+    vocabulary_schema = pa.schema([('session_id_hash', pa.string())])
+    if not run_paths:
+        # no detail rows at all: still write empty files with the expected columns
+        pq.write_table(schema.empty_table(), output_path)
+        pq.write_table(vocabulary_schema.empty_table(), session_vocabulary_path)
+        return 0
+
+    run_columns = ['session_id_hash', 'sku_code', 'server_timestamp_epoch_ms']
+    runs = [pq.ParquetFile(p).iter_batches(batch_size=merge_batch_size) for p in run_paths]
+    buffers = [pd.DataFrame(columns=run_columns) for _ in runs]
+    exhausted = [False] * len(runs)
+
+    def read_next(run_idx):
+        try:
+            batch = next(runs[run_idx]).to_pandas()
+        except StopIteration:
+            exhausted[run_idx] = True
+            return
+        buffers[run_idx] = pd.concat([buffers[run_idx], batch], ignore_index=True) \
+            if len(buffers[run_idx]) else batch
+
+    for run_idx in range(len(runs)):
+        read_next(run_idx)
+
+    writer = pq.ParquetWriter(output_path, schema)
+    vocabulary_writer = pq.ParquetWriter(session_vocabulary_path, vocabulary_schema)
+    n_rows = 0
+    last_session = None
+    last_code = -1
+    try:
+        while True:
+            open_runs = [idx for idx in range(len(runs)) if not exhausted[idx]]
+            if open_runs:
+                # runs still on disk and with an empty buffer can't bound the frontier yet
+                empty_runs = [idx for idx in open_runs if not len(buffers[idx])]
+                if empty_runs:
+                    for idx in empty_runs:
+                        read_next(idx)
+                    continue
+                frontier = min(_last_key(buffers[idx]) for idx in open_runs)
+            else:
+                frontier = None
+
+            chunks = []
+            for idx, buffer in enumerate(buffers):
+                cut = len(buffer) if frontier is None else _key_cut(buffer, frontier)
+                if cut:
+                    chunks.append(buffer.iloc[:cut])
+                    buffers[idx] = buffer.iloc[cut:].reset_index(drop=True)
+
+            if chunks:
+                chunk = pd.concat(chunks, ignore_index=True)
+                chunk = chunk.sort_values(by=BROWSING_SORT_KEYS, kind='mergesort')
+                # a new code starts at every session change, including across chunks
+                session_ids = chunk['session_id_hash'].to_numpy()
+                new_session = np.empty(len(session_ids), dtype=bool)
+                new_session[0] = session_ids[0] != last_session
+                new_session[1:] = session_ids[1:] != session_ids[:-1]
+                codes = last_code + np.cumsum(new_session)
+                vocabulary_writer.write_table(pa.table({'session_id_hash': pa.array(session_ids[new_session],
+                                                                                     type=pa.string())}))
+                last_session, last_code = session_ids[-1], codes[-1]
+                table = pa.table({'session_code': pa.array(codes, type=pa.int32()),
+                                  'sku_code': pa.array(chunk['sku_code'].to_numpy(), type=pa.int32()),
+                                  'server_timestamp_epoch_ms': pa.array(chunk['server_timestamp_epoch_ms'].to_numpy(),
+                                                                        type=pa.int64())})
+                writer.write_table(table)
+                n_rows += table.num_rows
+
+            if frontier is None:
+                break
+            # runs whose buffer reaches the frontier need more data to move past it
+            for idx in open_runs:
+                if not len(buffers[idx]) or _last_key(buffers[idx]) == frontier:
+                    read_next(idx)
+    finally:
+        writer.close()
+        vocabulary_writer.close()
+
+    return n_rows
+
+
+def _last_key(df):
+    return df['session_id_hash'].iat[-1], df['server_timestamp_epoch_ms'].iat[-1]
+
+
+def _key_cut(df, key):
+    """
+    Number of leading rows of a sorted dataframe whose (session_id_hash, timestamp) is smaller than key
+    """
+    session_ids = df['session_id_hash'].to_numpy()
+    lo = session_ids.searchsorted(key[0], side='left')
+    hi = session_ids.searchsorted(key[0], side='right')
+    return lo + df['server_timestamp_epoch_ms'].to_numpy()[lo:hi].searchsorted(key[1], side='left')
 
 
 def process_sku_to_content(sku_to_content_path):
@@ -1,5 +1,29 @@
 import json
 
+# number of past interactions the model takes as input
+MAX_LEN = 20
+
+
+def pad_sessions(sessions, mask_id=None, max_len=MAX_LEN):
+    """
+    Build fixed-length model inputs from sessions of token ids; shared with offline evaluation
+
+    :param sessions: list of sessions (list of token ids)
+    :param mask_id: id of the mask token, appended as the position to predict if not None
+    :param max_len: model input length
+    :return: list of padded sessions
+    """
+    padded = []
+    for session in sessions:
+        # add mask
+        if mask_id is not None:
+            session = session + [mask_id]
+        # select N most recent
+        session = session[-max_len:]
+        # padding
+        padded.append(session + [0]*(max_len-len(session)))
+    return padded
+
 
 def input_handler(data, context):
     # read input data
@@ -8,12 +32,8 @@ def input_handler(data, context):
     session = json.loads(jsonlines[0])["instances"][0]
     mask_id = json.loads(jsonlines[0])["mask"]
 
-    # add mask
-    session = session + [mask_id]
-    # select N most recent
-    session = session[-20:]
-    # padding
-    session = session + [0]*(20-len(session))
+    # add mask, select N most recent and pad
+    session = pad_sessions([session], mask_id)[0]
 
     # select most-recent for kNN model for prediction
     return json.dumps({'instances':[session]})
@@ -21,6 +41,7 @@ def input_handler(data, context):
 def output_handler(response, context):
 
     response_dict = response.json()
+    # either full-vocabulary scores or, for top-k models, {'ids': [...], 'scores': [...]}
     predictions = response_dict['predictions'][0]
 
     response_content_type = context.accept_header
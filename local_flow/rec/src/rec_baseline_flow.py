@@ -40,7 +40,8 @@ class RecFlow(FlowSpec):
                        'PARQUET_S3_PATH': os.getenv('PARQUET_S3_PATH'),
                        'SEARCH_TRAIN_PATH': os.getenv('SEARCH_TRAIN_PATH'),
                        'BROWSING_TRAIN_PATH': os.getenv('BROWSING_TRAIN_PATH'),
-                       'SKU_TO_CONTENT_PATH': os.getenv('SKU_TO_CONTENT_PATH')})
+                       'SKU_TO_CONTENT_PATH': os.getenv('SKU_TO_CONTENT_PATH'),
+                       'STREAMING_READ': os.getenv('STREAMING_READ')})
     @pip(libraries={'boto3': '1.17.11', 's3fs': '0.4.2', 'pandas': '1.2.4'})
     @step
     def process_raw_data(self):
@@ -48,6 +49,7 @@ class RecFlow(FlowSpec):
         Read data from S3 datastore and process/transform/wrangle
         """
         import os
+        import tempfile
         from process_raw_data import process_raw_data
         from utils import get_filename
         from metaflow.metaflow_config import DATATOOLS_S3ROOT
@@ -62,20 +64,31 @@ class RecFlow(FlowSpec):
         SKU_TO_CONTENT_PATH = os.path.join(DATASET_PATH, get_filename(
             os.getenv('SKU_TO_CONTENT_PATH')) + '.parquet')
 
-        # process raw data
-        processed_data = process_raw_data(search_train_path=SEARCH_TRAIN_PATH,
-                                          browsing_train_path=BROWSING_TRAIN_PATH,
-                                          sku_to_content_path=SKU_TO_CONTENT_PATH)
-
-        # save as parquet onto S3
-        with S3(run=self) as s3:
-            # save s3 paths in dict
-            self.data_paths = dict()
-            s3_root = s3._s3root
-            for name, data in processed_data.items():
-                data_path = os.path.join(s3_root, name + '.parquet')
-                data.to_parquet(path=data_path, engine='pyarrow')
-                self.data_paths[name] = data_path
+        # process raw data; streamed files are written to a local folder, removed once uploaded
+        with tempfile.TemporaryDirectory() as output_dir:
+            processed_data, vocabularies = process_raw_data(search_train_path=SEARCH_TRAIN_PATH,
+                                                            browsing_train_path=BROWSING_TRAIN_PATH,
+                                                            sku_to_content_path=SKU_TO_CONTENT_PATH,
+                                                            streaming=os.getenv('STREAMING_READ') == '1',
+                                                            output_dir=output_dir)
+
+            # save as parquet onto S3
+            with S3(run=self) as s3:
+                s3_root = s3._s3root
+
+                def save_parquet(name, data):
+                    if isinstance(data, str):
+                        # streamed data is already written as a local parquet file
+                        return s3.put_files([(name + '.parquet', data)])[0][1]
+                    data_path = os.path.join(s3_root, name + '.parquet')
+                    data.to_parquet(path=data_path, engine='pyarrow')
+                    return data_path
+
+                # save s3 paths in dict
+                self.data_paths = {name: save_parquet(name, data) for name, data in processed_data.items()}
+                # vocabularies map the int32 codes of the processed data back to hashes
+                self.vocabulary_paths = {name: save_parquet(name + '_vocabulary', data)
+                                         for name, data in vocabularies.items()}
 
         print(self.data_paths)
 
@@ -144,7 +157,8 @@ class RecFlow(FlowSpec):
         Train a Prod2Vec or ProdB model.
         """
         from utils import ExperimentTracker
-        from model import train_prod2vec_model, train_prodb_model
+        from model import train_prod2vec_model, train_prodb_model, build_neighbour_table
+        from embedding_store import load_embedding_store, save_neighbour_table
 
         # Get tracker name by detecting which tracker's environment variables are set
         tracker_name = 'neptune' if 'NEPTUNE_PROJECT' in os.environ \
@@ -167,7 +181,23 @@ class RecFlow(FlowSpec):
                                                                   window=self.config['WINDOW'],
                                                                   iterations=self.config['ITERATIONS'],
                                                                   ns_exponent=self.config['NS_EXPONENT'],
+                                                                  ann_lists=self.config.get('ANN_LISTS', 0),
+                                                                  ann_probes=self.config.get('ANN_PROBES', 8),
+                                                                  embedding_dtype=self.config.get('EMBEDDING_DTYPE', 'float32'),
                                                                   tracker=tracker.get_tracker_callback())
+            # embeddings are stored as .npy files instead of pickled weights
+            store_paths = self.model.pop('embedding_store')
+            store_folder = os.path.dirname(store_paths['embeddings.npy'])
+            embeddings, _ = load_embedding_store(store_folder)
+            # offline item-to-item neighbours, from the kNN embeddings (row 0 is padding), saved in the store
+            if self.config.get('NEIGHBOURS', 0) > 0:
+                neighbours = build_neighbour_table(embeddings[1:],
+                                                   n_neighbours=self.config['NEIGHBOURS'],
+                                                   max_session_len=self.config['NEIGHBOURS_MAX_SESSION_LEN'])
+                store_paths.update(save_neighbour_table(store_folder, neighbours))
+            # upload the store once all its files are written: artifacts only keep their S3 paths
+            with S3(run=self) as s3:
+                self.embedding_paths = dict(s3.put_files(list(store_paths.items())))
         else:
             self.model, self.token_mapping = train_prodb_model(sessions=self.dataset,
                                                                max_len=self.config['MAX_LEN'],
@@ -190,27 +220,42 @@ class RecFlow(FlowSpec):
         Deploy model on SageMaker
         """
         import os
-        import json
-        from deploy_model import deploy_tf_model
+        import pandas as pd
+        from deploy_model import deploy_tf_model, lambda_token_mapping, save_compact_vocabulary
+        from embedding_store import fetch_embedding_store, load_embedding_store, load_neighbour_table
 
         inference_code_path = "src/{}_sm_inference/inference.py".format(os.getenv('MODEL_CHOICE').lower())
 
+        # kNN weights are the memory-mapped embeddings
+        model_weights = self.model['weights']
+        neighbours = None
+        if model_weights is None:
+            store_folder = fetch_embedding_store(self.embedding_paths, 'embedding_store')
+            embeddings, _ = load_embedding_store(store_folder)
+            model_weights = [embeddings]
+            # kNN neighbour table, if any, shipped next to the model
+            neighbours = load_neighbour_table(store_folder)
+
         # deploy onto SM
         with S3(run=self) as s3:
             self.model_s3_path, \
             self.endpoint_name = deploy_tf_model(model_json=self.model['model'],
-                                                 model_weights=self.model['weights'],
+                                                 model_weights=model_weights,
                                                  custom_objects=self.model['custom_objects'],
                                                  sagemaker_entry_point_path=inference_code_path,
                                                  token_mapping=self.token_mapping,
                                                  s3_obj=s3,
-                                                 run_id=current.run_id)
+                                                 run_id=current.run_id,
+                                                 top_k=int(os.getenv('SAGEMAKER_TOP_K') or 0),
+                                                 neighbours=neighbours)
 
-        self.token_mapping_fname = 'serverless/token-mapping-{}.json'.format(self.endpoint_name)
+        self.token_mapping_fname = 'serverless/token-mapping-{}.vocab'.format(self.endpoint_name)
 
-        # save mappings to serverless folder
-        with open(self.token_mapping_fname, 'w') as f:
-            json.dump(self.token_mapping,f)
+        # decode sku codes back to hashes for the lambda
+        sku_vocabulary = pd.read_parquet(self.vocabulary_paths['product_sku_hash'])['product_sku_hash'].to_numpy()
+        # save mappings to serverless folder, in the compact format loaded lazily by the lambda
+        save_compact_vocabulary(self.token_mapping_fname,
+                                lambda_token_mapping(self.token_mapping, sku_vocabulary)['id2token'])
 
         self.next(self.end)
 
@@ -0,0 +1,17 @@
+{#
+  Watermark of an incremental model, as a TIMESTAMP_NTZ: the var_name var if set (a timestamp string, e.g.
+  "2019-04-15 10:20:30.123"), else the latest value of column already in the model, else the epoch.
+#}
+{% macro watermark(var_name, column) -%}
+
+    {%- if var(var_name, none) is not none -%}
+
+        '{{ var(var_name) }}'::TIMESTAMP_NTZ
+
+    {%- else -%}
+
+        (SELECT COALESCE(MAX({{ column }}), '1970-01-01'::TIMESTAMP_NTZ) FROM {{ this }})
+
+    {%- endif -%}
+
+{%- endmacro %}
@@ -0,0 +1,78 @@
+/**
+  Labelled action sequences of cart sessions, encoded for training.
+
+  Each action is one digit (the Actions codes of prepare_dataset.py: add=2, remove=3, purchase=4, detail=5,
+  pageview=6), in timestamp order. A session is a purchase session (label 1) if its first purchase follows its
+  first add: it is truncated before its second purchase and the first purchase is removed. A session with adds
+  but no purchase is an abandon session (label 0). Other sessions are dropped.
+ */
+
+{{ config(materialized='table') }}
+
+WITH
+    coded_events AS (
+        SELECT
+              session_id_hash
+            , organization_id
+            , server_timestamp
+            , CASE normalized_action
+                WHEN 'add' THEN 2
+                WHEN 'remove' THEN 3
+                WHEN 'purchase' THEN 4
+                WHEN 'detail' THEN 5
+                WHEN 'pageview' THEN 6
+            END AS action_code
+        FROM {{ ref('distinct_events_incremental') }}
+    ),
+    positioned_events AS (
+        SELECT
+              *
+            , ROW_NUMBER() OVER (
+                PARTITION BY session_id_hash, organization_id
+                ORDER BY server_timestamp ASC
+            ) AS position
+        FROM coded_events
+    ),
+    counted_events AS (
+        -- ordered by position, so that events with the same timestamp are counted in the order they are listed
+        SELECT
+              *
+            , COUNT_IF(action_code = 4) OVER (
+                PARTITION BY session_id_hash, organization_id
+                ORDER BY position ASC
+                ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+            ) AS purchase_count
+        FROM positioned_events
+    ),
+    session_marks AS (
+        SELECT
+              session_id_hash
+            , organization_id
+            , MIN(server_timestamp) AS start_time
+            , MIN(IFF(action_code = 2, position, NULL)) AS first_add
+            , MIN(IFF(action_code = 4, position, NULL)) AS first_purchase
+            , MIN(IFF(action_code = 4 AND purchase_count = 2, position, NULL)) AS second_purchase
+        FROM counted_events
+        GROUP BY session_id_hash, organization_id
+    ),
+    labelled_sessions AS (
+        SELECT
+              *
+            , IFF(first_purchase IS NULL, 0, 1) AS label
+        FROM session_marks
+        -- sessions with a purchase before their first add are dropped
+        WHERE first_add IS NOT NULL
+            AND (first_purchase IS NULL OR first_purchase > first_add)
+    )
+
+SELECT
+      session_id_hash
+    , organization_id
+    , start_time
+    , label
+    , LISTAGG(action_code::STRING, '') WITHIN GROUP (ORDER BY position ASC) AS actions
+FROM counted_events
+INNER JOIN labelled_sessions USING (session_id_hash, organization_id)
+WHERE label = 0
+    OR (label = 1 AND position < COALESCE(second_purchase, position + 1) AND position != first_purchase)
+GROUP BY session_id_hash, organization_id, start_time, label
@@ -0,0 +1,40 @@
+/*
+ * Same rows as distinct_events, in one pass and without the self-join on concatenated string keys: for each
+ * session and timestamp, keep the events of the first event_type (event_product over pageview).
+ *
+ * The model is incremental on server_timestamp: a run only reads events newer than the latest one already
+ * loaded, so events of a timestamp must arrive in the same load. The events_since var (a timestamp) reloads the
+ * events after it: the pre-hook first deletes them, as the model has no unique key and would append them twice.
+ * Use dbt run --full-refresh to rebuild it from scratch.
+ */
+
+{{ config(
+    materialized='incremental',
+    pre_hook="{% if is_incremental() and var('events_since', none) is not none %}
+        DELETE FROM {{ this }} WHERE server_timestamp > {{ watermark('events_since', 'server_timestamp') }}
+    {% endif %}"
+) }}
+
+SELECT
+      session_id_hash
+    , server_timestamp
+    , organization_id
+    , event_type
+    , product_action
+    , product_sku_hash
+    , hashed_url
+    , CASE
+        WHEN event_type='pageview' THEN 'pageview'
+        ELSE product_action
+    END AS normalized_action
+FROM {{ ref('browsing_flattened') }}
+{% if is_incremental() %}
+WHERE server_timestamp > {{ watermark('events_since', 'server_timestamp') }}
+{% endif %}
+-- RANK and not ROW_NUMBER: as in distinct_events, duplicate rows of the first event_type are all kept
+-- (NULLs sort last, and a NULL first event_type matches no row in distinct_events)
+QUALIFY RANK() OVER (
+        PARTITION BY session_id_hash, organization_id, server_timestamp
+        ORDER BY event_type ASC
+    ) = 1
+    AND event_type IS NOT NULL
@@ -1,7 +1,12 @@
 /*
  * Compute high level stats from sessions.
+ *
+ * Incremental on session_id_hash: a run only recomputes the sessions with events newer than the sessions_since
+ * var (a timestamp, passed by the Prefect flow) or, by default, than the latest event already in the table.
  */
 
+{{ config(materialized='incremental', unique_key='session_id_hash') }}
+
 SELECT
       session_id_hash
     , organization_id
@@ -9,6 +14,13 @@ SELECT
     , MAX(server_timestamp) AS end_time
     , timediff(second, start_time, end_time) AS session_time
     , COUNT(server_timestamp) AS session_action_count
-    , REGEXP_COUNT(LISTAGG(normalized_action), 'add') AS add_action_count
-FROM {{ ref('distinct_events') }}
-GROUP BY session_id_hash, organization_id
\ No newline at end of file
+    , COUNT_IF(normalized_action = 'add') AS add_action_count
+FROM {{ ref('distinct_events_incremental') }}
+{% if is_incremental() %}
+WHERE session_id_hash IN (
+    SELECT DISTINCT session_id_hash
+    FROM {{ ref('distinct_events_incremental') }}
+    WHERE server_timestamp > {{ watermark('sessions_since', 'end_time') }}
+)
+{% endif %}
+GROUP BY session_id_hash, organization_id
@@ -1,10 +1,20 @@
 /**
   Group sessions with a array of objects for events.
+
+  Incremental on session_id_hash, as session_stats: a run only rebuilds the sessions with events newer than the
+  sessions_since var (a timestamp) or, by default, than the latest event already in the table.
  */
 
-{{ config(materialized='table') }}
+{{ config(materialized='incremental', unique_key='session_id_hash') }}
 
 WITH
+    {% if is_incremental() %}
+    touched_sessions AS (
+        SELECT DISTINCT session_id_hash
+        FROM {{ ref('distinct_events_incremental') }}
+        WHERE server_timestamp > {{ watermark('sessions_since', 'end_time') }}
+    ),
+    {% endif %}
     event_table AS (
         SELECT
               session_id_hash
@@ -23,7 +33,10 @@ WITH
                 , server_timestamp
                 , session_id_hash
                 , organization_id
-            FROM {{ ref('distinct_events') }}
+            FROM {{ ref('distinct_events_incremental') }}
+            {% if is_incremental() %}
+            WHERE session_id_hash IN (SELECT session_id_hash FROM touched_sessions)
+            {% endif %}
         )
         GROUP BY session_id_hash, organization_id
     ),
@@ -31,6 +44,7 @@ WITH
         SELECT
               session_id_hash
             , start_time
+            , end_time
             , add_action_count
             , session_action_count
         FROM {{ ref('session_stats') }}
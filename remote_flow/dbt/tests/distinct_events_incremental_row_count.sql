@@ -0,0 +1,29 @@
+/*
+ * distinct_events_incremental must have the same rows as distinct_events, per session:
+ * returns the sessions whose row counts differ.
+ * distinct_events is not built by the Prefect flow, so the test only runs with the compare_distinct_events var:
+ * dbt run -m distinct_events && dbt test --vars '{compare_distinct_events: true}'
+ */
+
+{{ config(enabled=var('compare_distinct_events', false)) }}
+
+WITH
+    full_counts AS (
+        SELECT session_id_hash, organization_id, COUNT(*) AS row_count
+        FROM {{ ref('distinct_events') }}
+        GROUP BY session_id_hash, organization_id
+    ),
+    incremental_counts AS (
+        SELECT session_id_hash, organization_id, COUNT(*) AS row_count
+        FROM {{ ref('distinct_events_incremental') }}
+        GROUP BY session_id_hash, organization_id
+    )
+
+SELECT
+      session_id_hash
+    , organization_id
+    , full_counts.row_count AS full_row_count
+    , incremental_counts.row_count AS incremental_row_count
+FROM full_counts
+FULL OUTER JOIN incremental_counts USING (session_id_hash, organization_id)
+WHERE full_counts.row_count IS DISTINCT FROM incremental_counts.row_count
@@ -0,0 +1,189 @@
+"""
+
+Micro-benchmarks for the data upload, run on synthetic SIGIR rows
+
+Usage: python benchmarks.py <benchmark_name> [--rows N]
+
+"""
+import os
+import csv
+import time
+import hashlib
+import filecmp
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+
+from data_models.tables import browsing_train_table, search_train_table, sku_to_content_table
+from push_data_to_sf import _write_part
+from wrangle.wranglers import browsing_wrangler, search_wrangler, sku_wrangler, \
+    browsing_batch_wrangler, search_batch_wrangler, sku_batch_wrangler, parse_vectors
+
+
+def _hashes(rng, n_rows: int, n_distinct: int):
+    pool = np.array(['{:064x}'.format(i * 2654435761) for i in range(n_distinct)])
+    return pool[rng.integers(0, n_distinct, size=n_rows)]
+
+
+def _vectors(rng, n_rows: int, dims: int, distinct: int = None):
+    """
+    Vector strings as in the SIGIR files, with some missing elements and empty vectors
+    """
+    n_vectors = distinct or n_rows
+    values = rng.random((n_vectors, dims))
+    strings = []
+    for i, row in enumerate(values):
+        elements = ['' if (i + j) % 97 == 0 else '{:.8f}'.format(x) for j, x in enumerate(row)]
+        strings.append('' if i % 50 == 0 else '[' + ', '.join(elements) + ']')
+    strings = np.array(strings, dtype=object)
+    return strings if distinct is None else strings[rng.integers(0, distinct, size=n_rows)]
+
+
+def make_sigir_frame(table_name: str, n_rows: int, seed: int = 42):
+    """
+    Build synthetic rows of a SIGIR csv file, as strings
+
+    :param table_name: browsing_train, search_train or sku_to_content
+    :param n_rows: number of rows
+    :param seed: random seed
+    :return: dataframe of strings, with the columns of the csv file
+    """
+    rng = np.random.default_rng(seed)
+    timestamps = rng.integers(1_550_000_000_000, 1_560_000_000_000, size=n_rows).astype(str)
+    if table_name == 'browsing_train':
+        return pd.DataFrame({
+            'session_id_hash': _hashes(rng, n_rows, max(n_rows // 8, 1)),
+            'event_type': rng.choice(['event_product', 'pageview'], size=n_rows),
+            'product_action': rng.choice(['', 'detail', 'add', 'remove', 'purchase', 'click'], size=n_rows),
+            'product_sku_hash': np.where(rng.random(n_rows) < 0.3, '', _hashes(rng, n_rows, 10000)),
+            'server_timestamp_epoch_ms': timestamps,
+            'hashed_url': _hashes(rng, n_rows, 20000)
+        })
+    if table_name == 'search_train':
+        n_skus = rng.integers(0, 12, size=n_rows)
+        skus = _hashes(rng, int(n_skus.sum()), 10000)
+        offsets = np.concatenate([[0], np.cumsum(n_skus)])
+        product_skus = ["[" + ", ".join("'{}'".format(s) for s in skus[offsets[i]:offsets[i + 1]]) + "]"
+                        if n_skus[i] or i % 2 else '' for i in range(n_rows)]
+        return pd.DataFrame({
+            'session_id_hash': _hashes(rng, n_rows, max(n_rows // 4, 1)),
+            # queries repeat across sessions
+            'query_vector': _vectors(rng, n_rows, 50, distinct=max(n_rows // 10, 1)),
+            'clicked_skus_hash': '',
+            'product_skus_hash': product_skus,
+            'server_timestamp_epoch_ms': timestamps
+        })
+    return pd.DataFrame({
+        'product_sku_hash': _hashes(rng, n_rows, n_rows),
+        'description_vector': _vectors(rng, n_rows, 50),
+        'category_hash': _hashes(rng, n_rows, 100),
+        'image_vector': _vectors(rng, n_rows, 50),
+        'price_bucket': rng.choice(['', '1.0', '2.0', '3.0', '4.0', '5.0', '6.0', '7.0', '8.0', '9.0', '10.0'],
+                                   size=n_rows)
+    })
+
+
+def timed(func, *args, **kwargs):
+    """
+    Run a function once and return its output along with the elapsed wall time in seconds
+    """
+    start = time.perf_counter()
+    out = func(*args, **kwargs)
+    return out, time.perf_counter() - start
+
+
+def benchmark_wranglers(n_rows: int):
+    """
+    Check that the batch wranglers write the same csv parts as the row wranglers (golden check),
+    and compare their throughput in input rows per second
+    """
+    cases = [
+        ('browsing_train', browsing_train_table, browsing_wrangler, browsing_batch_wrangler),
+        ('search_train', search_train_table, search_wrangler, search_batch_wrangler),
+        ('sku_to_content', sku_to_content_table, sku_wrangler, sku_batch_wrangler)
+    ]
+    with tempfile.TemporaryDirectory() as folder:
+        for table_name, table, row_wrangler, batch_wrangler in cases:
+            fieldnames = [name for name, _ in table['columns']]
+            # round trip through a csv file, as read by SigirBatchedGenerator
+            csv_path = os.path.join(folder, table_name + '.csv')
+            make_sigir_frame(table_name, n_rows).to_csv(csv_path, index=False)
+            with open(csv_path) as f:
+                rows = list(csv.DictReader(f))
+            frame = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+
+            row_part, row_time = timed(_write_part, rows, os.path.join(folder, 'rows.csv'),
+                                       fieldnames, row_wrangler)
+            batch_part, batch_time = timed(_write_part, frame, os.path.join(folder, 'batch.csv'),
+                                           fieldnames, batch_wrangler, batched=True)
+            assert filecmp.cmp(row_part, batch_part, shallow=False), \
+                'Batch wrangler output differs for {}'.format(table_name)
+            print('{}: row {:.0f} rows/s, batch {:.0f} rows/s, speed-up x{:.1f} (outputs identical)'.format(
+                table_name, n_rows / row_time, n_rows / batch_time, row_time / batch_time))
+
+
+def benchmark_vector_parsing(n_rows: int):
+    """
+    Compare the bulk vector parser against parsing each string with float() per element
+    """
+    strings = make_sigir_frame('sku_to_content', n_rows)['description_vector'].tolist()
+
+    def parse_rows():
+        return [np.array([float(x) if x.strip() else np.nan for x in s.strip('[] ').split(',')])
+                if s.strip('[] ') else np.array([]) for s in strings]
+
+    rows, row_time = timed(parse_rows)
+    (vectors, lengths), bulk_time = timed(parse_vectors, strings)
+    for row, vector, length in zip(rows, vectors, lengths):
+        assert length == len(row) and np.allclose(vector[:length], row, equal_nan=True)
+        assert np.isnan(vector[length:]).all()
+    print('row: {:.0f} rows/s, bulk: {:.0f} rows/s, speed-up x{:.1f}, {} NaN elements, {:.1f} MB float32'.format(
+        n_rows / row_time, n_rows / bulk_time, row_time / bulk_time,
+        int(np.isnan(vectors).sum() - (vectors.shape[1] - lengths).sum()), vectors.nbytes / 2 ** 20))
+
+
+def benchmark_query_hashing(n_rows: int, dims: tuple = (50, 512)):
+    """
+    Compare batched, memoized query hashing against parsing and hashing each row, for the
+    SIGIR query size and for larger vectors. Memoized row hashing (_query_hash) shows how much
+    of the speed-up comes from hashing each distinct query once
+    """
+    from wrangle import wranglers
+
+    for n_dims in dims:
+        rng = np.random.default_rng(42)
+        # queries repeat across sessions
+        strings = pd.Series(_vectors(rng, n_rows, n_dims, distinct=max(n_rows // 10, 1)))
+
+        def hash_rows():
+            return [hashlib.sha256(np.array([float(x) if x.strip() else np.nan for x in s.strip('[] ').split(',')])
+                                   if s.strip('[] ') else np.array([])).hexdigest() for s in strings]
+
+        digests, row_time = timed(hash_rows)
+        wranglers.QUERY_HASHES.clear()
+        batch_digests, batch_time = timed(wranglers._query_hashes, strings)
+        assert batch_digests.tolist() == digests
+        wranglers.QUERY_HASHES.clear()
+        wranglers.QUERY_HASHES.clear()
+        memoized_digests, memoized_time = timed(lambda: [wranglers._query_hash(s) for s in strings])
+        assert memoized_digests == digests
+        print('{} dims, {} distinct queries: row {:.0f} rows/s, memoized row {:.0f} rows/s (x{:.1f}), '
+              'batch {:.0f} rows/s (x{:.1f}) (identical digests)'.format(
+                n_dims, strings.nunique(), n_rows / row_time, n_rows / memoized_time, row_time / memoized_time,
+                n_rows / batch_time, row_time / batch_time))
+
+
+BENCHMARKS = {
+    'hashing': benchmark_query_hashing,
+    'vectors': benchmark_vector_parsing,
+    'wranglers': benchmark_wranglers
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args.rows)
@@ -0,0 +1,86 @@
+import csv
+import glob
+import gzip
+import os
+import re
+import shutil
+
+
+class LocalNamespaceConnection:
+    """
+    A local stand-in for SFSelfClosingNamespaceConnection, to run and test the upload
+    without a Snowflake account. Tables are csv files in a local folder, and each table
+    has a stage folder where files are PUT before being copied into the table.
+
+    Implemented to be used with the with keyword.
+
+    Methods
+    -------
+    execute(command)
+        Records a command; CREATE OR REPLACE TABLE empties the table and its stage.
+
+    upload_file(absolute_file_path, table)
+        Uploads all files matching the absolute_file_path pattern to table.
+
+    put_file(absolute_file_path, table)
+        Copies all files matching the absolute_file_path pattern to the table stage.
+
+    copy_into(table)
+        Appends the rows of the staged files not loaded yet to the table csv file.
+
+    read_table(table)
+        Returns the rows of table as lists of strings.
+    """
+    def __init__(self, folder):
+        self._folder = folder
+        self.commands = []
+        self._loaded = {}
+
+    def __enter__(self):
+        os.makedirs(self._folder, exist_ok=True)
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        pass
+
+    def _table_path(self, table):
+        return os.path.join(self._folder, f"{table.lower()}.csv")
+
+    def _stage_path(self, table):
+        return os.path.join(self._folder, f"stage_{table.lower()}")
+
+    def execute(self, command):
+        self.commands.append(command)
+        match = re.match(r"\s*CREATE\s+OR\s+REPLACE\s+TABLE\s+(\w+)", command, re.IGNORECASE)
+        if match:
+            table = match.group(1)
+            open(self._table_path(table), 'w').close()
+            shutil.rmtree(self._stage_path(table), ignore_errors=True)
+            os.makedirs(self._stage_path(table))
+            self._loaded[table.lower()] = set()
+
+    def upload_file(self, absolute_file_path, table):
+        self.put_file(absolute_file_path, table)
+        self.copy_into(table)
+
+    def put_file(self, absolute_file_path, table):
+        self.commands.append(f"PUT file://{absolute_file_path} @%{table}")
+        for file_path in glob.glob(absolute_file_path):
+            shutil.copy(file_path, self._stage_path(table))
+
+    def copy_into(self, table):
+        self.commands.append(f"COPY INTO {table}")
+        # as in Snowflake, files already loaded from the stage are skipped
+        loaded = self._loaded[table.lower()]
+        with open(self._table_path(table), 'a', newline='') as table_file:
+            for file_path in sorted(glob.glob(os.path.join(self._stage_path(table), '*'))):
+                if file_path in loaded:
+                    continue
+                opener = gzip.open if file_path.endswith('.gz') else open
+                with opener(file_path, 'rt', newline='') as staged_file:
+                    shutil.copyfileobj(staged_file, table_file)
+                loaded.add(file_path)
+
+    def read_table(self, table):
+        with open(self._table_path(table), newline='') as table_file:
+            return list(csv.reader(table_file))
@@ -27,6 +27,18 @@ class SFSelfClosingNamespaceConnection:
 
     upload_file(absolute_file_path, table)
         Uploads all files matching the absolute_file_path pattern to table.
+
+    put_file(absolute_file_path, table)
+        Stages all files matching the absolute_file_path pattern in the table stage.
+
+    copy_into(table)
+        Loads the staged files into table.
+
+    fetch_arrow_batches(command)
+        Executes a query and yields its result as Arrow tables, one per result batch.
+
+    session_action_batches(table)
+        Yields the normalized actions of the sessions in table, one list per result batch.
     """
     def __init__(self, warehouse, database, schema):
         self._ctx = None
@@ -74,13 +86,37 @@ class SFSelfClosingNamespaceConnection:
         self._cs.executemany(command, seq_of_parameters)
 
     def upload_file(self, absolute_file_path, table):
+        self.put_file(absolute_file_path, table)
+        self.copy_into(table)
+
+    def put_file(self, absolute_file_path, table):
+        # gzipped files are detected and staged as they are, the others are compressed by PUT
+        self._cs.execute(f"PUT file://{absolute_file_path} @%{table}")
+
+    def copy_into(self, table):
         self._cs.execute(f"CREATE OR REPLACE FILE FORMAT ESCAPED_DQ TYPE = CSV "
                          "RECORD_DELIMITER = '\\n' "
                          "FIELD_OPTIONALLY_ENCLOSED_BY = '\\\"' "
                          "COMMENT = 'for loading objects from csv'")
-        self._cs.execute(f"PUT file://{absolute_file_path} @%{table}")
         self._cs.execute(f"COPY INTO {table} "
                          "FILE_FORMAT = ESCAPED_DQ")
 
+    def fetch_arrow_batches(self, command):
+        self._cs.execute(command)
+        # result batches are downloaded as they are consumed, the result set is never held in memory at once
+        yield from self._cs.fetch_arrow_batches()
+
+    def session_action_batches(self, table='cart_sessions'):
+        # only normalized_action is projected out of the events arrays, server side, as comma-separated
+        # strings in event order (one row per session)
+        query = (
+            "SELECT LISTAGG(e.value:normalized_action::STRING, ',') WITHIN GROUP (ORDER BY e.index) AS actions "
+            f"FROM {table} s, LATERAL FLATTEN(input => s.events) e "
+            "GROUP BY e.seq "
+            "ORDER BY e.seq"
+        )
+        for batch in self.fetch_arrow_batches(query):
+            yield batch.column('ACTIONS').to_pylist()
+
     def dict_get_all(self):
         return self._d_cs.execute('select events from cart_sessions').fetchall()
@@ -1,6 +1,8 @@
 import csv
 import itertools
 
+import pandas as pd
+
 
 class SigirBatchedGenerator:
     """
@@ -15,6 +17,9 @@ class SigirBatchedGenerator:
     get_batches(batch_size=1000)
     Yields batches of # {batch_size} lines.
 
+    get_frames(batch_size=1000)
+    Yields batches of # {batch_size} lines as dataframes of strings.
+
     """
 
     def __init__(self, filename):
@@ -45,6 +50,15 @@ class SigirBatchedGenerator:
                 elements_remaining = False
             yield batch
 
+    def get_frames(self, batch_size=1000):
+        """
+        Yields batches of # {batch_size} lines as dataframes, for the batch wranglers.
+        Values are read as strings, with empty strings for missing values, as in csv.DictReader.
+        :param batch_size: number of lines to read in a batch (default 1000)
+        :return: yields dataframes until exhausted.
+        """
+        yield from pd.read_csv(self._file, chunksize=batch_size, dtype=str, keep_default_na=False)
+
     def get_columns(self):
         """
         To get header/column names from file.
@@ -1,11 +1,15 @@
 import csv
+import gzip
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 
-
+from connectors.local_connector import LocalNamespaceConnection
 from connectors.sf_connector import SFSelfClosingNamespaceConnection
 from data_loaders.sigir_data_loader import SigirBatchedGenerator
 from data_models.tables import browsing_train_table, sku_to_content_table, search_train_table
-from wrangle.wranglers import sku_wrangler, browsing_wrangler, search_wrangler
+from wrangle import wranglers
+from wrangle.wranglers import sku_wrangler, browsing_wrangler, search_wrangler, \
+    sku_batch_wrangler, browsing_batch_wrangler, search_batch_wrangler
 
 #load env
 try:
@@ -15,18 +19,89 @@ except Exception as e:
     print(e)
 
 
-def write_chunks(table, filepath, conn, batch_size, max_batches=float('inf'), value_parser=lambda x: x):
+def _write_part(batch, output_file, fieldnames, value_parser, compress=False, batched=False):
+    """
+    "Unprocess" a batch of rows with the wrangler and write them to a csv part.
+
+    :param batch: list of row dicts, or a dataframe if batched, as read by SigirBatchedGenerator
+    :param output_file: path of the csv part
+    :param fieldnames: columns of the target table
+    :param value_parser: Logic (wrangler) to "unprocess" data
+    :param compress: if True, the part is gzipped (output_file should end with .gz)
+    :param batched: if True, value_parser is a batch wrangler, taking and returning a dataframe
+    :return: path of the csv part
+    """
+    # fast compression: parts are only staged, and wrangling should stay the bottleneck
+    file = gzip.open(output_file, 'wt', newline='', compresslevel=1) if compress else open(output_file, 'w', newline='')
+    with file:
+        print("writing", output_file)
+        if batched:
+            file.write(_csv_lines(value_parser(batch)[fieldnames]))
+            return output_file
+        writer = csv.DictWriter(file, fieldnames=fieldnames)
+        values = []
+        for b in batch:
+            v = value_parser(b)
+            if isinstance(v, list):
+                values.extend(v)
+            elif isinstance(v, dict):
+                values.append(v)
+        writer.writerows(values)
+    return output_file
+
+
+def _csv_lines(frame):
+    """
+    Format a dataframe of strings as csv.writer does (minimal quoting, \\r\\n line endings),
+    column by column instead of row by row.
+
+    :param frame: dataframe of strings
+    :return: csv text, without header
+    """
+    if len(frame) == 0:
+        return ''
+    columns = []
+    for _, values in frame.items():
+        values = values.astype(str)
+        special = values.str.contains('[",\\r\\n]', regex=True)
+        if special.any():
+            values = values.where(~special, '"' + values.str.replace('"', '""', regex=False) + '"')
+        columns.append(values)
+    lines = columns[0].str.cat(columns[1:], sep=',')
+    return '\r\n'.join(lines.tolist()) + '\r\n'
+
+
+def _identity(row):
+    # module-level, so that it can be pickled to the worker processes
+    return row
+
+
+def _init_worker(org_id):
+    # workers share the ORG_ID of the main process, which is random per import
+    wranglers.ORG_ID = org_id
+
+
+def write_chunks(table, filepath, conn, batch_size, max_batches=float('inf'), value_parser=_identity,
+                 n_workers=1, compress=False, batched=False):
     """
     Main function to read in csv files in batch and upload the content to snowflake after
     "unprocessing" the data. This method will create a temporary folder and store the "unprocessed"
     documents in csv format in order to then use SNowflakes csv upload capability.
 
+    With n_workers > 1 the upload is pipelined: batches are wrangled and written in parallel by a pool of
+    processes, each part is staged as soon as it is written, while later parts are still being produced,
+    and the staged parts are loaded with a single COPY at the end.
+
     :param table: name of the table to upload to
     :param filepath: path to the source csv files
-    :param conn: configured SFSelfClosingNamespaceConnection
+    :param conn: configured SFSelfClosingNamespaceConnection (or LocalNamespaceConnection)
     :param batch_size: number of lines per read batch (this is to manage memory usage)
     :param max_batches: max number of batches to process in a file (defaults to processing all)
     :param value_parser: Logic (wrangler) to "unprocess" data. (default: identity transformation)
+    :param n_workers: number of processes wrangling batches (default 1: no pipelining)
+    :param compress: if True, parts are written as gzipped csv files
+    :param batched: if True, batches are read as dataframes and value_parser is a batch wrangler
+        (e.g. browsing_batch_wrangler)
     :return: None
     """
 
@@ -34,30 +109,47 @@ def write_chunks(table, filepath, conn, batch_size, max_batches=float('inf'), va
     fieldnames = [name for name, _ in table['columns']]
     columns = ", ".join([f"{name} {datatype}" for name, datatype in table['columns']])
     table_name = table['name']
+    create_string = (
+        f"CREATE OR REPLACE TABLE {table_name}("
+        f"{columns})"
+    )
+    extension = '.csv.gz' if compress else '.csv'
     with tempfile.TemporaryDirectory() as tmpdirname:
         output_prefix = f"{tmpdirname}/batch"
-        with SigirBatchedGenerator(filepath) as data:
-            for i, batch in enumerate(data.get_batches(batch_size)):
-                if i >= max_batches:
-                    break
-                output_file = f"{output_prefix}{i}.csv"
-                with open(output_file, 'w') as file:
-                    print("writing", output_file)
-                    writer = csv.DictWriter(file, fieldnames=fieldnames)
-                    values = []
-                    for b in batch:
-                        v = value_parser(b)
-                        if isinstance(v, list):
-                            values.extend(v)
-                        elif isinstance(v, dict):
-                            values.append(v)
-                    writer.writerows(values)
-        create_string = (
-            f"CREATE OR REPLACE TABLE {table_name}("
-            f"{columns})"
-        )
+        if n_workers <= 1:
+            with SigirBatchedGenerator(filepath) as data:
+                batches = data.get_frames(batch_size) if batched else data.get_batches(batch_size)
+                for i, batch in enumerate(batches):
+                    if i >= max_batches:
+                        break
+                    _write_part(batch, f"{output_prefix}{i}{extension}", fieldnames, value_parser, compress, batched)
+            conn.execute(create_string)
+            conn.upload_file(f"{output_prefix}*", table_name)
+            return
+
         conn.execute(create_string)
-        conn.upload_file(f"{output_prefix}*", table_name)
+        uploads = []
+        # a single upload thread, as the connection cursor is not shared between threads
+        with ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=(wranglers.ORG_ID,)) as pool, \
+                ThreadPoolExecutor(1) as uploader, \
+                SigirBatchedGenerator(filepath) as data:
+            pending = set()
+            batches = data.get_frames(batch_size) if batched else data.get_batches(batch_size)
+            for i, batch in enumerate(batches):
+                if i >= max_batches or len(batch) == 0:
+                    break
+                # bound the batches held in memory: wait for a part when all workers have a queued batch
+                if len(pending) >= 2 * n_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    uploads.extend(uploader.submit(conn.put_file, future.result(), table_name) for future in done)
+                pending.add(pool.submit(_write_part, batch, f"{output_prefix}{i}{extension}",
+                                        fieldnames, value_parser, compress, batched))
+            uploads.extend(uploader.submit(conn.put_file, future.result(), table_name)
+                           for future in as_completed(pending))
+            # raise upload errors, if any
+            for upload in uploads:
+                upload.result()
+        conn.copy_into(table_name)
 
 
 if __name__ == "__main__":
@@ -73,26 +165,44 @@ if __name__ == "__main__":
     search_train = f"{data_path}/search_train.csv"
     sku_to_content = f"{data_path}/sku_to_content.csv"
 
+    n_workers = int(os.getenv("UPLOAD_WORKERS", 1))
+    compress = os.getenv("UPLOAD_COMPRESS", '0') == '1'
+    # vectorized wranglers over dataframe batches, same rows as the row-by-row ones
+    batched = os.getenv("BATCH_WRANGLERS", '0') == '1'
+    # dry run: tables are written as csv files in a local folder instead of Snowflake
+    local_folder = os.getenv("SNOWFLAKE_LOCAL_FOLDER")
+
     # upload all files
-    with SFSelfClosingNamespaceConnection(warehouse, database, schema) as sf_con:
+    connection = LocalNamespaceConnection(local_folder) if local_folder \
+        else SFSelfClosingNamespaceConnection(warehouse, database, schema)
+    with connection as sf_con:
         print(sku_to_content)  # print filepath for sanity check
         write_chunks(table=sku_to_content_table,
                      filepath=sku_to_content,
                      conn=sf_con,
                      batch_size=config_batch_size,
                      max_batches=config_max_batches,
-                     value_parser=sku_wrangler)
+                     value_parser=sku_batch_wrangler if batched else sku_wrangler,
+                     n_workers=n_workers,
+                     compress=compress,
+                     batched=batched)
         print(search_train)
         write_chunks(table=search_train_table,
                      filepath=search_train,
                      conn=sf_con,
                      batch_size=config_batch_size,
                      max_batches=config_max_batches,
-                     value_parser=search_wrangler)
+                     value_parser=search_batch_wrangler if batched else search_wrangler,
+                     n_workers=n_workers,
+                     compress=compress,
+                     batched=batched)
         print(browsing_train)
         write_chunks(table=browsing_train_table,
                      filepath=browsing_train,
                      conn=sf_con,
                      batch_size=config_batch_size,
                      max_batches=config_max_batches,
-                     value_parser=browsing_wrangler)
+                     value_parser=browsing_batch_wrangler if batched else browsing_wrangler,
+                     n_workers=n_workers,
+                     compress=compress,
+                     batched=batched)
@@ -0,0 +1,64 @@
+"""
+
+Tests for the pipelined upload of write_chunks, against LocalNamespaceConnection (no Snowflake account needed).
+
+Usage: python -m pytest test_push_data_to_sf.py
+
+"""
+import os
+import csv
+import glob
+
+from benchmarks import make_sigir_frame
+from connectors.local_connector import LocalNamespaceConnection
+from data_models.tables import browsing_train_table
+from push_data_to_sf import write_chunks
+from wrangle.wranglers import browsing_wrangler
+
+N_ROWS = 1000
+BATCH_SIZE = 100
+
+
+def _upload(folder, table, source, **kwargs):
+    """
+    Upload source to a local table and return the connection, with its recorded commands
+    """
+    with LocalNamespaceConnection(str(folder)) as conn:
+        write_chunks(table=table, filepath=source, conn=conn, batch_size=BATCH_SIZE, **kwargs)
+    return conn
+
+
+def test_pipelined_upload_matches_serial_upload(tmp_path):
+    source = str(tmp_path / 'browsing_train.csv')
+    make_sigir_frame('browsing_train', N_ROWS).to_csv(source, index=False)
+    table_name = browsing_train_table['name']
+
+    serial = _upload(tmp_path / 'serial', browsing_train_table, source, value_parser=browsing_wrangler)
+    pipelined = _upload(tmp_path / 'pipelined', browsing_train_table, source, value_parser=browsing_wrangler,
+                        n_workers=2, compress=True)
+
+    # table created first, every part staged before a single COPY at the end
+    commands = [command.split()[0] for command in pipelined.commands]
+    n_parts = N_ROWS // BATCH_SIZE
+    assert commands == ['CREATE'] + ['PUT'] * n_parts + ['COPY']
+    # parts are staged gzipped
+    staged = glob.glob(os.path.join(str(tmp_path / 'pipelined'), 'stage_{}'.format(table_name), '*'))
+    assert len(staged) == n_parts
+    assert all(path.endswith('.csv.gz') for path in staged)
+    # same rows as the serial upload
+    rows = pipelined.read_table(table_name)
+    assert len(rows) == N_ROWS
+    assert sorted(rows) == sorted(serial.read_table(table_name))
+
+
+def test_pipelined_upload_with_default_value_parser(tmp_path):
+    # a table with the columns of the source file, uploaded as is
+    table = {'name': 'copy_raw', 'columns': [('session_id_hash', 'CHAR(64)'), ('hashed_url', 'CHAR(64)')]}
+    source = str(tmp_path / 'copy.csv')
+    make_sigir_frame('browsing_train', N_ROWS)[['session_id_hash', 'hashed_url']].to_csv(source, index=False)
+
+    conn = _upload(tmp_path / 'pipelined', table, source, n_workers=2)
+
+    with open(source, newline='') as f:
+        expected = list(csv.reader(f))[1:]
+    assert sorted(conn.read_table(table['name'])) == sorted(expected)
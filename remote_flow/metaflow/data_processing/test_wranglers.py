@@ -0,0 +1,103 @@
+"""
+
+Golden tests for the batch wranglers: the csv parts they write must be byte-identical to the parts written
+with the row wranglers, on small SIGIR fixtures with edge cases (empty vectors, empty sku lists, values with
+quotes and backslashes).
+
+Usage: python -m pytest test_wranglers.py
+
+"""
+import csv
+import gzip
+import pytest
+
+from data_loaders.sigir_data_loader import SigirBatchedGenerator
+from data_models.tables import browsing_train_table, search_train_table, sku_to_content_table
+from push_data_to_sf import _write_part
+from wrangle.wranglers import browsing_wrangler, search_wrangler, sku_wrangler, \
+    browsing_batch_wrangler, search_batch_wrangler, sku_batch_wrangler
+
+SESSION = '7f4f0a6b2d5e4c3a9b8e1d2c3b4a5f6e7d8c9b0a1f2e3d4c5b6a7f8e9d0c1b2a'
+SKU = 'a1b2c3d4e5f6a7b8c9d0e1f2a3b4c5d6e7f8a9b0c1d2e3f4a5b6c7d8e9f0a1b2'
+
+BROWSING_ROWS = [
+    {'session_id_hash': SESSION, 'event_type': 'event_product', 'product_action': 'detail',
+     'product_sku_hash': SKU, 'server_timestamp_epoch_ms': '1550885210881', 'hashed_url': 'url_1'},
+    {'session_id_hash': SESSION, 'event_type': 'pageview', 'product_action': '',
+     'product_sku_hash': '', 'server_timestamp_epoch_ms': '1550885213307', 'hashed_url': ''},
+    # quotes, backslashes and separators go through repr, then csv quoting
+    {'session_id_hash': SESSION, 'event_type': 'event_product', 'product_action': "it's",
+     'product_sku_hash': 'say "hi"', 'server_timestamp_epoch_ms': '1550885215000', 'hashed_url': 'a\\b,c'},
+    {'session_id_hash': SESSION, 'event_type': 'event_product', 'product_action': 'add',
+     'product_sku_hash': '\'both\' "quotes"', 'server_timestamp_epoch_ms': '1550885216000',
+     'hashed_url': 'tab\\tand\\n'}
+]
+
+SEARCH_ROWS = [
+    {'session_id_hash': SESSION, 'query_vector': '[0.1, 0.2, 0.3]', 'clicked_skus_hash': '',
+     'product_skus_hash': "['{}', 'sku_2']".format(SKU), 'server_timestamp_epoch_ms': '1550885210881'},
+    # empty sku lists and empty vectors
+    {'session_id_hash': SESSION, 'query_vector': '[]', 'clicked_skus_hash': '',
+     'product_skus_hash': '[]', 'server_timestamp_epoch_ms': '1550885210882'},
+    {'session_id_hash': SESSION, 'query_vector': '', 'clicked_skus_hash': '',
+     'product_skus_hash': '', 'server_timestamp_epoch_ms': '1550885210883'},
+    # missing elements, repeated query, quotes and backslashes in skus
+    {'session_id_hash': SESSION, 'query_vector': '[0.1, , 0.3]', 'clicked_skus_hash': '',
+     'product_skus_hash': "['a\\\\b', 'c\"d']", 'server_timestamp_epoch_ms': '1550885210884'},
+    {'session_id_hash': SESSION, 'query_vector': '[0.1, 0.2, 0.3]', 'clicked_skus_hash': '',
+     'product_skus_hash': "['sku_3']", 'server_timestamp_epoch_ms': '1550885210885'}
+]
+
+SKU_ROWS = [
+    {'product_sku_hash': SKU, 'description_vector': '[0.25, 0.5, 0.125]', 'category_hash': 'category_1',
+     'image_vector': '[1.5, , 2.0]', 'price_bucket': '3.0'},
+    # empty vectors
+    {'product_sku_hash': 'sku_2', 'description_vector': '', 'category_hash': '',
+     'image_vector': '[]', 'price_bucket': ''},
+    {'product_sku_hash': 'sku_3', 'description_vector': '[nan, 0.5]', 'category_hash': 'category_2',
+     'image_vector': '[ ]', 'price_bucket': "1'0\\"}
+]
+
+CASES = [
+    ('browsing_train', BROWSING_ROWS, browsing_train_table, browsing_wrangler, browsing_batch_wrangler),
+    ('search_train', SEARCH_ROWS, search_train_table, search_wrangler, search_batch_wrangler),
+    ('sku_to_content', SKU_ROWS, sku_to_content_table, sku_wrangler, sku_batch_wrangler)
+]
+
+
+def _write_source(folder, name, rows):
+    """
+    Write fixture rows as a SIGIR csv file
+    """
+    path = folder / '{}.csv'.format(name)
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    return str(path)
+
+
+@pytest.mark.parametrize('name, rows, table, row_wrangler, batch_wrangler', CASES, ids=[c[0] for c in CASES])
+@pytest.mark.parametrize('compress', [False, True])
+def test_batch_wrangler_parts_match_row_wrangler(tmp_path, name, rows, table, row_wrangler, batch_wrangler,
+                                                 compress):
+    source = _write_source(tmp_path, name, rows)
+    fieldnames = [column for column, _ in table['columns']]
+    extension = '.csv.gz' if compress else '.csv'
+    # read the batches as write_chunks does
+    with SigirBatchedGenerator(source) as data:
+        batch = next(data.get_batches(len(rows)))
+    with SigirBatchedGenerator(source) as data:
+        frame = next(data.get_frames(len(rows)))
+
+    row_part = _write_part(batch, str(tmp_path / ('rows' + extension)), fieldnames, row_wrangler, compress)
+    batch_part = _write_part(frame, str(tmp_path / ('batch' + extension)), fieldnames, batch_wrangler, compress,
+                             batched=True)
+
+    opener = gzip.open if compress else open
+    with opener(row_part, 'rb') as f:
+        expected = f.read()
+    with opener(batch_part, 'rb') as f:
+        actual = f.read()
+    assert expected
+    assert actual == expected
@@ -1,8 +1,16 @@
 import hashlib
+import re
 import uuid
+import warnings
 import numpy as np
+import pandas as pd
 
 ORG_ID = str(uuid.uuid4()) # Randomly generated ORG_ID
+# query vector string -> digest: queries repeat heavily across sessions, so each is parsed and hashed once
+QUERY_HASHES = {}
+QUERY_HASHES_MAX_SIZE = 1000000
+# separators followed by an empty element, as in "0.1,,0.3" (np.fromstring would read -1 for " ")
+EMPTY_ELEMENT = re.compile(r',(?=\s*,)')
 
 
 def browsing_wrangler(row_dict):
@@ -32,7 +40,7 @@ def search_wrangler(row_dict):
     """
 
     skus = _parse_string_to_string_array(row_dict['product_skus_hash'])
-    qs = hashlib.sha256(_parse_string_to_np_array(row_dict['query_vector'])).hexdigest()
+    qs = _query_hash(row_dict['query_vector'])
     template = {
         'session_id_hash':  row_dict['session_id_hash'],
         'server_timestamp_epoch_ms': row_dict['server_timestamp_epoch_ms'],
@@ -83,6 +91,186 @@ def sku_wrangler(row_dict):
     }
 
 
+def browsing_batch_wrangler(batch):
+    """
+    Formats DB rows for the browsing table, for a whole batch at once.
+    Same rows as browsing_wrangler, with the VARIANT column built by vectorized string ops.
+    :param batch: input rows as a dataframe of strings
+    :return: wrangled dataframe, one row per input row
+    """
+    return pd.DataFrame({
+        'session_id_hash': batch['session_id_hash'],
+        'server_timestamp_epoch_ms': batch['server_timestamp_epoch_ms'].astype('int64').astype(str),
+        'organization_id': ORG_ID,
+        'raw_browsing_event': _dict_repr([
+            ('event_type', _quoted(batch['event_type'])),
+            ('product_action', _quoted(batch['product_action'])),
+            ('product_sku_hash', _quoted(batch['product_sku_hash'])),
+            ('hashed_url', _quoted(batch['hashed_url']))
+        ])
+    })
+
+
+def search_batch_wrangler(batch):
+    """
+    Formats DB rows for the search table, for a whole batch at once.
+    Same rows as search_wrangler: product_skus_hash is exploded to one row per sku, with its rank.
+    :param batch: input rows as a dataframe of strings
+    :return: wrangled dataframe
+    """
+    batch = batch.reset_index(drop=True)
+    qs = _query_hashes(batch['query_vector'])
+    skus = batch['product_skus_hash'].str.strip('[] ')
+    # rows without skus become a single NaN row when exploded
+    skus = skus.where(skus != '').str.split(',').explode()
+    has_sku = skus.notna()
+    rank = (skus.groupby(level=0).cumcount() + 1).astype(str).where(has_sku, '')
+    product = skus.fillna('').str.strip().str.strip("' ")
+    rows = batch.loc[skus.index]
+    qs = qs.loc[skus.index]
+    return pd.DataFrame({
+        'session_id_hash': rows['session_id_hash'],
+        'server_timestamp_epoch_ms': rows['server_timestamp_epoch_ms'],
+        'organization_id': ORG_ID,
+        'query_string': qs,
+        'raw_search_event': _dict_repr([
+            ('product_sku_hash', _quoted(product)),
+            ('rank', _quoted(rank)),
+            ('query', _quoted(qs)),
+            ('query_vector', _quoted(rows['query_vector']))
+        ])
+    }).reset_index(drop=True)
+
+
+def sku_batch_wrangler(batch):
+    """
+    Formats DB rows for the sku to content table, for a whole batch at once.
+    Same rows as sku_wrangler.
+    :param batch: input rows as a dataframe of strings
+    :return: wrangled dataframe, one row per input row
+    """
+    metadata = _dict_repr([
+        ('item_vector', _float_arrays_repr(batch['description_vector'])),
+        ('image_vector', _float_arrays_repr(batch['image_vector'])),
+        ('price_bucket', _quoted(batch['price_bucket']))
+    ])
+    return pd.DataFrame({
+        'product_sku_hash': batch['product_sku_hash'],
+        'ingestion_timestamp_epoch_ms': '1622855987',
+        'organization_id': ORG_ID,
+        'metadata': metadata
+    })
+
+
+def parse_vectors(strings, dims=None, dtype=np.float32):
+    """
+    Parse a column of vector strings ("[0.1, 0.2, ...]") into a 2D array at once: the strings are joined
+    into one buffer, parsed in C by np.fromstring. Empty elements are NaN, as in _parse_string_to_np_array,
+    and rows shorter than dims (e.g. empty vectors) are padded with NaN.
+    :param strings: sequence of vector strings (empty strings or None for missing vectors)
+    :param dims: number of columns (default: length of the longest vector)
+    :param dtype: dtype of the output; float64 gives the same values as _parse_string_to_np_array
+    :return: (n, dims) array, and the number of elements of each vector
+    """
+    stripped = [string.strip('[] ') if string else '' for string in strings]
+    lengths = np.array([string.count(',') + 1 if string else 0 for string in stripped], dtype=np.int64)
+    values = np.empty(0)
+    if lengths.sum() > 0:
+        # padded with separators, so that empty first and last elements are followed by one
+        text = EMPTY_ELEMENT.sub(',nan', ',' + ','.join(string for string in stripped if string) + ',')[1:-1]
+        try:
+            with warnings.catch_warnings():
+                # numpy returns a truncated array (with a warning) for unparsable buffers
+                warnings.simplefilter('error')
+                values = np.fromstring(text, dtype=np.float64, sep=',')
+        except (ValueError, DeprecationWarning):
+            values = np.empty(0)
+        if len(values) != lengths.sum():
+            # not plain floats: parse element by element, raising on invalid elements as float() does
+            values = np.array([float(x) if x.strip() else np.nan
+                               for string in stripped if string for x in string.split(',')], dtype=np.float64)
+    dims = int(lengths.max(initial=0)) if dims is None else dims
+    vectors = np.full((len(stripped), dims), np.nan, dtype=dtype)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    columns = np.arange(len(values)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    keep = columns < dims
+    vectors[rows[keep], columns[keep]] = values[keep]
+    return vectors, lengths
+
+
+def _quoted(values):
+    """
+    repr() of a column of strings: printable ASCII strings without quotes or backslashes
+    are only wrapped in single quotes, the others go through repr
+    """
+    quoted = "'" + values + "'"
+    special = values.str.contains(r"[^ -~]|['\\]", regex=True)
+    if special.any():
+        quoted = quoted.where(~special, values[special].map(repr))
+    return quoted
+
+
+def _dict_repr(items):
+    """
+    str() of a dict, column-wise: items are (key, column of value reprs) pairs
+    """
+    result = "{"
+    for i, (key, values) in enumerate(items):
+        result = result + ("" if i == 0 else ", ") + repr(key) + ": " + values
+    return result + "}"
+
+
+def _float_array_repr(string):
+    return str(_parse_string_to_float_array(string))
+
+
+def _float_arrays_repr(values):
+    """
+    str() of _parse_string_to_float_array for a column of vector strings
+    """
+    vectors, lengths = parse_vectors(values.tolist(), dtype=np.float64)
+    # literal NaNs are kept as floats by _parse_string_to_float_array, unlike empty elements
+    literal_nans = values.str.contains('nan', case=False, regex=False).tolist()
+    return pd.Series([_float_array_repr(string) if literal_nan else
+                      str([x if x == x else 'NaN' for x in vector[:length].tolist()])
+                      for string, vector, length, literal_nan in zip(values, vectors, lengths, literal_nans)],
+                     index=values.index)
+
+
+def _query_hash(string):
+    digest = QUERY_HASHES.get(string)
+    if digest is None:
+        digest = hashlib.sha256(_parse_string_to_np_array(string)).hexdigest()
+        _memoize_query_hashes({string: digest})
+    return digest
+
+
+def _query_hashes(values):
+    """
+    _query_hash for a column of query vector strings: only the strings not seen yet in the file are parsed,
+    as one matrix, and hashed. Digests are the same as _query_hash.
+    """
+    digests = {string: QUERY_HASHES.get(string) for string in pd.unique(values)}
+    missing = [string for string, digest in digests.items() if digest is None]
+    if missing:
+        vectors, lengths = parse_vectors(missing, dtype=np.float64)
+        new_digests = dict(zip(missing, _hash_rows(vectors, lengths)))
+        _memoize_query_hashes(new_digests)
+        digests.update(new_digests)
+    return values.map(digests)
+
+
+def _hash_rows(vectors, lengths):
+    return [hashlib.sha256(vector[:length]).hexdigest() for vector, length in zip(vectors, lengths)]
+
+
+def _memoize_query_hashes(digests):
+    # bounded memory: start over when full
+    if len(QUERY_HASHES) + len(digests) > QUERY_HASHES_MAX_SIZE:
+        QUERY_HASHES.clear()
+    QUERY_HASHES.update(digests)
+
+
 def _parse_string_to_float_array(string):
     if not string:
         return []
@@ -0,0 +1,441 @@
+"""
+
+Local equivalents of the dbt models, with pandas and Arrow, to run, test and benchmark the transforms without
+Snowflake. The models run in dependency order, from the SIGIR browsing_train file (.csv or .parquet):
+
+browsing_flattened -> distinct_events -> session_stats -> sessions -> cart_sessions
+                                      -> cart_session_actions
+
+The check command also replays the SQL of cart_session_actions itself on sqlite (Snowflake functions rewritten
+to their sqlite equivalents), and checks it against the local models on sessions including edge cases.
+
+Usage:
+    python local_models.py run <browsing_train.csv> <output_folder>
+    python local_models.py benchmark --rows 100000 1000000
+    python local_models.py check --rows 100000
+
+"""
+import os
+import re
+import time
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from prepare_dataset import Actions, ACTION_VALUES, UNKNOWN_ACTION, decode_action_codes, prepare_training_arrays
+
+
+DBT_MODELS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dbt', 'models', 'public')
+SESSION_KEYS = ['session_id_hash', 'organization_id']
+# fields of the event objects of the sessions model
+EVENT_FIELDS = ['normalized_action', 'event_type', 'product_action', 'product_sku_hash', 'hashed_url',
+                'server_timestamp']
+
+
+def read_browsing_train(file_path: str):
+    """
+    Read the SIGIR browsing_train file, .csv or .parquet (as uploaded by local_dataset_upload.py)
+    """
+    if file_path.endswith('.parquet'):
+        return pd.read_parquet(file_path)
+    return pd.read_csv(file_path, dtype={'server_timestamp_epoch_ms': np.int64})
+
+
+def browsing_flattened(browsing_train: pd.DataFrame, organization_id: str = 'local'):
+    """
+    Same transform as the browsing_flattened dbt model, from the SIGIR columns: the raw table only adds the
+    organization id, and the timestamp is loaded as a datetime
+
+    :param browsing_train: SIGIR browsing_train rows
+    :param organization_id: organization id of the events
+    :return: flattened browsing events
+    """
+    return pd.DataFrame({
+        'session_id_hash': browsing_train['session_id_hash'],
+        'organization_id': organization_id,
+        'server_timestamp': pd.to_datetime(browsing_train['server_timestamp_epoch_ms'], unit='ms'),
+        'event_type': browsing_train['event_type'],
+        'product_action': browsing_train['product_action'],
+        'product_sku_hash': browsing_train['product_sku_hash'],
+        'hashed_url': browsing_train['hashed_url']
+    })
+
+
+def distinct_events(browsing: pd.DataFrame):
+    """
+    Same transform as the distinct_events dbt model: for each session and timestamp, FIRST_VALUE(event_type)
+    ordered by event_type (NULLs last) is the smallest non-null event type, and the events of that type are
+    joined back on (session, timestamp, event type). Events with a NULL event type never match the join key.
+
+    :param browsing: browsing_flattened events
+    :return: events with normalized_action
+    """
+    # min over sorted integer codes of the event types, NULLs last
+    event_type_code, _ = pd.factorize(browsing['event_type'], sort=True)
+    event_type_code = np.where(event_type_code < 0, np.iinfo(np.int64).max, event_type_code)
+    first_event_type_code = pd.Series(event_type_code, index=browsing.index) \
+        .groupby([browsing[key] for key in SESSION_KEYS + ['server_timestamp']], sort=False).transform('min')
+    events = browsing[(event_type_code == first_event_type_code.to_numpy()) & browsing['event_type'].notna().to_numpy()]
+    return pd.DataFrame({
+        'session_id_hash': events['session_id_hash'],
+        'server_timestamp': events['server_timestamp'],
+        'organization_id': events['organization_id'],
+        'event_type': events['event_type'],
+        'product_action': events['product_action'],
+        'product_sku_hash': events['product_sku_hash'],
+        'hashed_url': events['hashed_url'],
+        'normalized_action': events['product_action'].where(events['event_type'] != 'pageview', 'pageview')
+    }).reset_index(drop=True)
+
+
+def session_stats(events: pd.DataFrame):
+    """
+    Same transform as the session_stats dbt model
+
+    :param events: distinct_events events
+    :return: one row of stats per session
+    """
+    timestamps = events['server_timestamp']
+    stats = events.assign(
+        timestamp_ms=timestamps.to_numpy().astype('datetime64[ms]').astype(np.int64),
+        add_count=(events['normalized_action'] == 'add').astype(np.int64)
+    ).groupby(SESSION_KEYS, sort=True).agg(
+        start_time=('server_timestamp', 'min'),
+        end_time=('server_timestamp', 'max'),
+        start_ms=('timestamp_ms', 'min'),
+        end_ms=('timestamp_ms', 'max'),
+        session_action_count=('server_timestamp', 'count'),
+        add_action_count=('add_count', 'sum')
+    ).reset_index()
+    # timediff(second, ...) counts the second boundaries between the two timestamps
+    stats['session_time'] = stats['end_ms'] // 1000 - stats['start_ms'] // 1000
+    return stats[SESSION_KEYS + ['start_time', 'end_time', 'session_time', 'session_action_count',
+                                 'add_action_count']]
+
+
+def sessions(events: pd.DataFrame, stats: pd.DataFrame):
+    """
+    Same transform as the sessions dbt model: the events of each session, by timestamp, as an Arrow list of
+    structs (ARRAY_AGG of OBJECT_CONSTRUCT; NULL values are null fields instead of missing keys)
+
+    :param events: distinct_events events
+    :param stats: session_stats rows
+    :return: Arrow table with session_id_hash, organization_id, events, start_time, end_time, add_action_count
+        and session_action_count, by start time
+    """
+    events = events.sort_values(SESSION_KEYS + ['server_timestamp'], kind='mergesort')
+    keys = events[SESSION_KEYS].to_numpy()
+    new_session = np.r_[True, (keys[1:] != keys[:-1]).any(axis=1)] if len(keys) else np.zeros(0, dtype=bool)
+    starts = np.flatnonzero(new_session)
+    offsets = pa.array(np.r_[starts, len(events)].astype(np.int32))
+    event_structs = pa.StructArray.from_arrays([pa.array(events[field]) for field in EVENT_FIELDS],
+                                               names=EVENT_FIELDS)
+    session_events = pa.ListArray.from_arrays(offsets, event_structs)
+
+    # INNER JOIN session_stats USING (session_id_hash), ORDER BY start_time
+    session_rows = pd.DataFrame({
+        'session_id_hash': events['session_id_hash'].to_numpy()[starts],
+        'organization_id': events['organization_id'].to_numpy()[starts],
+        'row': np.arange(len(starts))
+    }).merge(stats[['session_id_hash', 'start_time', 'end_time', 'add_action_count', 'session_action_count']],
+             on='session_id_hash').sort_values('start_time', kind='mergesort')
+    return pa.table({
+        'session_id_hash': pa.array(session_rows['session_id_hash']),
+        'organization_id': pa.array(session_rows['organization_id']),
+        'events': session_events.take(pa.array(session_rows['row'].to_numpy())),
+        'start_time': pa.array(session_rows['start_time']),
+        'end_time': pa.array(session_rows['end_time']),
+        'add_action_count': pa.array(session_rows['add_action_count']),
+        'session_action_count': pa.array(session_rows['session_action_count'])
+    })
+
+
+def cart_sessions(session_table: pa.Table):
+    """
+    Same transform as the cart_sessions dbt model: sessions with at least 1 add event
+    """
+    return session_table.filter(pc.greater(session_table['add_action_count'], 0))
+
+
+def cart_session_actions(distinct_events: pd.DataFrame):
+    """
+    Same transform as the cart_session_actions dbt model: labelled sessions, with one digit per action
+
+    :param distinct_events: events with session_id_hash, organization_id, server_timestamp and normalized_action
+    :return: dataframe with session_id_hash, organization_id, start_time, label and actions,
+        purchase sessions first, then abandon sessions, each by start time
+    """
+    events = distinct_events.sort_values(SESSION_KEYS + ['server_timestamp'], kind='mergesort')
+    action_code = events['normalized_action'].map(ACTION_VALUES)
+    # events are sorted by session, so each session is a contiguous block
+    session = events.groupby(SESSION_KEYS, sort=False).ngroup().to_numpy()
+    session_start = np.flatnonzero(np.diff(session, prepend=-1))
+    position = np.arange(len(events)) - session_start[session]
+    is_add = (action_code == Actions.add.value).to_numpy()
+    is_purchase = (action_code == Actions.purchase.value).to_numpy()
+    purchase_count = pd.Series(is_purchase.astype(np.int64)).groupby(session).cumsum().to_numpy()
+
+    def session_min(mask):
+        # min position per session among flagged events, NaN if none
+        return pd.Series(np.where(mask, position, np.nan)).groupby(session).transform('min').to_numpy()
+
+    first_add = session_min(is_add)
+    first_purchase = session_min(is_purchase)
+    second_purchase = session_min(is_purchase & (purchase_count == 2))
+    purchase_session = first_purchase > first_add
+    abandon_session = ~np.isnan(first_add) & np.isnan(first_purchase)
+    keep = abandon_session | (purchase_session
+                              & (np.isnan(second_purchase) | (position < second_purchase))
+                              & (position != first_purchase))
+    # as LISTAGG, NULL (unknown) actions are skipped
+    kept = np.flatnonzero(keep & action_code.notna().to_numpy())
+
+    # one digit per kept action, sliced per session
+    digits = (action_code.to_numpy()[kept].astype(np.uint8) + ord('0')).tobytes().decode('ascii')
+    kept_session = session[kept]
+    kept_start = np.flatnonzero(np.diff(kept_session, prepend=-1))
+    kept_end = np.r_[kept_start[1:], len(kept)]
+    first_rows = kept[kept_start]
+    session_actions = pd.DataFrame({
+        'session_id_hash': events['session_id_hash'].to_numpy()[first_rows],
+        'organization_id': events['organization_id'].to_numpy()[first_rows],
+        # start time of the whole session, not only of its kept events
+        'start_time': events['server_timestamp'].to_numpy()[session_start[session[first_rows]]],
+        'label': purchase_session[first_rows].astype(np.int8),
+        'actions': [digits[start:end] for start, end in zip(kept_start, kept_end)]
+    })
+    return session_actions.sort_values(['label', 'start_time'], ascending=[False, True], kind='mergesort') \
+        .reset_index(drop=True)
+
+
+def run_models(browsing_train: pd.DataFrame, organization_id: str = 'local', verbose: bool = True):
+    """
+    Run the model graph in dependency order
+
+    :param browsing_train: SIGIR browsing_train rows
+    :param organization_id: organization id of the events
+    :param verbose: print the time and output size of each model
+    :return: dict of model name to output, and dict of model name to seconds
+    """
+    steps = [
+        ('browsing_flattened', lambda out: browsing_flattened(browsing_train, organization_id)),
+        ('distinct_events', lambda out: distinct_events(out['browsing_flattened'])),
+        ('session_stats', lambda out: session_stats(out['distinct_events'])),
+        ('sessions', lambda out: sessions(out['distinct_events'], out['session_stats'])),
+        ('cart_sessions', lambda out: cart_sessions(out['sessions'])),
+        ('cart_session_actions', lambda out: cart_session_actions(out['distinct_events']))
+    ]
+    outputs = {}
+    timings = {}
+    for name, step in steps:
+        start = time.perf_counter()
+        outputs[name] = step(outputs)
+        timings[name] = time.perf_counter() - start
+        if verbose:
+            print('{}: {} rows in {:.2f}s'.format(name, outputs[name].num_rows if isinstance(outputs[name], pa.Table)
+                                                  else len(outputs[name]), timings[name]))
+    return outputs, timings
+
+
+def cart_session_training_data(cart_session_table: pa.Table):
+    """
+    Label the sessions of the cart_sessions model in Python, as prepare_dataset(encoded=False) does
+
+    :return: x and y, as prepare_training_data
+    """
+    session_events = pa.concat_arrays(cart_session_table['events'].chunks) if cart_session_table.num_rows \
+        else pa.array([], type=cart_session_table.schema.field('events').type)
+    offsets = np.r_[0, np.cumsum(np.diff(np.asarray(session_events.offsets)))].astype(np.int64)
+    names = session_events.flatten().field('normalized_action').to_pylist()
+    actions = np.fromiter((ACTION_VALUES.get(name, UNKNOWN_ACTION) for name in names), dtype=np.int8, count=len(names))
+    return prepare_training_arrays(actions, offsets)
+
+
+def make_browsing_train(n_rows: int, mean_session_len: int = 8, seed: int = 42):
+    """
+    Build synthetic SIGIR browsing_train rows: sessions of timestamped events, some of them logged twice at the
+    same timestamp (as pageview and event_product), which distinct_events deduplicates
+
+    :param n_rows: number of rows
+    :param mean_session_len: average number of events per session
+    :param seed: random seed
+    :return: dataframe with the SIGIR browsing_train columns
+    """
+    rng = np.random.default_rng(seed)
+    lengths = rng.geometric(1.0 / mean_session_len, size=n_rows // 2 + 1)
+    session_idx = np.repeat(np.arange(len(lengths)), lengths)[:n_rows]
+    session_start = rng.integers(1_550_000_000_000, 1_560_000_000_000, size=len(lengths))
+    step = np.where(rng.random(n_rows) < 0.1, 0, rng.integers(1, 60000, size=n_rows))
+    step[np.r_[True, session_idx[1:] != session_idx[:-1]]] = 0
+    timestamps = session_start[session_idx] + (np.cumsum(step) - np.cumsum(step)[
+        np.searchsorted(session_idx, session_idx)])
+    is_product = rng.random(n_rows) < 0.4
+    product_action = np.where(is_product, rng.choice(['detail', 'add', 'remove', 'purchase'], size=n_rows,
+                                                     p=[0.6, 0.25, 0.05, 0.1]), None)
+    skus = np.array(['{:064x}'.format(i * 2654435761) for i in range(10000)])
+    return pd.DataFrame({
+        'session_id_hash': np.char.add('session_', session_idx.astype(str)),
+        'event_type': np.where(is_product, 'event_product', 'pageview'),
+        'product_action': product_action,
+        'product_sku_hash': np.where(is_product, skus[rng.integers(0, len(skus), size=n_rows)], None),
+        'server_timestamp_epoch_ms': timestamps,
+        'hashed_url': skus[rng.integers(0, len(skus), size=n_rows)]
+    })
+
+
+def edge_case_browsing_train(start_time: int = 1_560_000_000_000):
+    """
+    browsing_train rows of sessions covering each labelling case: purchase before add (dropped), purchase after
+    add, second purchase (truncated), abandon, no add (dropped)
+
+    :param start_time: epoch ms of the first event
+    :return: dataframe with the SIGIR browsing_train columns
+    """
+    cases = {
+        'purchase_before_add': ['purchase', 'add', 'detail'],
+        'purchase_after_add': ['detail', 'add', 'view', 'purchase', 'view'],
+        'two_purchases': ['add', 'purchase', 'detail', 'add', 'purchase', 'view'],
+        'abandon': ['view', 'add', 'remove', 'view'],
+        'no_add': ['view', 'detail', 'purchase']
+    }
+    rows = [{
+        'session_id_hash': 'edge_' + name,
+        'event_type': 'pageview' if action == 'view' else 'event_product',
+        'product_action': None if action == 'view' else action,
+        'product_sku_hash': None,
+        'server_timestamp_epoch_ms': start_time + 1000 * idx,
+        'hashed_url': None
+    } for name, actions in cases.items() for idx, action in enumerate(actions)]
+    return pd.DataFrame(rows)
+
+
+class _OrderedListAgg:
+    """
+    sqlite aggregate for LISTAGG(value, delimiter) WITHIN GROUP (ORDER BY key): NULL values are skipped
+    """
+    def __init__(self):
+        self.items = []
+        self.delimiter = ''
+
+    def step(self, value, delimiter, key):
+        self.delimiter = delimiter
+        if value is not None:
+            self.items.append((key, value))
+
+    def finalize(self):
+        return self.delimiter.join(str(value) for _, value in sorted(self.items)) if self.items else None
+
+
+# rewrites of the Snowflake SQL used by the models into sqlite
+SNOWFLAKE_TO_SQLITE = [
+    (re.compile(r"\{\{\s*config\(.*?\)\s*\}\}", re.S), ''),
+    (re.compile(r"\{\{\s*ref\('(\w+)'\s*\)\s*\}\}"), r'\1'),
+    (re.compile(r"LISTAGG\((.+?), ('[^']*')\) WITHIN GROUP \(ORDER BY (\w+) ASC\)"), r'ORDERED_LISTAGG(\1, \2, \3)'),
+    (re.compile(r'COUNT_IF\(([^()]*)\)'), r'SUM(CASE WHEN \1 THEN 1 ELSE 0 END)'),
+    (re.compile(r'\bIFF\('), 'IIF('),
+    (re.compile(r'(\w+)::STRING'), r'CAST(\1 AS TEXT)')
+]
+
+
+def replay_dbt_model(model_name: str, tables: dict):
+    """
+    Run the SQL of a dbt model on sqlite, over local tables: only the Snowflake functions listed in
+    SNOWFLAKE_TO_SQLITE are supported, and timestamps are stored as epoch ms
+
+    :param model_name: name of a model in dbt/models/public
+    :param tables: dict of referenced model name to dataframe
+    :return: dataframe with the model output
+    """
+    with open(os.path.join(DBT_MODELS_PATH, model_name + '.sql')) as f:
+        query = f.read()
+    for pattern, replacement in SNOWFLAKE_TO_SQLITE:
+        query = pattern.sub(replacement, query)
+
+    connection = sqlite3.connect(':memory:')
+    connection.create_aggregate('ORDERED_LISTAGG', 3, _OrderedListAgg)
+    for name, frame in tables.items():
+        frame = frame.copy()
+        for column in frame.columns[frame.dtypes.map(pd.api.types.is_datetime64_any_dtype)]:
+            frame[column] = frame[column].to_numpy().astype('datetime64[ms]').astype(np.int64)
+        frame.to_sql(name, connection, index=False)
+    try:
+        return pd.read_sql_query(query, connection)
+    finally:
+        connection.close()
+
+
+def check(n_rows: int):
+    """
+    Replay the SQL of cart_session_actions on sqlite and check that it matches the local model, and gives the
+    same training data as labelling cart_sessions in Python, on synthetic sessions plus edge cases
+    """
+    browsing_train = pd.concat([make_browsing_train(n_rows), edge_case_browsing_train()], ignore_index=True)
+    outputs, _ = run_models(browsing_train, verbose=False)
+    local = outputs['cart_session_actions']
+    replayed = replay_dbt_model('cart_session_actions', {'distinct_events_incremental': outputs['distinct_events']})
+    replayed['start_time'] = pd.to_datetime(replayed['start_time'], unit='ms')
+
+    assert replayed['label'].notna().all(), 'cart_session_actions has NULL labels'
+    edge_labels = replayed[replayed['session_id_hash'].str.startswith('edge_')].set_index('session_id_hash')
+    assert edge_labels['label'].to_dict() == {'edge_purchase_after_add': 1, 'edge_two_purchases': 1,
+                                              'edge_abandon': 0}, edge_labels
+    columns = ['session_id_hash', 'label', 'actions']
+    assert replayed[columns].sort_values('session_id_hash').reset_index(drop=True).astype(str).equals(
+        local[columns].sort_values('session_id_hash').reset_index(drop=True).astype(str)), \
+        'the SQL of cart_session_actions and the local model disagree'
+
+    replayed = replayed.sort_values(['label', 'start_time'], ascending=[False, True], kind='mergesort')
+    assert cart_session_training_data(outputs['cart_sessions']) == decode_action_codes(
+        replayed['actions'].tolist(), replayed['label'].tolist()), 'cart_sessions and cart_session_actions disagree'
+    print('cart_session_actions: SQL replay, local model and cart_sessions agree on {} sessions'.format(len(replayed)))
+
+
+def benchmark(sizes):
+    """
+    Time each model as the number of browsing rows grows, and check that labelling cart_sessions in Python
+    gives the same training data as cart_session_actions
+    """
+    results = []
+    for n_rows in sizes:
+        outputs, timings = run_models(make_browsing_train(n_rows), verbose=False)
+        x, y = cart_session_training_data(outputs['cart_sessions'])
+        encoded = outputs['cart_session_actions']
+        assert (x, y) == decode_action_codes(encoded['actions'].tolist(), encoded['label'].tolist()), \
+            'cart_sessions and cart_session_actions disagree'
+        results.append(dict(timings, rows=n_rows, total=sum(timings.values())))
+    results = pd.DataFrame(results).set_index('rows')
+    print('Seconds per model:')
+    print(results.round(3).to_string())
+    print('Rows per second (total): ' + ', '.join('{}: {:.0f}'.format(n_rows, n_rows / total)
+                                                  for n_rows, total in results['total'].items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='run the models over a browsing_train file')
+    run_parser.add_argument('browsing_train', help='SIGIR browsing_train file, .csv or .parquet')
+    run_parser.add_argument('output_folder', help='folder for the model outputs, as .parquet files')
+    run_parser.add_argument('--organization-id', default='local')
+    benchmark_parser = subparsers.add_parser('benchmark', help='time the models on synthetic data')
+    benchmark_parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000])
+    check_parser = subparsers.add_parser('check', help='check the SQL of the models against the local models')
+    check_parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args()
+
+    if args.command == 'benchmark':
+        benchmark(args.rows)
+    elif args.command == 'check':
+        check(args.rows)
+    else:
+        model_outputs, _ = run_models(read_browsing_train(args.browsing_train), args.organization_id)
+        os.makedirs(args.output_folder, exist_ok=True)
+        for model_name, model_output in model_outputs.items():
+            if not isinstance(model_output, pa.Table):
+                model_output = pa.Table.from_pandas(model_output, preserve_index=False)
+            pq.write_table(model_output, os.path.join(args.output_folder, model_name + '.parquet'))
+        print('Models saved at: {}'.format(args.output_folder))
@@ -1,8 +1,13 @@
 import os
+import sys
 import json
+import numpy as np
 
 from enum import Enum
-from data_processing.connectors.sf_connector import SFSelfClosingNamespaceConnection
+
+# the labelling is shared with the intent flow of local_flow
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'local_flow', 'intent', 'src'))
+from session_labels import UNKNOWN_ACTION, sessions_to_flat_array, prepare_training_arrays
 
 
 class Actions(int, Enum):
@@ -15,13 +20,30 @@ class Actions(int, Enum):
     pageview = 6
 
 
-def prepare_dataset():
-    sessions = read_data_from_snowflake('', ['events'])
-    x, y = prepare_training_data(sessions)
+ACTION_VALUES = {action.name: action.value for action in Actions}
+ACTION_MEMBERS = {action: action.value for action in Actions}
+
+
+def prepare_dataset(encoded=True):
+    """
+    Build the labelled dataset from Snowflake
+
+    :param encoded: if True, read the sessions labelled and encoded by the cart_session_actions dbt model,
+        otherwise label the sessions of cart_sessions in Python
+    :return: dict with X (sessions of action indices, with start/end tokens) and y (labels)
+    """
+    if encoded:
+        x, y = read_encoded_sessions_from_snowflake()
+    else:
+        actions, offsets = read_actions_from_snowflake()
+        x, y = prepare_training_arrays(actions, offsets)
     return {'X': x, 'y': y}
 
 
-def read_data_from_snowflake(table, columns):
+def _target_connection():
+    # imported here, so that the labelling functions can be used without the Snowflake connector
+    from data_processing.connectors.sf_connector import SFSelfClosingNamespaceConnection
+
     # load env
     try:
         from dotenv import load_dotenv
@@ -31,11 +53,83 @@ def read_data_from_snowflake(table, columns):
     warehouse = os.getenv("SNOWFLAKE_WAREHOUSE")
     database = os.getenv("SNOWFLAKE_DB")
     schema = os.getenv("SNOWFLAKE_SCHEMA_TARGET")
-    with SFSelfClosingNamespaceConnection(warehouse, database, schema) as sf_con:
+    return SFSelfClosingNamespaceConnection(warehouse, database, schema)
+
+
+def read_data_from_snowflake(table, columns):
+    with _target_connection() as sf_con:
         sessions = sf_con.dict_get_all()
     return [[Actions[event['normalized_action']] for event in json.loads(session['EVENTS'])] for session in sessions]
 
 
+def read_actions_from_snowflake(table='cart_sessions'):
+    """
+    Stream the sessions from Snowflake, batch by batch, into a flat array of actions: only the
+    normalized actions are fetched, and no list of events per session is ever built
+
+    :param table: session table, with an events array per session
+    :return: flat int8 action array and int64 offsets, as sessions_to_flat_array
+    """
+    actions = []
+    lengths = []
+    with _target_connection() as sf_con:
+        for batch in sf_con.session_action_batches(table):
+            batch_actions, batch_lengths = encode_action_strings(batch)
+            actions.append(batch_actions)
+            lengths.append(batch_lengths)
+            print('Fetched {} sessions'.format(sum(len(_) for _ in lengths)))
+    lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    actions = np.concatenate(actions) if actions else np.zeros(0, dtype=np.int8)
+    return actions, offsets
+
+
+def read_encoded_sessions_from_snowflake(table='cart_session_actions'):
+    """
+    Stream labelled sessions from the cart_session_actions dbt model: purchase sessions first, then abandon
+    sessions, each by start time, as prepare_training_data orders them
+
+    :param table: table with label and actions columns, as built by the cart_session_actions model
+    :return: x and y, as prepare_training_data
+    """
+    actions = []
+    labels = []
+    query = f"SELECT label, actions FROM {table} ORDER BY label DESC, start_time ASC"
+    with _target_connection() as sf_con:
+        for batch in sf_con.fetch_arrow_batches(query):
+            actions.extend(batch.column('ACTIONS').to_pylist())
+            labels.extend(batch.column('LABEL').to_pylist())
+    return decode_action_codes(actions, labels)
+
+
+def decode_action_codes(actions, labels):
+    """
+    Decode sessions encoded with one digit per action (e.g. '5524') into training data
+
+    :param actions: encoded sessions
+    :param labels: 1 for purchase sessions, 0 for abandon sessions
+    :return: x (sessions of action indices, with start/end tokens) and y
+    """
+    x = [[Actions.start.value] + list(map(int, a)) + [Actions.end.value] for a in actions]
+    y = [int(label) for label in labels]
+    assert len(x) == len(y)
+    return x, y
+
+
+def encode_action_strings(sessions):
+    """
+    Encode sessions given as comma-separated action names (e.g. 'detail,add,purchase')
+
+    :param sessions: list of strings, one per session
+    :return: flat int8 array of action indices and int64 session lengths
+    """
+    lengths = np.array([s.count(',') + 1 if s else 0 for s in sessions], dtype=np.int64)
+    names = ','.join(s for s in sessions if s).split(',') if lengths.sum() else []
+    actions = np.fromiter((ACTION_VALUES.get(name, UNKNOWN_ACTION) for name in names), dtype=np.int8, count=len(names))
+    return actions, lengths
+
+
 def session_indexed(s):
     """
     Converts a session (of actions) to indices and adds start/end tokens
@@ -55,36 +149,5 @@ def prepare_training_data(sessions):
     :param sessions: list of sessions
     :return:
     """
-
-    purchase_sessions = []
-    abandon_sessions = []
-    for s in sessions:
-        # check that purchase action occurs after add action
-        if Actions.purchase in s and Actions.add in s and s.index(Actions.purchase) > s.index(Actions.add):
-            first_purchase = s.index(Actions.purchase)
-            p_session = s
-            # truncate session if multiple purchase actions in a session
-            if s.count(Actions.purchase) > 1:
-                second_purchase = s.index(Actions.purchase, first_purchase+1)
-                p_session = s[:second_purchase]
-            # remove actual purchase from list
-            p_session.pop(first_purchase)
-            purchase_sessions.append(p_session)
-            assert not any(e == Actions.purchase for e in p_session)
-
-        # add action but no purchase
-        elif Actions.add in s and not Actions.purchase in s:
-            abandon_sessions.append(s)
-
-    # convert sessions to index
-    purchase_sessions = [session_indexed(s) for s in purchase_sessions]
-    abandon_sessions = [session_indexed(s) for s in abandon_sessions]
-
-    # combine session with purchase and abandon
-    x = purchase_sessions + abandon_sessions
-
-    # give label=1 for purchase, label=0 for abandon
-    y = [1]*len(purchase_sessions) + [0]*len(abandon_sessions)
-    assert len(x) == len(y)
-
-    return x, y
+    actions, offsets = sessions_to_flat_array(sessions, ACTION_MEMBERS)
+    return prepare_training_arrays(actions, offsets)
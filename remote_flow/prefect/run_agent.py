@@ -1,6 +1,7 @@
 import os
 
-from prefect import Flow
+import snowflake.connector
+from prefect import Flow, task
 from prefect.tasks.dbt import DbtShellTask
 from prefect.tasks.shell import ShellTask
 from prefect.tasks.great_expectations import RunGreatExpectationsValidation
@@ -29,6 +30,46 @@ dbt_task = DbtShellTask(
     name="DBT",
 )
 
+@task(name="Sessions watermark")
+def dbt_run_command():
+    """
+    Build the dbt run command: the incremental session models get, as the sessions_since var, the timestamp of
+    the latest event they both already include, so that only the sessions touched by newer events are recomputed.
+    On the first run (no session models yet), or when they were built before they had end_time, they are rebuilt
+    from scratch with --full-refresh, as their watermark would otherwise read a missing column. distinct_events,
+    which distinct_events_incremental replaces, is only built to check the two with dbt test.
+
+    :return: dbt command
+    """
+    ctx = snowflake.connector.connect(
+        user=os.getenv('SNOWFLAKE_USER'),
+        password=os.getenv('SNOWFLAKE_PWD'),
+        account=os.getenv('SNOWFLAKE_ACCOUNT'),
+        role=os.getenv('SNOWFLAKE_ROLE'),
+        warehouse=os.getenv('SNOWFLAKE_WAREHOUSE'),
+        database=os.getenv('SNOWFLAKE_DB'),
+        schema=os.getenv('SNOWFLAKE_SCHEMA_TARGET'),
+    )
+    try:
+        watermark = ctx.cursor().execute(
+            "SELECT LEAST((SELECT MAX(end_time) FROM session_stats), (SELECT MAX(end_time) FROM sessions))"
+        ).fetchone()[0]
+    except snowflake.connector.errors.ProgrammingError as e:
+        # tables not built yet, or sessions still without end_time
+        print(e)
+        watermark = None
+    finally:
+        ctx.close()
+
+    print('Sessions watermark: {}'.format(watermark))
+    if watermark is None:
+        # build everything else incrementally, then the session models (and downstream) from scratch
+        return 'dbt run --exclude distinct_events session_stats+ && dbt run --full-refresh --models session_stats+'
+    # a quoted timestamp string, cast to TIMESTAMP_NTZ by the watermark macro
+    return "dbt run --exclude distinct_events --vars '{{sessions_since: \"{}\"}}'".format(
+        watermark.isoformat(sep=' '))
+
+
 # Define the MetaFlow task
 metaflow_task = ShellTask(
     log_stderr=True,
@@ -49,8 +90,8 @@ serverless_task = ShellTask(
 flow_name = os.getenv('PREFECT_FLOW_NAME')
 
 with Flow(flow_name) as flow:
-    # Prepare data with dbt
-    dbt_output = dbt_task(command='dbt run')
+    # Prepare data with dbt, incrementally from the latest sessions already built
+    dbt_output = dbt_task(command=dbt_run_command())
 
     # Run GE validation tasks
     database = os.getenv('SNOWFLAKE_DB').lower()